@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""NMEA 解析器微基准：对比原字符串解析器与字节级解析器的吞吐量。
+
+用法：
+    python3 benchmarks/bench_nmea_parser.py [--corpus 文件] [--repeat 20]
+
+默认使用 benchmarks/data/um220_drive.nmea（UM220 行驶记录样本，含少量校验错误行）。
+"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main  # noqa: E402
+
+DEFAULT_CORPUS = Path(__file__).with_name("data") / "um220_drive.nmea"
+
+
+def load_corpus(path: Path) -> list[bytes]:
+    """按 readline() 的形式读取语料（保留行尾）。"""
+
+    with path.open("rb") as file:
+        return [line for line in file if line.strip()]
+
+
+def time_once(func, lines: list[bytes]) -> float:
+    """解析一遍语料，返回耗时（秒）。"""
+
+    start = time.perf_counter()
+    for line in lines:
+        func(line)
+    return time.perf_counter() - start
+
+
+def bench(candidates: dict, lines: list[bytes], repeat: int) -> dict:
+    """交替重复运行各解析器（降低 CPU 频率波动的影响），返回每秒处理行数。"""
+
+    best = {label: float("inf") for label in candidates}
+    for _ in range(repeat):
+        for label, func in candidates.items():
+            best[label] = min(best[label], time_once(func, lines))
+
+    rates = {}
+    for label, elapsed in best.items():
+        rates[label] = len(lines) / elapsed
+        print(f"{label:<10} {rates[label]:>12,.0f} 行/秒  ({elapsed * 1e6 / len(lines):.2f} µs/行)")
+    return rates
+
+
+def main_bench():
+    """脚本入口。"""
+
+    parser = argparse.ArgumentParser(description="NMEA 解析器微基准")
+    parser.add_argument("--corpus", type=Path, default=DEFAULT_CORPUS, help="NMEA 记录文件")
+    parser.add_argument("--repeat", type=int, default=20, help="重复次数（取最快一次）")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    lines = load_corpus(args.corpus)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config = main.PublisherConfig(
+            port="",
+            baudrate=main.SERIAL_BAUDRATE,
+            mqtt_host="",
+            mqtt_port=0,
+            mqtt_user="",
+            mqtt_pass="",
+            mqtt_topic="",
+            mqtt_control_topic="",
+            mqtt_status_topic="",
+            mqtt_command_result_topic="",
+            device_id="bench",
+            history_file=Path(tmp) / "history.jsonl",
+        )
+        publisher = main.GPSPublisher(config)
+
+        def legacy(line: bytes):
+            return publisher.parse_nmea_sentence(line.decode("utf-8", errors="ignore").strip(), "bench")
+
+        parser_bytes = main.NMEABytesParser()
+
+        def fast(line: bytes):
+            return parser_bytes.parse(line, "bench")
+
+        print(f"语料: {args.corpus}（{len(lines)} 行）")
+        rates = bench({"legacy": legacy, "bytes": fast}, lines, args.repeat)
+        print(f"加速比: {rates['bytes'] / rates['legacy']:.2f}x")
+
+        checker = main.NMEABytesParser()
+        rejected = 0
+        mismatched = 0
+        for line in lines:
+            old = legacy(line)
+            new = checker.parse(line, "bench")
+            if old and not new:
+                rejected += 1
+                continue
+            if old and new:
+                old.pop("timestamp")
+                new.pop("timestamp")
+                mismatched += old != new
+        print(f"字节解析器拒绝的定位行: {rejected}（校验和错误 {checker.checksum_errors}），字段不一致: {mismatched}")
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""端到端基准：伪终端 → main.py（独立进程）→ 进程内替身 MQTT 服务器。
+
+无需 GPS 模块与 MQTT 服务器，在普通 Linux 上即可运行，可用于 CI 中的吞吐量回归测试。
+按给定的历元速率（每秒历元数，每个历元为 RMC/GGA/GLL 三条语句，"max" 表示尽快写入）
+依次写入数据，报告每一档的语句吞吐、串口写入到服务器收到的延迟分位数、丢失数、CPU 与内存。
+
+用法：
+    python3 benchmarks/bench_pipeline.py [--rates 1,10,100,max] [--duration 5] [--corpus 文件] [-- main.py 额外参数]
+
+不指定 --corpus 时生成合成轨迹；指定时循环使用记录文件中的语句，并把时间改写为递增的合成时间，
+使每个历元都能与收到的消息一一对应（校验和错误的行保持原样，以保留解析器的容错路径）。
+"""
+
+from __future__ import annotations
+
+import argparse
+import itertools
+import json
+import math
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tty
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Iterator, Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main  # noqa: E402
+from stub_broker import StubBroker  # noqa: E402
+
+MAIN_SCRIPT = Path(__file__).resolve().parent.parent / "main.py"
+TOPIC = "bench/location"
+CONTROL_TOPIC = "bench/control"
+STATUS_TOPIC = "bench/status"
+RESULT_TOPIC = "bench/result"
+EPOCH_START = datetime(2024, 1, 1)
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def nmea_sentence(body: str) -> bytes:
+    """为语句主体加上 $、校验和与行尾。"""
+
+    data = body.encode("ascii")
+    return b"$%s*%02X\r\n" % (data, main.nmea_checksum(data))
+
+
+def _nmea_lat_lng(lat: float, lng: float) -> tuple[str, str, str, str]:
+    """十进制度转换为 NMEA 的 ddmm.mmmmm / dddmm.mmmmm。"""
+
+    lat_deg, lng_deg = int(abs(lat)), int(abs(lng))
+    lat_text = f"{lat_deg:02d}{(abs(lat) - lat_deg) * 60:08.5f}"
+    lng_text = f"{lng_deg:03d}{(abs(lng) - lng_deg) * 60:08.5f}"
+    return lat_text, "N" if lat >= 0 else "S", lng_text, "E" if lng >= 0 else "W"
+
+
+def epoch_key(seq: int) -> tuple[str, str]:
+    """第 seq 个历元的 (utc_date, utc_time)，与解析结果中的字段格式一致。"""
+
+    moment = EPOCH_START + timedelta(seconds=seq)
+    return moment.strftime("%Y-%m-%d"), moment.strftime("%H:%M:%S")
+
+
+def synthetic_epochs(start_seq: int = 0) -> Iterator[tuple[tuple[str, str], bytes]]:
+    """生成沿圆形轨迹（半径约 500 米，约 10 m/s）行驶的历元，每个历元为 RMC、GGA、GLL 三条语句。"""
+
+    center_lat, center_lng = main.DEFAULT_MANUAL_LATITUDE, main.DEFAULT_MANUAL_LONGITUDE
+    radius_deg = 500 / 111_320
+    for seq in itertools.count(start_seq):
+        moment = EPOCH_START + timedelta(seconds=seq)
+        angle = seq * 0.02
+        lat = center_lat + radius_deg * math.sin(angle)
+        lng = center_lng + radius_deg * math.cos(angle) / math.cos(math.radians(center_lat))
+        lat_text, ns, lng_text, ew = _nmea_lat_lng(lat, lng)
+        hhmmss = moment.strftime("%H%M%S.00")
+        course = (90 - math.degrees(angle) + 180) % 360
+        data = b"".join(
+            (
+                nmea_sentence(
+                    f"GNRMC,{hhmmss},A,{lat_text},{ns},{lng_text},{ew},19.438,{course:.2f},"
+                    f"{moment.strftime('%d%m%y')},,,A"
+                ),
+                nmea_sentence(f"GNGGA,{hhmmss},{lat_text},{ns},{lng_text},{ew},1,12,0.87,41.3,M,-7.4,M,,"),
+                nmea_sentence(f"GNGLL,{lat_text},{ns},{lng_text},{ew},{hhmmss},A,A"),
+            )
+        )
+        yield epoch_key(seq), data
+
+
+def _restamp(line: bytes, moment: datetime) -> bytes:
+    """把记录语句中的时间（及 RMC 日期）改写为合成时间并重算校验和；校验和错误的行原样返回。"""
+
+    text = line.strip()
+    if not text.startswith(b"$") or b"*" not in text:
+        return line
+    body, _, checksum = text[1:].partition(b"*")
+    if checksum[:2].upper() != b"%02X" % main.nmea_checksum(body):
+        return line
+
+    fields = body.split(b",")
+    kind = fields[0][-3:]
+    hhmmss = moment.strftime("%H%M%S.00").encode()
+    if kind == b"RMC" and len(fields) > 9:
+        fields[1], fields[9] = hhmmss, moment.strftime("%d%m%y").encode()
+    elif kind == b"GGA" and len(fields) > 1:
+        fields[1] = hhmmss
+    elif kind == b"GLL" and len(fields) > 5:
+        fields[5] = hhmmss
+    return nmea_sentence(b",".join(fields).decode("ascii"))
+
+
+def corpus_epochs(path: Path, start_seq: int = 0) -> Iterator[tuple[tuple[str, str], bytes]]:
+    """循环读取记录文件，按原始 UTC 时间分组为历元并改写为递增的合成时间。"""
+
+    def groups():
+        while True:
+            current, chunk = None, []
+            with main.open_history_text(path) as file:
+                for line in file:
+                    parts = line.split(",")
+                    stamp = None
+                    if parts[0].endswith("RMC") or parts[0].endswith("GGA"):
+                        stamp = parts[1] if len(parts) > 1 else None
+                    elif parts[0].endswith("GLL"):
+                        stamp = parts[5] if len(parts) > 5 else None
+                    if stamp and stamp != current and chunk:
+                        yield chunk
+                        chunk = []
+                    current = stamp or current
+                    chunk.append(line.encode("ascii", errors="ignore"))
+            if chunk:
+                yield chunk
+
+    for seq, chunk in zip(itertools.count(start_seq), groups()):
+        moment = EPOCH_START + timedelta(seconds=seq)
+        yield epoch_key(seq), b"".join(_restamp(line, moment) for line in chunk)
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """线性插值分位数。"""
+
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * fraction
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+def process_usage(pid: int) -> tuple[float, int, int]:
+    """读取进程累计 CPU 秒数、当前 RSS 与峰值 RSS（KB）。"""
+
+    with open(f"/proc/{pid}/stat", encoding="ascii") as file:
+        fields = file.read().rsplit(")", 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    rss = peak = 0
+    with open(f"/proc/{pid}/status", encoding="ascii") as file:
+        for line in file:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1])
+            elif line.startswith("VmHWM:"):
+                peak = int(line.split()[1])
+    return cpu, rss, peak
+
+
+class PtyFeeder:
+    """伪终端主端：写入 NMEA 数据，并在后台读走被测程序写给串口的配置命令。"""
+
+    def __init__(self):
+        """创建伪终端对并设为原始模式。"""
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        threading.Thread(target=self._drain, name="pty-drain", daemon=True).start()
+
+    def _drain(self):
+        """丢弃从被测程序收到的数据。"""
+
+        while True:
+            try:
+                if not os.read(self.master, 4096):
+                    return
+            except OSError:
+                return
+
+    def write(self, data: bytes):
+        """写入全部数据（缓冲区满时阻塞，即被测程序读取不及时会反压写入端）。"""
+
+        view = memoryview(data)
+        while view:
+            written = os.write(self.master, view)
+            view = view[written:]
+
+
+def run_level(
+    broker: StubBroker,
+    feeder: PtyFeeder,
+    epochs: Iterator[tuple[tuple[str, str], bytes]],
+    rate: Optional[float],
+    duration: float,
+    pid: int,
+) -> dict:
+    """以指定速率（None 表示尽快）写入 duration 秒，等待处理完毕后统计本档结果。"""
+
+    sent: dict[tuple[str, str], float] = {}
+    lines = 0
+    start_index = len(broker.messages)
+    cpu_before = process_usage(pid)[0]
+
+    start = time.perf_counter()
+    deadline = start + duration
+    for index, (key, data) in enumerate(epochs):
+        if rate:
+            target = start + index / rate
+            now = time.perf_counter()
+            if target > now:
+                time.sleep(target - now)
+        feeder.write(data)
+        sent[key] = time.perf_counter()
+        lines += data.count(b"\n")
+        if time.perf_counter() >= deadline:
+            break
+    write_elapsed = time.perf_counter() - start
+
+    # 等待积压处理完：连续 1 秒没有新消息或最多 10 秒
+    last_count, stable_since = -1, time.monotonic()
+    while time.monotonic() - stable_since < 1.0 and time.monotonic() - start < duration + 10:
+        count = len(broker.messages)
+        if count != last_count:
+            last_count, stable_since = count, time.monotonic()
+        time.sleep(0.1)
+    cpu_after, rss, peak = process_usage(pid)
+
+    latencies = []
+    for message in broker.messages[start_index:]:
+        if message.topic != TOPIC:
+            continue
+        for fix in _decode_fixes(message.payload):
+            sent_at = sent.get((fix.get("utc_date"), fix.get("utc_time")))
+            if sent_at is not None:
+                latencies.append((message.received_at - sent_at) * 1000)
+
+    return {
+        "rate": rate,
+        "epochs": len(sent),
+        "lines": lines,
+        "lines_per_s": lines / write_elapsed,
+        "received": len(latencies),
+        "lost": len(sent) - len(latencies),
+        "p50_ms": percentile(latencies, 0.50),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+        "max_ms": max(latencies, default=float("nan")),
+        "cpu_pct": (cpu_after - cpu_before) / (time.perf_counter() - start) * 100,
+        "rss_mb": rss / 1024,
+        "peak_rss_mb": peak / 1024,
+    }
+
+
+def _decode_fixes(payload: bytes) -> list[dict]:
+    """解析单条或批量 JSON 定位消息。"""
+
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        return []
+    if data.get("message_type") == "BATCH":
+        return data.get("fixes", [])
+    return [data]
+
+
+def query_status(broker: StubBroker, timeout: float = 5.0) -> Optional[dict]:
+    """通过控制主题请求状态，返回命令回执中的状态字典。"""
+
+    index = len(broker.messages)
+    broker.publish(CONTROL_TOPIC, json.dumps({"command": "status"}))
+
+    def completed(message) -> bool:
+        # 命令先回复 accepted 回执，最终结果才带状态
+        return message.topic == RESULT_TOPIC and json.loads(message.payload).get("phase") != "accepted"
+
+    if not broker.wait_for(lambda messages: any(completed(m) for m in messages[index:]), timeout):
+        return None
+    result = next(m for m in broker.messages[index:] if completed(m))
+    return json.loads(result.payload).get("status")
+
+
+def main_bench():
+    """脚本入口。"""
+
+    parser = argparse.ArgumentParser(description="GPS 发布器端到端基准")
+    parser.add_argument("--rates", default="1,10,100,max", help="历元速率列表（每秒历元数，max 表示尽快）")
+    parser.add_argument("--duration", type=float, default=5.0, help="每档持续写入的秒数")
+    parser.add_argument("--corpus", type=Path, help="使用记录的 NMEA 文件（可为 .gz），缺省生成合成轨迹")
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出结果（便于 CI 比较）")
+    parser.add_argument("extra", nargs="*", help="传给 main.py 的额外参数（写在 -- 之后）")
+    args = parser.parse_args()
+
+    rates = [None if item.strip() == "max" else float(item) for item in args.rates.split(",")]
+    broker = StubBroker()
+    feeder = PtyFeeder()
+    epochs = corpus_epochs(args.corpus) if args.corpus else synthetic_epochs()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        command = [
+            sys.executable,
+            str(MAIN_SCRIPT),
+            "--port", feeder.port,
+            "--mqtt-host", broker.host,
+            "--mqtt-port", str(broker.port),
+            "--mqtt-user", "",
+            "--mqtt-pass", "",
+            "--mqtt-topic", TOPIC,
+            "--mqtt-control-topic", CONTROL_TOPIC,
+            "--mqtt-status-topic", STATUS_TOPIC,
+            "--mqtt-command-result-topic", RESULT_TOPIC,
+            "--device-id", "bench",
+            "--history-file", str(Path(tmp) / "history.jsonl"),
+            "--spool-dir", str(Path(tmp) / "spool"),
+            *args.extra,
+        ]  # fmt: skip
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            # 采集启动（配置命令发送完毕、读取线程就绪）后会发布一次状态
+            if not broker.wait_for(lambda messages: any(m.topic == STATUS_TOPIC for m in messages), 30):
+                raise SystemExit("被测程序未能启动（30 秒内未收到状态消息）")
+
+            results = []
+            for rate in rates:
+                result = run_level(broker, feeder, epochs, rate, args.duration, process.pid)
+                status = query_status(broker) or {}
+                result["queue_dropped"] = status.get("line_queue", {}).get("dropped")
+                result["checksum_errors"] = status.get("nmea", {}).get("checksum_errors")
+                results.append(result)
+                if not args.json:
+                    print(
+                        f"{'max' if rate is None else f'{rate:g}/s':>7} "
+                        f"{result['lines_per_s']:>10,.0f} 行/秒  "
+                        f"收到 {result['received']:>6}/{result['epochs']:<6} 丢失 {result['lost']:<5} "
+                        f"队列丢弃 {result['queue_dropped']}  "
+                        f"延迟 p50 {result['p50_ms']:.1f} / p95 {result['p95_ms']:.1f} / "
+                        f"p99 {result['p99_ms']:.1f} ms  "
+                        f"CPU {result['cpu_pct']:.0f}%  RSS {result['rss_mb']:.1f} MB（峰值 {result['peak_rss_mb']:.1f}）"
+                    )
+            if args.json:
+                print(json.dumps(results, ensure_ascii=False, indent=2))
+        finally:
+            process.send_signal(signal.SIGINT)
+            try:
+                process.wait(15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            broker.close()
+
+
+if __name__ == "__main__":
+    main_bench()
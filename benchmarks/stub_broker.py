@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""进程内 MQTT 3.1.1 替身服务器，仅用于基准测试与回放测试。
+
+支持 CONNECT、PUBLISH（QoS 0/1）、SUBSCRIBE（精确主题匹配）、PINGREQ 与 DISCONNECT，
+收到的每条 PUBLISH 都记录接收时刻（time.perf_counter()），供测量端到端延迟。
+"""
+
+from __future__ import annotations
+
+import socket
+import struct
+import threading
+import time
+from dataclasses import dataclass
+
+
+@dataclass
+class ReceivedMessage:
+    """服务器收到的一条 PUBLISH。"""
+
+    topic: str
+    payload: bytes
+    qos: int
+    received_at: float
+
+
+def _encode_length(length: int) -> bytes:
+    """MQTT 剩余长度的变长编码。"""
+
+    out = bytearray()
+    while True:
+        digit = length % 128
+        length //= 128
+        out.append(digit | 0x80 if length else digit)
+        if not length:
+            return bytes(out)
+
+
+class StubBroker:
+    """监听本地随机端口的最小 MQTT 服务器，每个连接一个线程。"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        """创建监听套接字并启动接受线程。"""
+
+        self._server = socket.create_server((host, port))
+        self.host = host
+        self.port = self._server.getsockname()[1]
+        self.messages: list[ReceivedMessage] = []
+        self._subscriptions: list[tuple[socket.socket, str]] = []
+        self._connections: list[socket.socket] = []
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._closed = False
+        threading.Thread(target=self._accept_loop, name="stub-broker", daemon=True).start()
+
+    def close(self):
+        """关闭监听与全部连接。"""
+
+        self._closed = True
+        self._server.close()
+        self.disconnect_all()
+
+    def disconnect_all(self):
+        """断开全部客户端连接（模拟服务器故障）。"""
+
+        with self._lock:
+            connections, self._connections = self._connections, []
+            self._subscriptions = []
+        for conn in connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+                conn.close()
+            except OSError:
+                pass
+
+    def publish(self, topic: str, payload: bytes | str):
+        """向订阅了该主题的客户端下发一条 QoS 0 消息。"""
+
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        topic_bytes = topic.encode("utf-8")
+        body = struct.pack(">H", len(topic_bytes)) + topic_bytes + payload
+        packet = b"\x30" + _encode_length(len(body)) + body
+        with self._lock:
+            targets = [conn for conn, subscribed in self._subscriptions if subscribed == topic]
+        for conn in targets:
+            try:
+                conn.sendall(packet)
+            except OSError:
+                pass
+
+    def wait_for(self, predicate, timeout: float) -> bool:
+        """等待直到 predicate(messages) 为真或超时。"""
+
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while not predicate(self.messages):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def _accept_loop(self):
+        """接受新连接。"""
+
+        while not self._closed:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self._lock:
+                self._connections.append(conn)
+            threading.Thread(target=self._serve, args=(conn,), name="stub-broker-conn", daemon=True).start()
+
+    @staticmethod
+    def _read_exact(stream, size: int) -> bytes:
+        """读取指定字节数，连接关闭时抛出 EOFError。"""
+
+        data = stream.read(size)
+        if len(data) < size:
+            raise EOFError
+        return data
+
+    def _serve(self, conn: socket.socket):
+        """处理一个客户端连接。"""
+
+        stream = conn.makefile("rb")
+        try:
+            while True:
+                header = self._read_exact(stream, 1)[0]
+                length, multiplier = 0, 1
+                while True:
+                    digit = self._read_exact(stream, 1)[0]
+                    length += (digit & 0x7F) * multiplier
+                    multiplier *= 128
+                    if digit < 0x80:
+                        break
+                body = self._read_exact(stream, length) if length else b""
+                received_at = time.perf_counter()
+                packet_type = header >> 4
+
+                if packet_type == 1:  # CONNECT
+                    conn.sendall(b"\x20\x02\x00\x00")
+                elif packet_type == 3:  # PUBLISH
+                    qos = (header >> 1) & 0x03
+                    topic_length = struct.unpack_from(">H", body)[0]
+                    offset = 2 + topic_length
+                    topic = body[2:offset].decode("utf-8")
+                    if qos:
+                        conn.sendall(b"\x40\x02" + body[offset : offset + 2])
+                        offset += 2
+                    with self._cond:
+                        self.messages.append(ReceivedMessage(topic, body[offset:], qos, received_at))
+                        self._cond.notify_all()
+                    self.publish(topic, body[offset:])
+                elif packet_type == 8:  # SUBSCRIBE
+                    topic_length = struct.unpack_from(">H", body, 2)[0]
+                    topic = body[4 : 4 + topic_length].decode("utf-8")
+                    with self._lock:
+                        self._subscriptions.append((conn, topic))
+                    conn.sendall(b"\x90\x03" + body[:2] + b"\x00")
+                elif packet_type == 12:  # PINGREQ
+                    conn.sendall(b"\xd0\x00")
+                elif packet_type == 14:  # DISCONNECT
+                    break
+        except (EOFError, OSError):
+            pass
+        finally:
+            with self._lock:
+                self._subscriptions = [(c, t) for c, t in self._subscriptions if c is not conn]
+                if conn in self._connections:
+                    self._connections.remove(conn)
+            try:
+                conn.close()
+            except OSError:
+                pass
@@ -0,0 +1,112 @@
+"use strict";
+
+// 定位消息解码：兼容单条 JSON、批量 JSON（message_type 为 BATCH）与紧凑二进制（"GF" 开头）。
+// 紧凑格式与 main.py 中 encode_compact_batch / decode_compact_batch 保持一致。
+
+const COMPACT_VERSION = 1;
+const COMPACT_HAS_SATELLITES = 0x01;
+const COMPACT_HAS_HDOP = 0x02;
+const COMPACT_HAS_ALTITUDE = 0x04;
+const COMPACT_HAS_QUALITY = 0x08;
+const COMPACT_FENCE_KNOWN = 0x10;
+const COMPACT_INSIDE_FENCE = 0x20;
+const COMPACT_HAS_TYPE = 0x40;
+const COMPACT_MESSAGE_NAMES = { 1: "RMC", 2: "GLL", 3: "GGA", 4: "MANUAL", 5: "FIX" };
+
+function isCompactPayload(bytes) {
+  return bytes.length >= 3 && bytes[0] === 0x47 && bytes[1] === 0x46;
+}
+
+function decodeCompactBatch(bytes) {
+  const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+  const version = view.getUint8(2);
+  if (version !== COMPACT_VERSION) {
+    throw new Error(`不支持的紧凑消息版本: ${version}`);
+  }
+
+  const count = view.getUint16(4, true);
+  let offset = 6;
+  const deviceLength = view.getUint8(offset);
+  offset += 1;
+  const deviceId = new TextDecoder().decode(bytes.subarray(offset, offset + deviceLength));
+  offset += deviceLength;
+
+  const readVarint = () => {
+    let result = 0;
+    let scale = 1;
+    for (;;) {
+      const byte = bytes[offset];
+      offset += 1;
+      result += (byte & 0x7f) * scale;
+      if (byte < 0x80) {
+        return result;
+      }
+      scale *= 128;
+    }
+  };
+  const unzigzag = (value) => (value % 2 === 0 ? value / 2 : -(value + 1) / 2);
+
+  const fixes = [];
+  if (!count) {
+    return { version, deviceId, fixes };
+  }
+
+  let ts = Number(view.getBigInt64(offset, true));
+  let lat = view.getInt32(offset + 8, true);
+  let lng = view.getInt32(offset + 12, true);
+  offset += 16;
+
+  for (let i = 0; i < count; i += 1) {
+    ts += unzigzag(readVarint());
+    lat += unzigzag(readVarint());
+    lng += unzigzag(readVarint());
+    const fix = {
+      device_id: deviceId,
+      time: ts,
+      latitude: lat / 1e7,
+      longitude: lng / 1e7,
+      speed_ms: readVarint() / 100,
+      course: readVarint() / 100
+    };
+    const mask = bytes[offset];
+    offset += 1;
+
+    if (mask & COMPACT_HAS_SATELLITES) {
+      fix.num_satellites = bytes[offset];
+      offset += 1;
+    }
+    if (mask & COMPACT_HAS_HDOP) {
+      fix.hdop = readVarint() / 100;
+    }
+    if (mask & COMPACT_HAS_ALTITUDE) {
+      fix.altitude = unzigzag(readVarint()) / 10;
+    }
+    if (mask & COMPACT_HAS_QUALITY) {
+      fix.quality = bytes[offset];
+      offset += 1;
+    }
+    if (mask & COMPACT_FENCE_KNOWN) {
+      fix.isInsideFence = Boolean(mask & COMPACT_INSIDE_FENCE);
+    }
+    if (mask & COMPACT_HAS_TYPE) {
+      fix.message_type = COMPACT_MESSAGE_NAMES[bytes[offset]] || null;
+      offset += 1;
+    }
+    fixes.push(fix);
+  }
+
+  return { version, deviceId, fixes };
+}
+
+function decodeGpsPayload(payload) {
+  const bytes = payload instanceof Uint8Array ? payload : new TextEncoder().encode(String(payload));
+  if (isCompactPayload(bytes)) {
+    return decodeCompactBatch(bytes).fixes;
+  }
+
+  const data = JSON.parse(new TextDecoder().decode(bytes));
+  if (data && data.message_type === "BATCH" && Array.isArray(data.fixes)) {
+    return data.fixes;
+  }
+  return [data];
+}
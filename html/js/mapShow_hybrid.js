@@ -1414,8 +1414,7 @@ function connectMQTTFromForm() {
     }
 
     try {
-      const data = JSON.parse(payload.toString());
-      handleIncomingPoint(data);
+      decodeGpsPayload(payload).forEach(handleIncomingPoint);
     } catch (error) {
       console.warn("解析MQTT消息失败", error);
     }
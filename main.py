@@ -9,26 +9,85 @@
 from __future__ import annotations
 
 import argparse
+import asyncio
+import bisect
+import calendar
+import concurrent.futures
 import contextlib
+import csv
+import glob
+import gzip
+import io
+import itertools
 import json
 import logging
+import math
+import mmap
 import os
+import queue
+import random
+import shutil
+import re
+import select
+import signal
 import socket
+import struct
+import sys
+import threading
 import time
-from dataclasses import dataclass
-from datetime import datetime, timedelta
+import urllib.parse
+import zlib
+from array import array
+from collections import deque
+from dataclasses import dataclass, replace
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional
 
 import paho.mqtt.client as mqtt
 import serial
 import serial.tools.list_ports
+from serial.tools.list_ports_common import ListPortInfo
+
+try:  # fcntl 仅 POSIX 可用：用于按网卡读取 IPv4 地址
+    import fcntl
+except ImportError:  # pragma: no cover - 取决于运行环境
+    fcntl = None
+
+try:  # NumPy 可选：存在时二进制历史查询直接返回结构化数组视图
+    import numpy as np
+except ImportError:  # pragma: no cover - 取决于运行环境
+    np = None
 
 
 # ====================== 可修改的参数 ======================
 # 串口配置
-SERIAL_PORT: str | None = "/dev/ttyUSB0"  # 示例："/dev/ttyAMA0"，为 None 时自动选择第一个可用串口
-SERIAL_BAUDRATE: int = 9600
+SERIAL_PORT: str | None = "/dev/ttyUSB0"  # 示例："/dev/ttyAMA0"，为 None 时自动探测输出 NMEA 的串口
+SERIAL_BAUDRATE: int = 9600  # 为 0 时在 SERIAL_PROBE_BAUDRATES 中自动探测
+# 自动选择串口（SERIAL_PORT 为 None）或自动波特率时：并行打开候选串口，依次尝试各波特率，
+# 在 SERIAL_PROBE_TIMEOUT 秒内收到校验正确的 NMEA 语句即选中；结果（串口、波特率、USB 序列号）
+# 保存到 SERIAL_PORT_CACHE（None 表示不缓存），下次启动直接使用，设备无输出时才重新探测
+SERIAL_PROBE_BAUDRATES: tuple[int, ...] = (9600, 115200, 38400, 19200, 57600, 4800)
+SERIAL_PROBE_TIMEOUT: float = 8.0
+SERIAL_PORT_CACHE: Optional[Path] = Path(__file__).with_name("serial_port.json")
+# 串口断开（如 USB 松动）后自动重连：设备重新出现后打开并重新配置接收机，
+# 失败按 SERIAL_RECONNECT_MIN_DELAY ~ SERIAL_RECONNECT_MAX_DELAY 秒指数退避（带抖动）
+SERIAL_RECONNECT: bool = True
+SERIAL_RECONNECT_MIN_DELAY: float = 1.0
+SERIAL_RECONNECT_MAX_DELAY: float = 60.0
+# 接收机配置方案：启动采集时启用的语句、输出频率（1/2/5/10 Hz，0 表示保持接收机设置）
+# 与切换到的波特率（0 表示不切换）；每条命令等待接收机应答，最多 RECEIVER_ACK_TIMEOUT 秒
+RECEIVER_SENTENCES: tuple[str, ...] = ("RMC", "GLL")
+RECEIVER_RATE_HZ: float = 0.0
+RECEIVER_BAUDRATE: int = 0
+RECEIVER_ACK_TIMEOUT: float = 0.3
+# 多接收机：非空时一个进程同时读取多个串口，格式 "串口=设备ID,..."，"auto" 表示自动发现全部串口
+RECEIVERS: str = ""
+# 串口读取线程与处理线程之间的环形缓冲区容量（行数）及溢出策略：
+# "drop-oldest" 丢弃最旧的行、"drop-newest" 丢弃新到的行、"block" 阻塞读取线程直到有空位
+SERIAL_QUEUE_SIZE: int = 1024
+SERIAL_QUEUE_POLICY: str = "drop-oldest"
 
 # MQTT 配置
 MQTT_HOST: str = "wauclub.com"
@@ -39,6 +98,8 @@ MQTT_TOPIC: str = "student/location"
 MQTT_CONTROL_TOPIC: str = "student/location/control"
 MQTT_STATUS_TOPIC: str = "student/location/status"
 MQTT_COMMAND_RESULT_TOPIC: str = "student/location/control/result"
+MQTT_FENCE_TOPIC: str = "student/location/fence"
+MQTT_TRIP_TOPIC: str = "student/location/trip"
 
 # 设备 ID
 DEVICE_ID: str = "um220_tracker_001"
@@ -46,10 +107,101 @@ DEVICE_ID: str = "um220_tracker_001"
 # 历史文件（JSON Lines）
 HISTORY_FILE: Path = Path(__file__).with_name("history.jsonl")
 
+# 历史写入批处理：累计条数或时间窗口（秒）先到者触发一次写入；
+# 落盘策略 "none" 仅写入系统缓存、"batch" 每批 fsync、"interval" 每隔 HISTORY_FSYNC_INTERVAL 秒 fsync
+HISTORY_BATCH_SIZE: int = 50
+HISTORY_BATCH_INTERVAL: float = 1.0
+HISTORY_FSYNC_POLICY: str = "interval"
+HISTORY_FSYNC_INTERVAL: float = 10.0
+HISTORY_MAX_PENDING: int = 10000
+# 历史分段（默认关闭，前端只读取 history.jsonl）：当前文件超过 HISTORY_ROTATE_BYTES 字节（0 表示不限）或跨天时滚动为 history-时间.jsonl，
+# 关闭的分段在后台压缩（"none"/"gzip"/"zstd"，zstd 需 Python 3.14+ 标准库支持，否则回退 gzip），
+# 所有历史文件总大小超过 HISTORY_RETENTION_BYTES（0 表示不限）时删除最旧分段
+HISTORY_ROTATE_BYTES: int = 0
+HISTORY_ROTATE_DAILY: bool = False
+HISTORY_COMPRESSION: str = "none"
+HISTORY_RETENTION_BYTES: int = 0
+# 历史记录中原始负载 raw 的保存方式："full" 完整保存、"slim" 去掉与记录重复的字段、"drop" 不保存
+HISTORY_RAW_MODE: str = "full"
+# 历史存储后端："jsonl" 文本、"binary" 定长二进制分段（可内存映射、带稀疏时间索引）、"both" 同时写入
+HISTORY_BACKEND: str = "jsonl"
+HISTORY_BINARY_DIR: Path = Path(__file__).with_name("history_bin")
+# 本地历史查询 HTTP 服务（供地图前端拉取轨迹），端口为 0 时常规运行不启动；--serve-history 缺省用 8765
+HISTORY_HTTP_HOST: str = "127.0.0.1"
+HISTORY_HTTP_PORT: int = 0
+# 地图轨迹多分辨率金字塔：历史查询服务的 GET /track 按缩放级别返回简化后的编码折线，
+# 各级别误差不超过 TRACK_LOD_PIXEL_TOLERANCE 个屏幕像素；结果按设备与日期缓存在 TRACK_LOD_DIR（None 表示不启用），
+# 已结束的小时不再重建，当前小时由后台线程每 TRACK_LOD_REFRESH_INTERVAL 秒刷新
+TRACK_LOD_DIR: Optional[Path] = Path(__file__).with_name("track_lod")
+TRACK_LOD_PIXEL_TOLERANCE: float = 1.0
+TRACK_LOD_REFRESH_INTERVAL: float = 60.0
+# 运行指标：Prometheus 文本格式的 GET /metrics 服务，端口为 0 时不启动；STATUS 消息中始终附带指标摘要
+METRICS_HTTP_HOST: str = "127.0.0.1"
+METRICS_HTTP_PORT: int = 0
+# 设备信息（负载、内存、IP）由后台线程每 SYSTEM_INFO_INTERVAL 秒采样一次，状态消息直接读取缓存；
+# 常驻运行时每 HEARTBEAT_INTERVAL 秒向状态主题发布心跳，只包含与上一条状态相比变化的字段（0 表示不发送）
+SYSTEM_INFO_INTERVAL: float = 30.0
+HEARTBEAT_INTERVAL: float = 60.0
+
+# 历元融合（默认关闭，--epoch-fusion 开启）：把同一 UTC 时刻的 RMC/GLL/GGA 合并为一条 FIX 消息发布；
+# 收齐 EPOCH_FUSION_SENTENCES 中的语句或等待超过 EPOCH_FUSION_TIMEOUT 秒即发出
+EPOCH_FUSION_ENABLED: bool = False
+EPOCH_FUSION_SENTENCES: tuple[str, ...] = ("RMC", "GLL")
+EPOCH_FUSION_TIMEOUT: float = 0.5
+
+# MQTT 定位消息编码："json" 每条 JSON、"compact" 紧凑二进制（见 encode_compact_batch）；
+# MQTT_BATCH_SIZE > 1 时累计条数或等待 MQTT_BATCH_INTERVAL_MS 毫秒后合并为一条消息发布
+MQTT_PAYLOAD_ENCODING: str = "json"
+MQTT_BATCH_SIZE: int = 1
+MQTT_BATCH_INTERVAL_MS: int = 1000
+# MQTT 发布窗口：定位消息的 QoS（0 或 1），最多 MQTT_MAX_INFLIGHT 条已交给 paho 尚未确认
+# （QoS 1 等 PUBACK，QoS 0 等写入套接字），其余在容量为 MQTT_QUEUE_SIZE 条的队列中等待；
+# 队列满时按 MQTT_QUEUE_POLICY 处理（同 SERIAL_QUEUE_POLICY），被挤出的消息在启用断线发送队列时写入该队列；
+# HISTORY_AFTER_ACK 为 True 时定位在服务器确认后才写入历史，设备历史与服务器收到的数据一致
+MQTT_QOS: int = 0
+MQTT_MAX_INFLIGHT: int = 20
+MQTT_QUEUE_SIZE: int = 1000
+MQTT_QUEUE_POLICY: str = "drop-oldest"
+HISTORY_AFTER_ACK: bool = False
+
+# 发布前过滤链（逗号分隔，按顺序执行，空字符串表示不过滤）：
+# "deadband" 距离/航向死区，"simplify" 流式轨迹简化（开窗法，误差不超过 SIMPLIFY_TOLERANCE_M 米）；
+# 两者都保证至少每 FILTER_MAX_SILENCE_S 秒发布一次
+PUBLISH_FILTERS: str = ""
+DEADBAND_DISTANCE_M: float = 5.0
+DEADBAND_HEADING_DEG: float = 20.0
+SIMPLIFY_TOLERANCE_M: float = 5.0
+FILTER_MAX_SILENCE_S: float = 60.0
+
+# 电子围栏：从 FENCE_FILE（GeoJSON，多边形或带 radius_m 的圆，None 或文件不存在表示不启用）加载，
+# 每条定位设置 isInsideFence 并在进入/离开时向 MQTT_FENCE_TOPIC 发布事件；
+# 进入或离开都要越过边界 FENCE_HYSTERESIS_M 米，避免在边界附近反复触发；控制命令 reload_fences 热加载
+FENCE_FILE: Optional[Path] = Path(__file__).with_name("fences.geojson")
+FENCE_HYSTERESIS_M: float = 10.0
+
+# 行程统计：速度不低于 TRIP_MOVING_SPEED_MS（未上报速度时按相邻定位推算）视为移动，
+# 最后一次移动后 TRIP_STOP_DWELL_S 秒内没有再移动即结束行程（长时间收不到定位同样结束）；
+# 结束时向 MQTT_TRIP_TOPIC 发布距离、时长与平均/最高速度，距离不足 TRIP_MIN_DISTANCE_M 米的视为漂移不发布
+TRIP_MOVING_SPEED_MS: float = 1.0
+TRIP_STOP_DWELL_S: float = 180.0
+TRIP_MIN_DISTANCE_M: float = 100.0
+
+# 断线发送队列：MQTT 不可用时未发出的消息追加到 SPOOL_DIR（None 表示不启用），
+# 总大小超过 SPOOL_MAX_BYTES 时丢弃最旧分段；重连后按每秒 SPOOL_DRAIN_RATE 条、
+# 最多 SPOOL_DRAIN_WINDOW 条未确认的 QoS 1 消息在后台重放
+SPOOL_DIR: Optional[Path] = Path(__file__).with_name("spool")
+SPOOL_MAX_BYTES: int = 64 * 1024 * 1024
+SPOOL_SEGMENT_BYTES: int = 1024 * 1024
+SPOOL_DRAIN_RATE: float = 20.0
+SPOOL_DRAIN_WINDOW: int = 10
+
 # 手动发布默认值（用于 --manual-* 参数缺省时）
 DEFAULT_MANUAL_LONGITUDE: float = 121.061722
 DEFAULT_MANUAL_LATITUDE: float = 40.885880
 DEFAULT_MANUAL_SPEED_MS: float = 0.0
+# 批量手动发布（--manual-file）：每秒最多发布条数（0 表示不限速）与最多未确认的 QoS 1 消息数
+MANUAL_PUBLISH_RATE: float = 0.0
+MANUAL_INFLIGHT_WINDOW: int = 20
 # ========================================================
 
 
@@ -76,382 +228,6394 @@ class PublisherConfig:
     mqtt_command_result_topic: str
     device_id: str
     history_file: Path
+    receiver_sentences: tuple[str, ...] = RECEIVER_SENTENCES
+    receiver_rate_hz: float = RECEIVER_RATE_HZ
+    receiver_baudrate: int = RECEIVER_BAUDRATE
+    probe_baudrates: tuple[int, ...] = SERIAL_PROBE_BAUDRATES
+    probe_timeout: float = SERIAL_PROBE_TIMEOUT
+    port_cache: Optional[Path] = SERIAL_PORT_CACHE
+    serial_reconnect: bool = SERIAL_RECONNECT
+    serial_reconnect_min_delay: float = SERIAL_RECONNECT_MIN_DELAY
+    serial_reconnect_max_delay: float = SERIAL_RECONNECT_MAX_DELAY
+    mqtt_qos: int = MQTT_QOS
+    mqtt_max_inflight: int = MQTT_MAX_INFLIGHT
+    mqtt_queue_size: int = MQTT_QUEUE_SIZE
+    mqtt_queue_policy: str = MQTT_QUEUE_POLICY
+    history_after_ack: bool = HISTORY_AFTER_ACK
+    mqtt_fence_topic: str = MQTT_FENCE_TOPIC
+    fence_file: Optional[Path] = FENCE_FILE
+    fence_hysteresis_m: float = FENCE_HYSTERESIS_M
+    mqtt_trip_topic: str = MQTT_TRIP_TOPIC
+    trip_moving_speed_ms: float = TRIP_MOVING_SPEED_MS
+    trip_stop_dwell_s: float = TRIP_STOP_DWELL_S
+    trip_min_distance_m: float = TRIP_MIN_DISTANCE_M
+    queue_size: int = SERIAL_QUEUE_SIZE
+    queue_policy: str = SERIAL_QUEUE_POLICY
+    history_batch_size: int = HISTORY_BATCH_SIZE
+    history_batch_interval: float = HISTORY_BATCH_INTERVAL
+    history_fsync_policy: str = HISTORY_FSYNC_POLICY
+    history_fsync_interval: float = HISTORY_FSYNC_INTERVAL
+    history_rotate_bytes: int = HISTORY_ROTATE_BYTES
+    history_rotate_daily: bool = HISTORY_ROTATE_DAILY
+    history_compression: str = HISTORY_COMPRESSION
+    history_retention_bytes: int = HISTORY_RETENTION_BYTES
+    history_raw_mode: str = HISTORY_RAW_MODE
+    history_backend: str = HISTORY_BACKEND
+    history_binary_dir: Path = HISTORY_BINARY_DIR
+    history_http_host: str = HISTORY_HTTP_HOST
+    history_http_port: int = HISTORY_HTTP_PORT
+    track_lod_dir: Optional[Path] = TRACK_LOD_DIR
+    track_lod_pixel_tolerance: float = TRACK_LOD_PIXEL_TOLERANCE
+    track_lod_refresh_interval: float = TRACK_LOD_REFRESH_INTERVAL
+    metrics_http_host: str = METRICS_HTTP_HOST
+    metrics_http_port: int = METRICS_HTTP_PORT
+    system_info_interval: float = SYSTEM_INFO_INTERVAL
+    heartbeat_interval: float = HEARTBEAT_INTERVAL
+    epoch_fusion: bool = EPOCH_FUSION_ENABLED
+    epoch_sentences: tuple[str, ...] = EPOCH_FUSION_SENTENCES
+    epoch_timeout: float = EPOCH_FUSION_TIMEOUT
+    payload_encoding: str = MQTT_PAYLOAD_ENCODING
+    batch_size: int = MQTT_BATCH_SIZE
+    batch_interval_ms: int = MQTT_BATCH_INTERVAL_MS
+    publish_filters: str = PUBLISH_FILTERS
+    deadband_distance_m: float = DEADBAND_DISTANCE_M
+    deadband_heading_deg: float = DEADBAND_HEADING_DEG
+    simplify_tolerance_m: float = SIMPLIFY_TOLERANCE_M
+    filter_max_silence_s: float = FILTER_MAX_SILENCE_S
+    spool_dir: Optional[Path] = SPOOL_DIR
+    spool_max_bytes: int = SPOOL_MAX_BYTES
+    spool_drain_rate: float = SPOOL_DRAIN_RATE
+
+
+QUEUE_POLICIES = ("drop-oldest", "drop-newest", "block")
+FSYNC_POLICIES = ("none", "batch", "interval")
+HISTORY_COMPRESSIONS = ("none", "gzip", "zstd")
+HISTORY_RAW_MODES = ("full", "slim", "drop")
+HISTORY_BACKENDS = ("jsonl", "binary", "both")
+PAYLOAD_ENCODINGS = ("json", "compact")
+HISTORY_SEGMENT_SUFFIXES = {".gz": "gzip", ".zst": "zstd"}
+
+# raw 精简模式下去掉的字段（已在历史记录顶层保存或可由其推导）
+HISTORY_SLIM_DROP_KEYS = frozenset(
+    {"latitude", "longitude", "lat", "lng", "time", "timestamp", "device_id", "deviceId", "source", "speed_ms", "speed"}
+)
 
 
-class GPSPublisher:
-    """负责读取串口、解析 NMEA 并发布到 MQTT 的核心类。"""
+def _zstd_module():
+    """返回标准库的 zstd 模块（Python 3.14+），不可用时返回 None。"""
 
-    def __init__(self, config: PublisherConfig):
-        """初始化发布器，保存配置并准备运行所需的状态字段。"""
+    try:
+        from compression import zstd  # type: ignore[import-not-found]
+    except ImportError:
+        return None
+    return zstd
 
-        self.config = config
-        self.service_active = False
-        self.gps_streaming = False
-        self.ser: Optional[serial.Serial] = None
-        self.mqtt_client: Optional[mqtt.Client] = None
-        self.history_file = config.history_file
-        self.history_file.touch(exist_ok=True)
-        self._mqtt_connected = False
-        self._data_count = 0
-        self._last_start_error: Optional[str] = None
-        self.command_help = {
-            "start": "启动或恢复 GPS 采集",
-            "stop": "停止 GPS 采集",
-            "status": "返回设备状态",
-            "help": "列出支持的命令及作用",
-        }
 
-    # ------------------------ 公共接口 ------------------------
-    def run(self):
-        """阻塞式运行，支持 MQTT 控制启动/停止与状态查询。"""
+def history_segments(path: Path) -> list[Path]:
+    """列出历史文件已滚动的分段（含压缩分段），按时间从旧到新排序。"""
 
-        if self.service_active:
-            logging.warning("GPS 服务已在运行中")
-            return
+    segments = []
+    prefix = f"{path.stem}-"
+    tails = {path.suffix} | {path.suffix + suffix for suffix in HISTORY_SEGMENT_SUFFIXES}
+    for candidate in path.parent.glob(f"{glob.escape(prefix)}*"):
+        stamp = candidate.name[len(prefix) :].split(".", 1)[0]
+        if not stamp.replace("-", "").isdigit() or candidate.name[len(prefix) + len(stamp) :] not in tails:
+            continue
+        # 同一秒内多次滚动时名称带 -1、-2 后缀，按数字元组排序保证先后顺序
+        segments.append((tuple(int(part) for part in stamp.split("-")), candidate))
+    return [candidate for _, candidate in sorted(segments)]
 
-        self.service_active = True
-        try:
-            self._initialize_mqtt()
-            self.start_streaming()
 
-            while self.service_active:
-                try:
-                    if self.gps_streaming and self.ser:
-                        line_bytes = self.ser.readline()
-                        if not line_bytes:
-                            continue
+def history_paths(path: Path) -> list[Path]:
+    """按时间顺序返回全部历史文件：已滚动分段在前，当前文件在最后。"""
 
-                        line = line_bytes.decode("utf-8", errors="ignore").strip()
-                        if not line:
-                            continue
+    paths = history_segments(path)
+    if path.exists():
+        paths.append(path)
+    return paths
 
-                        logging.debug("收到原始 NMEA: %s", line)
 
-                        gps_data = self.parse_nmea_sentence(line, self.config.device_id)
-                        if not gps_data:
-                            logging.debug("未解析的 NMEA 数据: %s", line)
-                            continue
+def open_compressed(path: Path):
+    """以二进制模式打开文件，按扩展名自动处理 gzip/zstd 压缩。"""
 
-                        self.publish_gps_data(gps_data, self.config.mqtt_topic)
-                        self._data_count += 1
+    for suffix, compression in HISTORY_SEGMENT_SUFFIXES.items():
+        if path.name.endswith(suffix):
+            if compression == "gzip":
+                return gzip.open(path, "rb")
+            zstd = _zstd_module()
+            if zstd is None:
+                raise RuntimeError(f"当前 Python 不支持 zstd，无法读取: {path}")
+            return zstd.open(path, "rb")
+    return path.open("rb")
 
-                        if self._data_count % 10 == 0:
-                            logging.info("运行中... 已发送 %d 条数据", self._data_count)
 
-                except serial.SerialException as exc:
-                    logging.error("串口错误: %s", exc)
-                    self.stop_streaming()
-                except Exception as exc:  # noqa: BLE001
-                    logging.error("处理数据时出错: %s", exc)
+def open_history_text(path: Path):
+    """以文本模式打开历史文件，自动处理 gzip/zstd 压缩分段。"""
 
-                time.sleep(0.1)
+    return io.TextIOWrapper(open_compressed(path), encoding="utf-8")
 
-        except KeyboardInterrupt:
-            logging.info("收到中断信号，准备退出...")
-        except Exception as exc:  # noqa: BLE001
-            logging.error("GPS 发布器错误: %s", exc)
-        finally:
-            self.service_active = False
-            self.cleanup_resources()
 
-    def publish_manual_location(
-        self,
-        longitude: float,
-        latitude: float,
-        speed_ms: float,
-        device_id: Optional[str] = None,
-    ) -> None:
-        """在无设备时手动发布一条测试数据。"""
+class LineRingBuffer:
+    """串口原始行的有界环形缓冲区，连接读取线程与处理线程。"""
 
-        payload: Dict[str, Any] = {
-            "message_type": "MANUAL",
-            "device_id": device_id or self.config.device_id,
-            "timestamp": datetime.utcnow().isoformat(),
-            "latitude": latitude,
-            "longitude": longitude,
-            "speed_ms": speed_ms,
-            "speed_knots": round(speed_ms / 0.51444, 3) if speed_ms else 0.0,
-            "source": "manual_input",
-        }
+    def __init__(self, capacity: int, policy: str = "drop-oldest"):
+        """按容量与溢出策略创建缓冲区。"""
 
-        try:
-            beijing_time = datetime.utcnow() + timedelta(hours=8)
-            payload["time"] = beijing_time.strftime("%Y/%m/%d %H:%M:%S")
-        except Exception:  # noqa: BLE001
-            payload["time"] = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+        if capacity <= 0:
+            raise ValueError(f"缓冲区容量必须为正数: {capacity}")
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f"未知的溢出策略: {policy}（可选: {', '.join(QUEUE_POLICIES)}）")
 
-        client = mqtt.Client()
-        if self.config.mqtt_user and self.config.mqtt_pass:
-            client.username_pw_set(self.config.mqtt_user, self.config.mqtt_pass)
+        self.capacity = capacity
+        self.policy = policy
+        self._items: deque[bytes] = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self.received = 0
+        self.dropped = 0
+        self.high_watermark = 0
 
-        try:
-            client.connect(self.config.mqtt_host, self.config.mqtt_port, 60)
-            client.loop_start()
-            result = client.publish(self.config.mqtt_topic, json.dumps(payload, ensure_ascii=False), qos=1)
-            result.wait_for_publish()
-            self.append_history_file(payload)
-            logging.info(
-                "手动发布数据成功: 纬度=%s, 经度=%s, 速度=%.3f m/s",
-                latitude,
-                longitude,
-                speed_ms,
-            )
-        except Exception as exc:  # noqa: BLE001
-            logging.error("手动发布数据失败: %s", exc)
-        finally:
-            with contextlib.suppress(Exception):
-                client.loop_stop()
-                client.disconnect()
+    def put(self, item: bytes) -> bool:
+        """写入一行，按策略处理溢出；返回该行是否进入缓冲区。"""
 
-    # ---------------------- 初始化流程 -----------------------
-    def _initialize_serial(self):
-        """打开配置的串口，校验可用设备并给出清晰的错误提示。"""
+        with self._cond:
+            self.received += 1
+            if len(self._items) >= self.capacity:
+                if self.policy == "drop-newest":
+                    self.dropped += 1
+                    return False
+                if self.policy == "drop-oldest":
+                    self._items.popleft()
+                    self.dropped += 1
+                else:
+                    while len(self._items) >= self.capacity and not self._closed:
+                        self._cond.wait(0.5)
+                    if self._closed:
+                        self.dropped += 1
+                        return False
+
+            self._items.append(item)
+            depth = len(self._items)
+            if depth > self.high_watermark:
+                self.high_watermark = depth
+            self._cond.notify_all()
+            return True
 
-        available_ports = [port.device for port in serial.tools.list_ports.comports()]
-        port = self.config.port
+    def get(self, timeout: Optional[float] = None) -> Optional[bytes]:
+        """取出最旧的一行，超时或缓冲区关闭且为空时返回 None。"""
 
-        if port:
-            if port not in available_ports:
-                suggestion = "，可能是大小写问题？" if any(p.lower() == port.lower() for p in available_ports) else ""
-                available = ", ".join(available_ports) or "无可用串口"
-                raise RuntimeError(f"指定的串口不存在: {port}（可用: {available}）{suggestion}")
-        else:
-            port = self._auto_detect_port()
-            logging.info("未指定串口，自动选择: %s", port)
+        with self._cond:
+            if not self._items:
+                self._cond.wait(timeout)
+                if not self._items:
+                    return None
+            item = self._items.popleft()
+            self._cond.notify_all()
+            return item
 
-        try:
-            self.ser = serial.Serial(
-                port=port,
-                baudrate=self.config.baudrate,
-                bytesize=serial.EIGHTBITS,
-                parity=serial.PARITY_NONE,
-                stopbits=serial.STOPBITS_ONE,
-                timeout=1,
-            )
-        except serial.SerialException as exc:  # noqa: BLE001
-            available = ", ".join(available_ports) or "无可用串口"
-            original = getattr(exc, "original_exception", None)
-            errno = getattr(exc, "errno", None)
-            detail = str(exc) or "未知错误"
+    def open(self):
+        """重新允许写入（重新开始采集时调用）。"""
 
-            if original:
-                errno = getattr(original, "errno", errno)
-                if not detail:
-                    detail = str(original)
+        with self._cond:
+            self._closed = False
 
-            busy_hint = ""
-            if (errno == 16) or ("Device or resource busy" in detail) or ("Errno 16" in detail):
-                busy_hint = "，设备被其他程序占用（例如 minicom），请关闭占用后重试"
-            elif (errno == 13) or ("Permission denied" in detail) or ("Errno 13" in detail):
-                busy_hint = "，权限不足，请确认当前用户对串口有访问权限"
+    def close(self):
+        """关闭缓冲区，唤醒所有等待中的读写方。"""
 
-            raise RuntimeError(f"串口打开失败: {port}，错误: {detail}{busy_hint}（可用: {available}）") from exc
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
 
-        if not self.ser.is_open:
-            raise RuntimeError("无法打开串口")
+    def __len__(self) -> int:
+        return len(self._items)
 
-        logging.info("串口连接成功: %s", port)
+    def stats(self) -> Dict[str, Any]:
+        """返回缓冲区深度与丢弃计数，用于状态上报。"""
 
-    def _initialize_mqtt(self):
-        """建立 MQTT 连接并注册控制消息回调。"""
+        with self._cond:
+            return {
+                "depth": len(self._items),
+                "capacity": self.capacity,
+                "policy": self.policy,
+                "received": self.received,
+                "dropped": self.dropped,
+                "high_watermark": self.high_watermark,
+            }
 
-        self.mqtt_client = mqtt.Client()
 
-        if self.config.mqtt_user and self.config.mqtt_pass:
-            self.mqtt_client.username_pw_set(self.config.mqtt_user, self.config.mqtt_pass)
+NMEAHandler = Callable[[list, str, str], Optional[Dict[str, Any]]]
 
-        def _on_connect(client, userdata, flags, rc):
-            """处理 MQTT 连接成功或失败的事件。"""
+# 语句 ID（如 b"RMC"）到解析函数的注册表，新增语句类型只需用 register_nmea_parser 注册
+NMEA_PARSERS: Dict[bytes, NMEAHandler] = {}
 
-            self._mqtt_connected = rc == 0
-            if rc == 0:
-                logging.info("MQTT 连接成功")
-                if self.config.mqtt_control_topic:
-                    client.subscribe(self.config.mqtt_control_topic)
-                    logging.info("已订阅控制主题: %s", self.config.mqtt_control_topic)
-            else:
-                logging.error("MQTT 连接失败，错误码: %s", rc)
+# 不处理也不记录日志的语句 ID
+NMEA_IGNORED: set[bytes] = {b"TXT"}
 
-        def _on_disconnect(client, userdata, rc):
-            """处理 MQTT 断开事件并刷新连接状态。"""
 
-            self._mqtt_connected = False
-            logging.info("MQTT 连接断开")
+def register_nmea_parser(sentence_id: str) -> Callable[[NMEAHandler], NMEAHandler]:
+    """注册指定语句 ID（不含 talker 前缀，如 "RMC"）的字节级解析函数。"""
 
-        self.mqtt_client.on_connect = _on_connect
-        self.mqtt_client.on_disconnect = _on_disconnect
-        self.mqtt_client.on_message = self._on_control_message
+    key = sentence_id.encode("ascii")
 
-        self.mqtt_client.connect(self.config.mqtt_host, self.config.mqtt_port, 60)
-        self.mqtt_client.loop_start()
-        logging.info("MQTT 连接中: %s:%s", self.config.mqtt_host, self.config.mqtt_port)
+    def decorator(func: NMEAHandler) -> NMEAHandler:
+        NMEA_PARSERS[key] = func
+        return func
 
-    def _auto_detect_port(self) -> str:
-        """自动选择第一个可用串口，若无可用设备则抛出异常。"""
+    return decorator
 
-        ports = [port.device for port in serial.tools.list_ports.comports()]
-        if not ports:
-            raise RuntimeError("未检测到可用串口，请检查连接")
-        return ports[0]
 
-    # ---------------------- 核心功能 ------------------------
-    def start_streaming(self):
-        """开启串口读取并发送配置命令。"""
+def nmea_checksum(body: bytes) -> int:
+    """计算 "$" 与 "*" 之间内容的 XOR 校验和。
 
-        if self.gps_streaming:
-            logging.info("GPS 采集已在运行")
-            return True
+    把整段字节（NMEA 语句最长 82 字节）视为一个大整数，依次把右移 64、32、…、1 字节的值异或进来，
+    最低字节即为全部字节的异或；固定 7 次整数运算，不需要掩码。超过 128 字节时逐字节计算。
+    """
 
-        self._data_count = 0
-        try:
-            self._last_start_error = None
-            self._initialize_serial()
-            self.send_gps_commands()
-            self.gps_streaming = True
-            self.publish_status()
-            logging.info("GPS 采集已启动")
-            return True
-        except Exception as exc:  # noqa: BLE001
-            logging.error("启动 GPS 采集失败: %s", exc)
-            self.gps_streaming = False
-            self._last_start_error = f"{exc.__class__.__name__}: {exc}" if str(exc) else exc.__class__.__name__
-            return False
+    if len(body) > 128:
+        result = 0
+        for byte in body:
+            result ^= byte
+        return result
 
-    def stop_streaming(self):
-        """停止串口读取并关闭串口。"""
+    value = int.from_bytes(body, "little")
+    value ^= value >> 512
+    value ^= value >> 256
+    value ^= value >> 128
+    value ^= value >> 64
+    value ^= value >> 32
+    value ^= value >> 16
+    value ^= value >> 8
+    return value & 0xFF
 
-        if not self.gps_streaming:
-            logging.info("GPS 采集已停止，无需重复停止")
-            return True
 
-        self.gps_streaming = False
-        self._close_serial()
-        self.publish_status()
-        logging.info("GPS 采集已停止")
-        return True
+_now_cache = [0, ""]
 
-    def send_gps_commands(self):
-        """向 GPS 模块发送配置命令。"""
 
-        config_commands = [
-            b"$CFGMSG,0,,0\r\n",  # 关闭所有消息
-            b"$CFGMSG,0,4,1\r\n",  # 开启 RMC 消息（1Hz）
-            b"$CFGMSG,0,1,1\r\n",  # 开启 GLL 消息（1Hz）
-        ]
+def _now_iso() -> str:
+    """返回本地时间的 ISO 字符串，同一毫秒内的多次调用复用缓存结果。"""
 
-        for cmd in config_commands:
-            try:
-                if self.ser:
-                    self.ser.write(cmd)
-                logging.info("发送配置命令: %s", cmd.decode().strip())
-                time.sleep(0.5)
-            except Exception as exc:  # noqa: BLE001
-                logging.error("发送命令失败: %s", exc)
+    tick = time.monotonic_ns() // 1_000_000
+    if _now_cache[0] != tick:
+        _now_cache[0] = tick
+        _now_cache[1] = datetime.now().isoformat()
+    return _now_cache[1]
 
-    def parse_nmea_sentence(self, sentence: str, device_id: str) -> Optional[Dict[str, Any]]:
-        """解析 NMEA 协议数据。"""
 
-        try:
-            sentence = sentence.strip()
+# 同一历元的 RMC/GGA/GLL 时间相同、日期极少变化，各缓存最近一次的 (字段, 结果)（整体替换，多线程读取安全）
+_nmea_time_cache: list[tuple[bytes, Optional[str]]] = [(b"", None)]
+_nmea_date_cache: list[tuple[bytes, Optional[str]]] = [(b"", None)]
 
-            if not sentence.startswith("$") or "*" not in sentence:
-                return None
 
-            data_body, checksum = sentence[1:].split("*")
-            parts = data_body.split(",")
+def _nmea_time(value: bytes) -> Optional[str]:
+    """将 hhmmss(.ss) 转为 hh:mm:ss；高于 1Hz 输出时保留非零的小数秒（hh:mm:ss.ss），以区分同一秒内的历元。"""
 
-            nmea_type = parts[0]
-            message_id = nmea_type[-3:]
+    cached = _nmea_time_cache[0]
+    if value == cached[0]:
+        return cached[1]
+    if len(value) < 6:
+        return None
+    text = value.decode("ascii")
+    fraction = text[6:].rstrip("0")
+    if len(fraction) > 1:
+        result = f"{text[:2]}:{text[2:4]}:{text[4:6]}{fraction}"
+    else:
+        result = f"{text[:2]}:{text[2:4]}:{text[4:6]}"
+    _nmea_time_cache[0] = (value, result)
+    return result
 
-            if message_id == "RMC":
-                return self.parse_rmc(parts, device_id)
-            if message_id == "GLL":
-                return self.parse_gll(parts, device_id)
-            if message_id == "GGA":
-                return self.parse_gga(parts, device_id)
 
-            if nmea_type not in {"TXT", "GNTXT"}:
-                logging.debug("忽略未处理的 NMEA 类型: %s", nmea_type)
-            return None
+def _nmea_date(value: bytes) -> Optional[str]:
+    """将 ddmmyy 转为 20yy-mm-dd。"""
 
-        except Exception as exc:  # noqa: BLE001
-            logging.error("NMEA 解析错误: %s", exc)
+    cached = _nmea_date_cache[0]
+    if value == cached[0]:
+        return cached[1]
+    if len(value) != 6:
+        return None
+    text = value.decode("ascii")
+    result = f"20{text[4:6]}-{text[2:4]}-{text[0:2]}"
+    _nmea_date_cache[0] = (value, result)
+    return result
+
+
+# 同一历元各语句的经纬度字段相同，缓存最近的转换结果（不含符号），超过上限时清空
+_nmea_coord_cache: Dict[bytes, float] = {}
+_NMEA_COORD_CACHE_SIZE = 64
+
+
+def _nmea_coord(value: bytes, direction: bytes) -> Optional[float]:
+    """将字节形式的 (d)ddmm.mmmm 坐标转换为带符号小数，空字段返回 None。"""
+
+    decimal = _nmea_coord_cache.get(value)
+    if decimal is None:
+        if not value:
+            return None
+        split = value.find(b".") - 2
+        if split < 0:
+            raise ValueError(f"无效的坐标值: {value!r}")
+        decimal = round(int(value[:split] or 0) + float(value[split:]) / 60.0, 6)
+        if len(_nmea_coord_cache) >= _NMEA_COORD_CACHE_SIZE:
+            _nmea_coord_cache.clear()
+        _nmea_coord_cache[value] = decimal
+    return -decimal if direction in (b"S", b"W") else decimal
+
+
+# RMC 字段位置
+_RMC_TIME, _RMC_STATUS, _RMC_LAT, _RMC_NS, _RMC_LON, _RMC_EW = 1, 2, 3, 4, 5, 6
+_RMC_SPEED, _RMC_COURSE, _RMC_DATE, _RMC_MODE = 7, 8, 9, 12
+
+
+@register_nmea_parser("RMC")
+def parse_rmc_bytes(fields: list, device_id: str, timestamp: str) -> Optional[Dict[str, Any]]:
+    """解析 RMC 语句（字节字段），仅返回有效定位。"""
+
+    if len(fields) < 12 or fields[_RMC_STATUS] != b"A":
+        return None
+
+    speed_knots = float(fields[_RMC_SPEED]) if fields[_RMC_SPEED] else 0.0
+    return {
+        "message_type": "RMC",
+        "device_id": device_id,
+        "timestamp": timestamp,
+        "utc_time": _nmea_time(fields[_RMC_TIME]),
+        "utc_date": _nmea_date(fields[_RMC_DATE]),
+        "latitude": _nmea_coord(fields[_RMC_LAT], fields[_RMC_NS]),
+        "longitude": _nmea_coord(fields[_RMC_LON], fields[_RMC_EW]),
+        "speed_knots": speed_knots,
+        "speed_ms": speed_knots * 0.51444,
+        "course": float(fields[_RMC_COURSE]) if fields[_RMC_COURSE] else 0.0,
+        "status": "A",
+        "mode": fields[_RMC_MODE].decode("ascii") if len(fields) > _RMC_MODE else None,
+    }
+
+
+# GLL 字段位置
+_GLL_LAT, _GLL_NS, _GLL_LON, _GLL_EW, _GLL_TIME, _GLL_STATUS = 1, 2, 3, 4, 5, 6
+
+
+@register_nmea_parser("GLL")
+def parse_gll_bytes(fields: list, device_id: str, timestamp: str) -> Optional[Dict[str, Any]]:
+    """解析 GLL 语句（字节字段），过滤无效状态。"""
+
+    if len(fields) < 7:
+        return None
+    status = fields[_GLL_STATUS]
+    if status not in (b"A", b"D"):
+        return None
+
+    return {
+        "message_type": "GLL",
+        "device_id": device_id,
+        "timestamp": timestamp,
+        "utc_time": _nmea_time(fields[_GLL_TIME]),
+        "latitude": _nmea_coord(fields[_GLL_LAT], fields[_GLL_NS]),
+        "longitude": _nmea_coord(fields[_GLL_LON], fields[_GLL_EW]),
+        "status": status.decode("ascii"),
+    }
+
+
+# GGA 字段位置
+_GGA_TIME, _GGA_LAT, _GGA_NS, _GGA_LON, _GGA_EW = 1, 2, 3, 4, 5
+_GGA_QUALITY, _GGA_SATS, _GGA_HDOP, _GGA_ALT = 6, 7, 8, 9
+
+
+@register_nmea_parser("GGA")
+def parse_gga_bytes(fields: list, device_id: str, timestamp: str) -> Optional[Dict[str, Any]]:
+    """解析 GGA 语句（字节字段），返回卫星数量、精度与高度。"""
+
+    if len(fields) < 15:
+        return None
+
+    return {
+        "message_type": "GGA",
+        "device_id": device_id,
+        "timestamp": timestamp,
+        "utc_time": _nmea_time(fields[_GGA_TIME]),
+        "latitude": _nmea_coord(fields[_GGA_LAT], fields[_GGA_NS]),
+        "longitude": _nmea_coord(fields[_GGA_LON], fields[_GGA_EW]),
+        "quality": int(fields[_GGA_QUALITY]) if fields[_GGA_QUALITY] else 0,
+        "num_satellites": int(fields[_GGA_SATS]) if fields[_GGA_SATS] else 0,
+        "hdop": float(fields[_GGA_HDOP]) if fields[_GGA_HDOP] else 0.0,
+        "altitude": float(fields[_GGA_ALT]) if fields[_GGA_ALT] else 0.0,
+    }
+
+
+class NMEABytesParser:
+    """直接处理 readline() 返回字节的 NMEA 解析器，校验 XOR 校验和并按注册表分发。"""
+
+    def __init__(self, handlers: Optional[Dict[bytes, NMEAHandler]] = None, require_checksum: bool = True):
+        """handlers 缺省使用全局注册表 NMEA_PARSERS。"""
+
+        self.handlers = NMEA_PARSERS if handlers is None else handlers
+        self.require_checksum = require_checksum
+        self.parsed = 0
+        self.checksum_errors = 0
+        self.malformed = 0
+        self.unhandled = 0
+
+    def parse(self, line: bytes, device_id: str) -> Optional[Dict[str, Any]]:
+        """解析一行原始字节，校验失败、格式错误或无有效定位时返回 None。"""
+
+        line = line.strip()
+        if not line:
             return None
 
-    def parse_rmc(self, parts: list[str], device_id: str) -> Optional[Dict[str, Any]]:
-        """解析 RMC 语句，提取定位、速度与日期时间等信息。"""
+        star = line.rfind(b"*")
+        if star < 0 or line[0] != 0x24:  # "$"
+            self.malformed += 1
+            return None
 
-        if len(parts) < 12:
+        # 语句 ID 为第一个逗号（无逗号时为 "*"）前的 3 个字符，直接在原行上切片
+        comma = line.find(b",", 1, star)
+        end = comma if comma >= 0 else star
+        sentence_id = line[max(end - 3, 1) : end]
+        handler = self.handlers.get(sentence_id)
+        if handler is None:
+            # 未注册的语句无需校验和解析，直接跳过
+            self.unhandled += 1
+            if sentence_id not in NMEA_IGNORED:
+                logging.debug("忽略未处理的 NMEA 类型: %s", line[1:end].decode("ascii", errors="replace"))
             return None
 
-        try:
-            status = parts[2]
-            if status != "A":
+        body = line[1:star]
+        if self.require_checksum or star + 1 < len(line):
+            try:
+                expected = int(line[star + 1 : star + 3], 16)
+            except ValueError:
+                self.malformed += 1
+                return None
+            if nmea_checksum(body) != expected:
+                self.checksum_errors += 1
+                logging.debug("NMEA 校验和错误，已丢弃: %r", line)
                 return None
 
-            utc_time = parts[1]
-            time_str = f"{utc_time[:2]}:{utc_time[2:4]}:{utc_time[4:6]}" if utc_time and len(utc_time) >= 6 else None
+        try:
+            result = handler(body.split(b","), device_id, _now_iso())
+        except (ValueError, IndexError, UnicodeDecodeError) as exc:
+            self.malformed += 1
+            logging.error("%s 解析错误: %s", sentence_id.decode("ascii", errors="replace"), exc)
+            return None
 
-            utc_date = parts[9]
-            date_str = f"20{utc_date[4:6]}-{utc_date[2:4]}-{utc_date[0:2]}" if utc_date and len(utc_date) == 6 else None
+        if result is not None:
+            self.parsed += 1
+        return result
 
-            latitude = self.dm_to_decimal(parts[3], parts[4]) if parts[3] else None
-            longitude = self.dm_to_decimal(parts[5], parts[6], is_longitude=True) if parts[5] else None
+    def stats(self) -> Dict[str, int]:
+        """返回解析计数，用于状态上报。"""
 
-            speed_knots = float(parts[7]) if parts[7] else 0.0
-            course = float(parts[8]) if parts[8] else 0.0
-            speed_ms = speed_knots * 0.51444
+        return {
+            "parsed": self.parsed,
+            "checksum_errors": self.checksum_errors,
+            "malformed": self.malformed,
+            "unhandled": self.unhandled,
+        }
 
-            return {
-                "message_type": "RMC",
-                "device_id": device_id,
-                "timestamp": datetime.now().isoformat(),
-                "utc_time": time_str,
-                "utc_date": date_str,
-                "latitude": latitude,
-                "longitude": longitude,
-                "speed_knots": speed_knots,
-                "speed_ms": speed_ms,
-                "course": course,
-                "status": status,
-                "mode": parts[12] if len(parts) > 12 else None,
-            }
 
-        except (ValueError, IndexError) as exc:
-            logging.error("RMC 解析错误: %s", exc)
+class EpochAssembler:
+    """历元组装器：按 utc_time 收集同一时刻的语句，合并为一条融合定位（FIX）。"""
+
+    # 各字段优先采用的语句顺序
+    POSITION_SOURCES = ("RMC", "GGA", "GLL")
+    FIELD_SOURCES = {
+        "utc_date": ("RMC",),
+        "speed_knots": ("RMC",),
+        "speed_ms": ("RMC",),
+        "course": ("RMC",),
+        "mode": ("RMC",),
+        "quality": ("GGA",),
+        "num_satellites": ("GGA",),
+        "hdop": ("GGA",),
+        "altitude": ("GGA",),
+        "status": ("RMC", "GLL"),
+    }
+
+    def __init__(self, expected: tuple[str, ...] = EPOCH_FUSION_SENTENCES, timeout: float = EPOCH_FUSION_TIMEOUT):
+        """expected 为一个历元应包含的语句类型，收齐后立即发出。"""
+
+        self.expected = frozenset(expected)
+        self.timeout = timeout
+        self._key: Optional[str] = None
+        self._parts: Dict[str, Dict[str, Any]] = {}
+        self._deadline = 0.0
+        self.sentences = 0
+        self.fixes = 0
+        self.timeouts = 0
+
+    def add(self, data: Dict[str, Any], now: Optional[float] = None) -> list[Dict[str, Any]]:
+        """加入一条解析结果，返回因此完成的融合定位（可能为空）。"""
+
+        now = time.monotonic() if now is None else now
+        self.sentences += 1
+        key = data.get("utc_time")
+        message_type = data.get("message_type")
+        if not key or not message_type:
+            # 无时间的语句无法归属历元，先发出当前历元再原样透传
+            return self.flush() + [data]
+
+        ready: list[Dict[str, Any]] = []
+        # 新时刻到达，或同类型语句重复（高于 1Hz 时同一秒内有多个历元）即视为新历元
+        if self._parts and (key != self._key or message_type in self._parts):
+            ready.extend(self.flush())
+
+        if not self._parts:
+            self._key = key
+            self._deadline = now + self.timeout
+        self._parts[message_type] = data
+
+        if self.expected <= self._parts.keys():
+            ready.extend(self.flush())
+        return ready
+
+    def poll(self, now: Optional[float] = None) -> list[Dict[str, Any]]:
+        """超时未收齐的历元直接发出。"""
+
+        now = time.monotonic() if now is None else now
+        if self._parts and now >= self._deadline:
+            self.timeouts += 1
+            return self.flush()
+        return []
+
+    def time_to_deadline(self, now: Optional[float] = None) -> Optional[float]:
+        """距离当前历元超时的秒数，无待发历元时返回 None。"""
+
+        if not self._parts:
             return None
+        now = time.monotonic() if now is None else now
+        return max(0.0, self._deadline - now)
+
+    def flush(self) -> list[Dict[str, Any]]:
+        """立即发出当前历元（若有）。"""
+
+        if not self._parts:
+            return []
+        parts = self._parts
+        self._parts = {}
+        self._key = None
+        self.fixes += 1
+        return [self._fuse(parts)]
+
+    def _fuse(self, parts: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+        """按字段来源优先级合并同一历元的语句。"""
+
+        first = next(iter(parts.values()))
+        fix: Dict[str, Any] = {
+            "message_type": "FIX",
+            "device_id": first.get("device_id"),
+            "timestamp": first.get("timestamp"),
+            "utc_time": first.get("utc_time"),
+        }
 
-    def parse_gll(self, parts: list[str], device_id: str) -> Optional[Dict[str, Any]]:
-        """解析 GLL 语句，提取经纬度与时间，过滤无效状态。"""
+        for source in self.POSITION_SOURCES:
+            data = parts.get(source)
+            if data and data.get("latitude") is not None and data.get("longitude") is not None:
+                fix["latitude"] = data["latitude"]
+                fix["longitude"] = data["longitude"]
+                break
 
-        if len(parts) < 7:
-            return None
+        for field, sources in self.FIELD_SOURCES.items():
+            for source in sources:
+                data = parts.get(source)
+                if data and data.get(field) is not None:
+                    fix[field] = data[field]
+                    break
 
-        try:
-            if parts[6] not in {"A", "D"}:
-                return None
+        fix["sentences"] = sorted(parts)
+        return fix
 
-            latitude = self.dm_to_decimal(parts[1], parts[2]) if parts[1] else None
-            longitude = self.dm_to_decimal(parts[3], parts[4], is_longitude=True) if parts[3] else None
-            utc_time = parts[5]
-            time_str = f"{utc_time[:2]}:{utc_time[2:4]}:{utc_time[4:6]}" if utc_time and len(utc_time) >= 6 else None
+    def stats(self) -> Dict[str, Any]:
+        """返回融合计数，用于状态上报。"""
 
-            return {
-                "message_type": "GLL",
-                "device_id": device_id,
-                "timestamp": datetime.now().isoformat(),
-                "utc_time": time_str,
-                "latitude": latitude,
-                "longitude": longitude,
-                "status": parts[6],
-            }
+        return {
+            "sentences": self.sentences,
+            "fixes": self.fixes,
+            "timeouts": self.timeouts,
+            "pending": len(self._parts),
+        }
 
-        except (ValueError, IndexError) as exc:
-            logging.error("GLL 解析错误: %s", exc)
-            return None
 
-    def parse_gga(self, parts: list[str], device_id: str) -> Optional[Dict[str, Any]]:
-        """解析 GGA 语句，返回卫星数量、精度与高度等信息。"""
+# 历史记录中 "YYYY/MM/DD HH:MM:SS" 时间为北京时间
+BEIJING_TZ = timezone(timedelta(hours=8))
+
+
+def history_timestamp_to_epoch(value: Any) -> Optional[float]:
+    """将历史记录的时间字段转换为 Unix 时间戳（秒），无法识别时返回 None。"""
+
+    if isinstance(value, (int, float)):
+        return value / 1000.0 if value > 1e12 else float(value)
+    if not isinstance(value, str) or not value:
+        return None
+
+    # 快速路径：append_history_file 写入的 "YYYY/MM/DD HH:MM:SS"
+    if len(value) == 19 and value[4] == "/" and value[7] == "/":
+        try:
+            return float(
+                calendar.timegm(
+                    (
+                        int(value[0:4]),
+                        int(value[5:7]),
+                        int(value[8:10]),
+                        int(value[11:13]),
+                        int(value[14:16]),
+                        int(value[17:19]),
+                    )
+                )
+                - 8 * 3600
+            )
+        except ValueError:
+            return None
+
+    try:
+        dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return dt.timestamp()
+
+
+# 定长二进制记录：时间戳(float64 秒) 纬度/经度(int32，1e-7 度) 速度(float32 m/s) 航向(float32 度) 标志(uint32)
+BINARY_RECORD = struct.Struct("<diiffI4x")
+BINARY_INDEX_ENTRY = struct.Struct("<dQ")
+BINARY_INDEX_STRIDE = 256
+BINARY_COORD_SCALE = 1e7
+# 查询用粗网格单元大小（1e-7 度单位，100000 即 0.01°，约 1 km）
+BINARY_GRID_CELL = 100_000
+BINARY_FLAG_INSIDE_FENCE = 0x1
+# 标志位 8~15 保存消息类型编码
+BINARY_MESSAGE_TYPES = {"RMC": 1, "GLL": 2, "GGA": 3, "MANUAL": 4, "FIX": 5}
+BINARY_MESSAGE_NAMES = {code: name for name, code in BINARY_MESSAGE_TYPES.items()}
+
+if np is not None:
+    BINARY_DTYPE = np.dtype(
+        {
+            "names": ["ts", "lat", "lng", "speed", "course", "flags"],
+            "formats": ["<f8", "<i4", "<i4", "<f4", "<f4", "<u4"],
+            "offsets": [0, 8, 12, 16, 20, 24],
+            "itemsize": BINARY_RECORD.size,
+        }
+    )
+
+
+def history_record_to_binary(record: Dict[str, Any]) -> Optional[tuple]:
+    """将一条历史记录转换为二进制记录字段元组，缺少时间或坐标时返回 None。"""
+
+    ts = history_timestamp_to_epoch(record.get("timestamp"))
+    if ts is None:
+        return None
+    try:
+        lat = int(round(float(record["lat"]) * BINARY_COORD_SCALE))
+        lng = int(round(float(record["lng"]) * BINARY_COORD_SCALE))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+    raw = record.get("raw") or {}
+    try:
+        speed = float(record.get("speed") or 0.0)
+        course = float(raw.get("course") or 0.0)
+    except (TypeError, ValueError):
+        speed, course = 0.0, 0.0
+
+    flags = BINARY_MESSAGE_TYPES.get(str(raw.get("message_type", "")), 0) << 8
+    if record.get("isInsideFence"):
+        flags |= BINARY_FLAG_INSIDE_FENCE
+    return ts, lat, lng, speed, course, flags
+
+
+def binary_fix_to_dict(fields: tuple, device_id: str) -> Dict[str, Any]:
+    """将二进制记录字段还原为与 history.jsonl 相近的字典。"""
+
+    ts, lat, lng, speed, course, flags = fields[:6]
+    return {
+        "timestamp": datetime.fromtimestamp(ts, BEIJING_TZ).strftime("%Y/%m/%d %H:%M:%S"),
+        "ts": ts,
+        "lng": round(lng / BINARY_COORD_SCALE, 7),
+        "lat": round(lat / BINARY_COORD_SCALE, 7),
+        "isInsideFence": bool(flags & BINARY_FLAG_INSIDE_FENCE),
+        "speed": round(float(speed), 3),
+        "course": round(float(course), 2),
+        "message_type": BINARY_MESSAGE_NAMES.get((int(flags) >> 8) & 0xFF),
+        "deviceId": device_id,
+    }
+
+
+class _BinarySegmentWriter:
+    """单个设备单日分段的追加写入器，维护稀疏时间索引。"""
+
+    def __init__(self, data_path: Path):
+        """打开分段并修复上次异常退出留下的半条记录或缺失的索引。"""
+
+        self.data_path = data_path
+        self.index_path = data_path.with_suffix(".gpsi")
+        data_path.parent.mkdir(parents=True, exist_ok=True)
+
+        self.data = data_path.open("ab")
+        size = self.data.tell()
+        if size % BINARY_RECORD.size:
+            size -= size % BINARY_RECORD.size
+            self.data.truncate(size)
+        self.count = size // BINARY_RECORD.size
+        self.running_max = float("-inf")
+        self._rebuild_index()
+        self.index = self.index_path.open("ab")
+
+    def _rebuild_index(self):
+        """依据数据文件校验索引，条目数不一致时整体重建。"""
+
+        expected = (self.count + BINARY_INDEX_STRIDE - 1) // BINARY_INDEX_STRIDE
+        entries = self.index_path.stat().st_size // BINARY_INDEX_ENTRY.size if self.index_path.exists() else 0
+        if self.count == 0:
+            self.index_path.write_bytes(b"")
+            return
+
+        with self.data_path.open("rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if entries == expected:
+                with self.index_path.open("rb") as index:
+                    index.seek((expected - 1) * BINARY_INDEX_ENTRY.size)
+                    self.running_max = BINARY_INDEX_ENTRY.unpack(index.read(BINARY_INDEX_ENTRY.size))[0]
+                start = (expected - 1) * BINARY_INDEX_STRIDE
+                for (ts, *_rest) in BINARY_RECORD.iter_unpack(mapped[start * BINARY_RECORD.size :]):
+                    self.running_max = max(self.running_max, ts)
+                return
+
+            logging.info("重建二进制历史索引: %s", self.index_path.name)
+            chunks = []
+            for number, (ts, *_rest) in enumerate(BINARY_RECORD.iter_unpack(mapped[: self.count * BINARY_RECORD.size])):
+                self.running_max = max(self.running_max, ts)
+                if number % BINARY_INDEX_STRIDE == 0:
+                    chunks.append(BINARY_INDEX_ENTRY.pack(self.running_max, number))
+            self.index_path.write_bytes(b"".join(chunks))
+
+    def append(self, rows: list[tuple]):
+        """追加多条记录；每 BINARY_INDEX_STRIDE 条写一个索引项（记录截至该条的最大时间戳）。"""
+
+        data_chunks = []
+        index_chunks = []
+        for row in rows:
+            self.running_max = max(self.running_max, row[0])
+            if self.count % BINARY_INDEX_STRIDE == 0:
+                index_chunks.append(BINARY_INDEX_ENTRY.pack(self.running_max, self.count))
+            data_chunks.append(BINARY_RECORD.pack(*row))
+            self.count += 1
+
+        # 先写数据再写索引，崩溃时最多丢失可重建的索引项
+        self.data.write(b"".join(data_chunks))
+        self.data.flush()
+        if index_chunks:
+            self.index.write(b"".join(index_chunks))
+            self.index.flush()
+
+    def fsync(self):
+        """同步数据与索引文件。"""
+
+        os.fsync(self.data.fileno())
+        os.fsync(self.index.fileno())
+
+    def close(self):
+        """关闭文件句柄。"""
+
+        with contextlib.suppress(Exception):
+            self.data.close()
+            self.index.close()
+
+
+class BinaryHistoryStore:
+    """定长二进制历史存储：按 设备/UTC 日期 分段，追加写入，支持内存映射的时间范围查询。
+
+    目录结构为 <root>/<设备>/<YYYYMMDD>.gpsb（记录）与同名 .gpsi（稀疏索引）。
+    索引每 BINARY_INDEX_STRIDE 条记录保存一次"截至该条的最大时间戳"，
+    查询时二分索引定位起始块，再对映射出的记录切片做一次向量化过滤，无需逐条解析。
+    """
+
+    def __init__(self, root: Path):
+        """root 为存储根目录，不存在时在首次写入时创建。"""
+
+        self.root = root
+        self._writers: Dict[str, _BinarySegmentWriter] = {}
+        self._lock = threading.Lock()
+        self._grid_cache: Dict[Path, tuple[int, list[frozenset]]] = {}
+        self.appended = 0
+        self.skipped = 0
+
+    @staticmethod
+    def device_dirname(device_id: Optional[str]) -> str:
+        """将设备 ID 转换为安全的目录名。"""
+
+        return re.sub(r"[^A-Za-z0-9_.-]", "_", device_id or "unknown") or "unknown"
+
+    def devices(self) -> list[str]:
+        """列出已有数据的设备目录名。"""
+
+        if not self.root.exists():
+            return []
+        return sorted(child.name for child in self.root.iterdir() if child.is_dir())
+
+    def append_records(self, records: list[Dict[str, Any]]):
+        """追加一批历史记录（append_history_file 生成的字典）。"""
+
+        grouped: Dict[tuple[str, str], list[tuple]] = {}
+        for record in records:
+            row = history_record_to_binary(record)
+            if row is None:
+                self.skipped += 1
+                continue
+            day = datetime.fromtimestamp(row[0], timezone.utc).strftime("%Y%m%d")
+            grouped.setdefault((self.device_dirname(record.get("deviceId")), day), []).append(row)
+
+        with self._lock:
+            for (device, day), rows in grouped.items():
+                writer = self._writers.get(device)
+                segment = self.root / device / f"{day}.gpsb"
+                if writer is None or writer.data_path != segment:
+                    if writer is not None:
+                        writer.close()
+                    writer = self._writers[device] = _BinarySegmentWriter(segment)
+                writer.append(rows)
+                self.appended += len(rows)
+
+    def fsync(self):
+        """同步所有打开的分段。"""
+
+        with self._lock:
+            for writer in self._writers.values():
+                with contextlib.suppress(OSError):
+                    writer.fsync()
+
+    def close(self):
+        """关闭所有分段写入器。"""
+
+        with self._lock:
+            for writer in self._writers.values():
+                writer.close()
+            self._writers.clear()
+
+    def segments(self, device_id: str, start: Optional[float] = None, end: Optional[float] = None) -> list[Path]:
+        """返回设备在时间范围内可能包含数据的分段（按日期排序）。"""
+
+        device_dir = self.root / self.device_dirname(device_id)
+        if not device_dir.exists():
+            return []
+
+        first = datetime.fromtimestamp(start, timezone.utc).strftime("%Y%m%d") if start is not None else ""
+        last = datetime.fromtimestamp(end, timezone.utc).strftime("%Y%m%d") if end is not None else "99999999"
+        return sorted(path for path in device_dir.glob("*.gpsb") if first <= path.stem <= last)
+
+    def scan(
+        self,
+        device_id: str,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+        bbox: Optional[tuple[float, float, float, float]] = None,
+    ):
+        """逐个分段生成时间范围 [start, end]（及可选经纬度范围）内的记录块。
+
+        bbox 为 (最小经度, 最小纬度, 最大经度, 最大纬度)，借助每个索引块的粗网格跳过不相交的块。
+        安装 NumPy 时每块为结构化数组（字段 ts/lat/lng/speed/course/flags），
+        否则为 (ts, lat, lng, speed, course, flags) 元组列表。
+        """
+
+        bbox_e7 = None
+        if bbox is not None:
+            bbox_e7 = tuple(int(round(value * BINARY_COORD_SCALE)) for value in bbox)
+
+        for path in self.segments(device_id, start, end):
+            size = path.stat().st_size - path.stat().st_size % BINARY_RECORD.size
+            if size <= 0:
+                continue
+            count = size // BINARY_RECORD.size
+            with path.open("rb") as file, mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ) as mapped:
+                first, last = self._bounds(path.with_suffix(".gpsi"), count, start)
+                if first >= last:
+                    continue
+                if bbox_e7 is None:
+                    ranges = [(first, last)]
+                else:
+                    ranges = self._grid_ranges(path, mapped, count, first, last, bbox_e7)
+                for low, high in ranges:
+                    result = self._filter_slice(mapped, low, high, start, end, bbox_e7)
+                    if len(result):
+                        yield result
+
+    @staticmethod
+    def _filter_slice(mapped, low: int, high: int, start: Optional[float], end: Optional[float], bbox_e7):
+        """对 [low, high) 记录切片做一次时间与范围过滤。"""
+
+        view = memoryview(mapped)[low * BINARY_RECORD.size : high * BINARY_RECORD.size]
+        try:
+            if np is not None:
+                chunk = np.frombuffer(view, dtype=BINARY_DTYPE)
+                mask = np.ones(len(chunk), dtype=bool)
+                if start is not None:
+                    mask &= chunk["ts"] >= start
+                if end is not None:
+                    mask &= chunk["ts"] <= end
+                if bbox_e7 is not None:
+                    min_lng, min_lat, max_lng, max_lat = bbox_e7
+                    lat = chunk["lat"]
+                    lng = chunk["lng"]
+                    mask &= (lat >= min_lat) & (lat <= max_lat) & (lng >= min_lng) & (lng <= max_lng)
+                    del lat, lng
+                result = chunk[mask]  # 布尔索引会复制，之后可安全关闭映射
+                del chunk
+                return result
+
+            rows = []
+            for row in BINARY_RECORD.iter_unpack(view):
+                if (start is not None and row[0] < start) or (end is not None and row[0] > end):
+                    continue
+                if bbox_e7 is not None and not (
+                    bbox_e7[1] <= row[1] <= bbox_e7[3] and bbox_e7[0] <= row[2] <= bbox_e7[2]
+                ):
+                    continue
+                rows.append(row[:6])
+            return rows
+        finally:
+            view.release()
+
+    def _grid_ranges(self, path: Path, mapped, count: int, first: int, last: int, bbox_e7) -> list[tuple[int, int]]:
+        """根据每块的粗网格占用情况，返回与 bbox 相交的记录区间（相邻块合并）。"""
+
+        min_lng, min_lat, max_lng, max_lat = bbox_e7
+        lat_cells = range(min_lat // BINARY_GRID_CELL, max_lat // BINARY_GRID_CELL + 1)
+        lng_cells = range(min_lng // BINARY_GRID_CELL, max_lng // BINARY_GRID_CELL + 1)
+
+        block_cells = self._block_cells(path, mapped, count)
+        ranges: list[tuple[int, int]] = []
+        for block in range(first // BINARY_INDEX_STRIDE, (last - 1) // BINARY_INDEX_STRIDE + 1):
+            if not any(lat_cell in lat_cells and lng_cell in lng_cells for lat_cell, lng_cell in block_cells[block]):
+                continue
+            low = max(first, block * BINARY_INDEX_STRIDE)
+            high = min(last, (block + 1) * BINARY_INDEX_STRIDE)
+            if ranges and ranges[-1][1] == low:
+                ranges[-1] = (ranges[-1][0], high)
+            else:
+                ranges.append((low, high))
+        return ranges
+
+    def _block_cells(self, path: Path, mapped, count: int) -> list[frozenset]:
+        """返回每个索引块占用的网格单元集合，按分段缓存，新增记录时只补算尾部块。"""
+
+        cached_count, cells = self._grid_cache.get(path, (0, []))
+        if cached_count == count:
+            return cells
+
+        cells = list(cells[: cached_count // BINARY_INDEX_STRIDE])
+        for block in range(len(cells), (count + BINARY_INDEX_STRIDE - 1) // BINARY_INDEX_STRIDE):
+            low = block * BINARY_INDEX_STRIDE
+            high = min(count, low + BINARY_INDEX_STRIDE)
+            view = memoryview(mapped)[low * BINARY_RECORD.size : high * BINARY_RECORD.size]
+            try:
+                if np is not None:
+                    chunk = np.frombuffer(view, dtype=BINARY_DTYPE)
+                    pairs = zip((chunk["lat"] // BINARY_GRID_CELL).tolist(), (chunk["lng"] // BINARY_GRID_CELL).tolist())
+                    cells.append(frozenset(pairs))
+                    del chunk
+                else:
+                    cells.append(
+                        frozenset(
+                            (row[1] // BINARY_GRID_CELL, row[2] // BINARY_GRID_CELL)
+                            for row in BINARY_RECORD.iter_unpack(view)
+                        )
+                    )
+            finally:
+                view.release()
+
+        self._grid_cache[path] = (count, cells)
+        return cells
+
+    def query(self, device_id: str, start: Optional[float] = None, end: Optional[float] = None):
+        """返回时间范围内全部记录：NumPy 结构化数组或元组列表。"""
+
+        chunks = list(self.scan(device_id, start, end))
+        if np is not None:
+            return np.concatenate(chunks) if chunks else np.empty(0, dtype=BINARY_DTYPE)
+        return [row for chunk in chunks for row in chunk]
+
+    @staticmethod
+    def _bounds(index_path: Path, count: int, start: Optional[float]) -> tuple[int, int]:
+        """二分稀疏索引，返回需要读取的记录区间 [first, last)。
+
+        索引为前缀最大值，只能确定起点：晚写入的旧记录（回填、重放、时钟回拨）可能位于任意位置，
+        终点始终为 count，超出 end 的记录由 _filter_slice 过滤。
+        """
+
+        if not index_path.exists():
+            return 0, count
+
+        entries = array("d")
+        numbers = array("Q")
+        for running_max, number in BINARY_INDEX_ENTRY.iter_unpack(index_path.read_bytes()):
+            if number >= count:
+                break
+            entries.append(running_max)
+            numbers.append(number)
+        if not entries:
+            return 0, count
+
+        first = 0
+        if start is not None:
+            # 截至块首的最大时间戳 < start 时，之前的块不可能有命中记录（前一块整体跳过）
+            position = bisect.bisect_left(entries, start)
+            first = numbers[position - 1] if position > 0 else 0
+        return first, count
+
+
+def convert_history_to_binary(history_file: Path, store: BinaryHistoryStore) -> int:
+    """把 history.jsonl（含已滚动与压缩的分段）转换写入二进制存储，返回写入条数。"""
+
+    before = store.appended
+    batch: list[Dict[str, Any]] = []
+    for path in history_paths(history_file):
+        with open_history_text(path) as file:
+            for line in file:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    batch.append(json.loads(line))
+                except json.JSONDecodeError:
+                    store.skipped += 1
+                    continue
+                if len(batch) >= 5000:
+                    store.append_records(batch)
+                    batch.clear()
+    if batch:
+        store.append_records(batch)
+    store.close()
+    return store.appended - before
+
+
+# 紧凑二进制批量消息（小端）：
+#   头部  "GF" | 版本 u8 | 保留 u8 | 条数 u16 | 设备 ID 长度 u8 + UTF-8 | 基准时间 i64 毫秒 | 基准纬度 i32 | 基准经度 i32
+#   每条  Δ时间(ms) Δ纬度 Δ经度（1e-7 度，均为 zigzag varint，相对上一条）| 速度 cm/s varint | 航向 0.01° varint
+#         | 附加掩码 u8，随后按位附加：卫星数 u8、HDOP×100 varint、高度(dm) zigzag varint、定位质量 u8、消息类型 u8
+COMPACT_MAGIC = b"GF"
+COMPACT_VERSION = 1
+COMPACT_HEADER = struct.Struct("<2sBBH")
+COMPACT_BASE = struct.Struct("<qii")
+COMPACT_HAS_SATELLITES = 0x01
+COMPACT_HAS_HDOP = 0x02
+COMPACT_HAS_ALTITUDE = 0x04
+COMPACT_HAS_QUALITY = 0x08
+COMPACT_FENCE_KNOWN = 0x10
+COMPACT_INSIDE_FENCE = 0x20
+COMPACT_HAS_TYPE = 0x40
+
+
+def _write_varint(buffer: bytearray, value: int):
+    """写入无符号 LEB128 变长整数。"""
+
+    while value >= 0x80:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _read_varint(data: bytes, offset: int) -> tuple[int, int]:
+    """读取无符号 LEB128 变长整数，返回 (值, 新偏移)。"""
+
+    result = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, offset
+        shift += 7
+
+
+def _zigzag(value: int) -> int:
+    """有符号整数转 zigzag 编码。"""
+
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def _unzigzag(value: int) -> int:
+    """zigzag 编码还原为有符号整数。"""
+
+    return value // 2 if not value & 1 else -(value + 1) // 2
+
+
+def _fix_epoch_ms(fix: Dict[str, Any]) -> int:
+    """定位的时间戳（毫秒），无法解析时使用当前时间。"""
+
+    epoch = history_timestamp_to_epoch(fix.get("timestamp"))
+    return int(round((epoch if epoch is not None else time.time()) * 1000))
+
+
+def encode_compact_batch(fixes: list[Dict[str, Any]], device_id: str) -> bytes:
+    """将一批定位编码为紧凑二进制消息（坐标缩放为整数并相对上一条做差分）。"""
+
+    device = (device_id or "").encode("utf-8")[:255]
+    rows = []
+    for fix in fixes:
+        if fix.get("latitude") is None or fix.get("longitude") is None:
+            continue
+        rows.append(
+            (
+                _fix_epoch_ms(fix),
+                int(round(float(fix["latitude"]) * BINARY_COORD_SCALE)),
+                int(round(float(fix["longitude"]) * BINARY_COORD_SCALE)),
+                fix,
+            )
+        )
+
+    buffer = bytearray(COMPACT_HEADER.pack(COMPACT_MAGIC, COMPACT_VERSION, 0, len(rows)))
+    buffer.append(len(device))
+    buffer += device
+    if not rows:
+        return bytes(buffer)
+
+    previous_ts, previous_lat, previous_lng, _ = rows[0]
+    buffer += COMPACT_BASE.pack(previous_ts, previous_lat, previous_lng)
+    for ts, lat, lng, fix in rows:
+        _write_varint(buffer, _zigzag(ts - previous_ts))
+        _write_varint(buffer, _zigzag(lat - previous_lat))
+        _write_varint(buffer, _zigzag(lng - previous_lng))
+        previous_ts, previous_lat, previous_lng = ts, lat, lng
+
+        _write_varint(buffer, max(0, int(round(float(fix.get("speed_ms") or 0.0) * 100))))
+        _write_varint(buffer, int(round(float(fix.get("course") or 0.0) * 100)) % 36000)
+
+        mask = 0
+        extras = bytearray()
+        if fix.get("num_satellites") is not None:
+            mask |= COMPACT_HAS_SATELLITES
+            extras.append(min(255, int(fix["num_satellites"])))
+        if fix.get("hdop") is not None:
+            mask |= COMPACT_HAS_HDOP
+            _write_varint(extras, max(0, int(round(float(fix["hdop"]) * 100))))
+        if fix.get("altitude") is not None:
+            mask |= COMPACT_HAS_ALTITUDE
+            _write_varint(extras, _zigzag(int(round(float(fix["altitude"]) * 10))))
+        if fix.get("quality") is not None:
+            mask |= COMPACT_HAS_QUALITY
+            extras.append(min(255, int(fix["quality"])))
+        if fix.get("isInsideFence") is not None:
+            mask |= COMPACT_FENCE_KNOWN | (COMPACT_INSIDE_FENCE if fix["isInsideFence"] else 0)
+        message_code = BINARY_MESSAGE_TYPES.get(str(fix.get("message_type", "")))
+        if message_code:
+            mask |= COMPACT_HAS_TYPE
+            extras.append(message_code)
+        buffer.append(mask)
+        buffer += extras
+
+    return bytes(buffer)
+
+
+def decode_compact_batch(payload: bytes) -> Dict[str, Any]:
+    """参考解码器：还原 encode_compact_batch 生成的消息（html/js/gpsPayloadDecoder.js 为对应的前端实现）。"""
+
+    magic, version, _reserved, count = COMPACT_HEADER.unpack_from(payload, 0)
+    if magic != COMPACT_MAGIC:
+        raise ValueError("不是紧凑定位消息")
+    if version != COMPACT_VERSION:
+        raise ValueError(f"不支持的紧凑消息版本: {version}")
+
+    offset = COMPACT_HEADER.size
+    device_length = payload[offset]
+    offset += 1
+    device_id = payload[offset : offset + device_length].decode("utf-8")
+    offset += device_length
+
+    fixes: list[Dict[str, Any]] = []
+    if count:
+        ts, lat, lng = COMPACT_BASE.unpack_from(payload, offset)
+        offset += COMPACT_BASE.size
+
+    for _ in range(count):
+        delta, offset = _read_varint(payload, offset)
+        ts += _unzigzag(delta)
+        delta, offset = _read_varint(payload, offset)
+        lat += _unzigzag(delta)
+        delta, offset = _read_varint(payload, offset)
+        lng += _unzigzag(delta)
+        speed, offset = _read_varint(payload, offset)
+        course, offset = _read_varint(payload, offset)
+        mask = payload[offset]
+        offset += 1
+
+        fix: Dict[str, Any] = {
+            "device_id": device_id,
+            "time": ts,
+            "latitude": lat / BINARY_COORD_SCALE,
+            "longitude": lng / BINARY_COORD_SCALE,
+            "speed_ms": speed / 100,
+            "course": course / 100,
+        }
+        if mask & COMPACT_HAS_SATELLITES:
+            fix["num_satellites"] = payload[offset]
+            offset += 1
+        if mask & COMPACT_HAS_HDOP:
+            value, offset = _read_varint(payload, offset)
+            fix["hdop"] = value / 100
+        if mask & COMPACT_HAS_ALTITUDE:
+            value, offset = _read_varint(payload, offset)
+            fix["altitude"] = _unzigzag(value) / 10
+        if mask & COMPACT_HAS_QUALITY:
+            fix["quality"] = payload[offset]
+            offset += 1
+        if mask & COMPACT_FENCE_KNOWN:
+            fix["isInsideFence"] = bool(mask & COMPACT_INSIDE_FENCE)
+        if mask & COMPACT_HAS_TYPE:
+            fix["message_type"] = BINARY_MESSAGE_NAMES.get(payload[offset])
+            offset += 1
+        fixes.append(fix)
+
+    return {"version": version, "device_id": device_id, "fixes": fixes}
+
+
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEGREE = EARTH_RADIUS_M * math.pi / 180  # 每度纬度对应的米数
+
+
+def haversine_m(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """两点间的大圆距离（米）。"""
+
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lng2 - lng1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def haversine_m_array(lat1, lng1, lat2, lng2):
+    """haversine_m 的 NumPy 向量化版本，逐元素返回距离数组（需要 NumPy）。"""
+
+    phi1 = np.radians(lat1)
+    phi2 = np.radians(lat2)
+    a = np.sin((phi2 - phi1) / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(np.radians(lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def _has_position(fix: Dict[str, Any]) -> bool:
+    """定位是否带有经纬度。"""
+
+    return fix.get("latitude") is not None and fix.get("longitude") is not None
+
+
+class FixFilter:
+    """发布前过滤器基类：process 返回应发布的定位（可为空，也可补发之前暂存的定位）。"""
+
+    name = "filter"
+
+    def __init__(self):
+        """初始化计数。"""
+
+        self.received = 0
+        self.forwarded = 0
+
+    def process(self, fix: Dict[str, Any], now: float) -> list[Dict[str, Any]]:
+        """处理一条定位。"""
+
+        raise NotImplementedError
+
+    def flush(self) -> list[Dict[str, Any]]:
+        """退出前发出暂存的定位。"""
+
+        return []
+
+    def pending(self) -> int:
+        """暂存未决的定位数量。"""
+
+        return 0
+
+    def stats(self) -> Dict[str, int]:
+        """返回该过滤器的计数。"""
+
+        return {
+            "received": self.received,
+            "forwarded": self.forwarded,
+            "suppressed": self.received - self.forwarded - self.pending(),
+        }
+
+
+class DeadbandFilter(FixFilter):
+    """距离/航向死区：位移小于阈值且航向变化不大时抑制，静默超时后强制发布。"""
+
+    name = "deadband"
+
+    def __init__(
+        self,
+        distance_m: float = DEADBAND_DISTANCE_M,
+        heading_deg: float = DEADBAND_HEADING_DEG,
+        max_silence_s: float = FILTER_MAX_SILENCE_S,
+        min_speed_ms: float = 0.5,
+    ):
+        """min_speed_ms 以下视为静止，此时航向不可靠，不参与判断。"""
+
+        super().__init__()
+        self.distance_m = distance_m
+        self.heading_deg = heading_deg
+        self.max_silence_s = max_silence_s
+        self.min_speed_ms = min_speed_ms
+        self._last: Optional[Dict[str, Any]] = None
+        self._last_time = 0.0
+
+    def process(self, fix: Dict[str, Any], now: float) -> list[Dict[str, Any]]:
+        """判断是否超出死区。"""
+
+        self.received += 1
+        if not _has_position(fix) or self._should_forward(fix, now):
+            self._last = fix if _has_position(fix) else self._last
+            self._last_time = now
+            self.forwarded += 1
+            return [fix]
+        return []
+
+    def _should_forward(self, fix: Dict[str, Any], now: float) -> bool:
+        """距离、航向或静默时间任一超出阈值即发布。"""
+
+        last = self._last
+        if last is None or now - self._last_time >= self.max_silence_s:
+            return True
+        if haversine_m(last["latitude"], last["longitude"], fix["latitude"], fix["longitude"]) >= self.distance_m:
+            return True
+
+        course, last_course = fix.get("course"), last.get("course")
+        if course is None or last_course is None or (fix.get("speed_ms") or 0.0) < self.min_speed_ms:
+            return False
+        change = abs((float(course) - float(last_course) + 180.0) % 360.0 - 180.0)
+        return change >= self.heading_deg
+
+
+class OpeningWindowSimplifier(FixFilter):
+    """流式轨迹简化（开窗法）：锚点到最新点的线段与窗口内所有点的距离都不超过容差时继续延长，
+    否则发布窗口内最后一个点作为新锚点。发布的折线与原轨迹偏差不超过 tolerance_m。
+    """
+
+    name = "simplify"
+
+    def __init__(
+        self,
+        tolerance_m: float = SIMPLIFY_TOLERANCE_M,
+        max_silence_s: float = FILTER_MAX_SILENCE_S,
+        max_window: int = 200,
+    ):
+        """max_window 限制窗口长度，保证单点处理代价有上限。"""
+
+        super().__init__()
+        self.tolerance_m = tolerance_m
+        self.max_silence_s = max_silence_s
+        self.max_window = max_window
+        self._anchor: Optional[Dict[str, Any]] = None
+        self._window: list[Dict[str, Any]] = []
+        self._last_time = 0.0
+
+    def process(self, fix: Dict[str, Any], now: float) -> list[Dict[str, Any]]:
+        """加入一点，窗口被打破或静默超时时返回需要发布的点。"""
+
+        self.received += 1
+        if not _has_position(fix):
+            self.forwarded += 1
+            return [fix]
+
+        if self._anchor is None:
+            return self._emit(fix, now)
+
+        emitted: list[Dict[str, Any]] = []
+        if self._window and not self._fits(fix):
+            emitted = self._emit(self._window[-1], now)
+        self._window.append(fix)
+
+        if now - self._last_time >= self.max_silence_s or len(self._window) >= self.max_window:
+            emitted += self._emit(self._window[-1], now)
+        return emitted
+
+    def flush(self) -> list[Dict[str, Any]]:
+        """发出窗口中最后一个点，使轨迹终点完整。"""
+
+        if not self._window:
+            return []
+        return self._emit(self._window[-1], self._last_time)
+
+    def pending(self) -> int:
+        """窗口中尚未决定的点数。"""
+
+        return len(self._window)
+
+    def _emit(self, fix: Dict[str, Any], now: float) -> list[Dict[str, Any]]:
+        """发布一点并以其为新锚点重新开窗。"""
+
+        # 被跳过的窗口内点已由新线段在容差内代表
+        self._window = []
+        self._anchor = fix
+        self._last_time = now
+        self.forwarded += 1
+        return [fix]
+
+    def _fits(self, candidate: Dict[str, Any]) -> bool:
+        """锚点到候选点的线段是否在容差内覆盖窗口中的全部点。"""
+
+        anchor = self._anchor
+        lat0 = math.radians(anchor["latitude"])
+        scale_x = math.cos(lat0) * EARTH_RADIUS_M * math.pi / 180.0
+        scale_y = EARTH_RADIUS_M * math.pi / 180.0
+
+        # 以锚点为原点的局部平面坐标（米）
+        bx = (candidate["longitude"] - anchor["longitude"]) * scale_x
+        by = (candidate["latitude"] - anchor["latitude"]) * scale_y
+        length_sq = bx * bx + by * by
+        for point in self._window:
+            px = (point["longitude"] - anchor["longitude"]) * scale_x
+            py = (point["latitude"] - anchor["latitude"]) * scale_y
+            if length_sq == 0.0:
+                distance = math.hypot(px, py)
+            else:
+                t = max(0.0, min(1.0, (px * bx + py * by) / length_sq))
+                distance = math.hypot(px - t * bx, py - t * by)
+            if distance > self.tolerance_m:
+                return False
+        return True
+
+
+# 过滤器注册表：名称 -> 根据配置构造过滤器的函数，新增过滤器在此注册即可用于 --filters
+FIX_FILTERS: Dict[str, Callable[["PublisherConfig"], FixFilter]] = {
+    "deadband": lambda config: DeadbandFilter(
+        config.deadband_distance_m,
+        config.deadband_heading_deg,
+        config.filter_max_silence_s,
+    ),
+    "simplify": lambda config: OpeningWindowSimplifier(
+        config.simplify_tolerance_m,
+        config.filter_max_silence_s,
+    ),
+}
+
+
+class FixFilterChain:
+    """按顺序串联多个发布前过滤器。"""
+
+    def __init__(self, filters: list[FixFilter]):
+        """filters 为空时原样放行。"""
+
+        self.filters = filters
+
+    @classmethod
+    def from_config(cls, config: "PublisherConfig") -> "FixFilterChain":
+        """根据配置中的过滤器名称构造过滤链。"""
+
+        filters = []
+        for name in (part.strip() for part in config.publish_filters.split(",")):
+            if not name:
+                continue
+            if name not in FIX_FILTERS:
+                raise ValueError(f"未知的发布过滤器: {name}（可选: {', '.join(FIX_FILTERS)}）")
+            filters.append(FIX_FILTERS[name](config))
+        return cls(filters)
+
+    def process(self, fix: Dict[str, Any], now: Optional[float] = None) -> list[Dict[str, Any]]:
+        """让定位依次通过各过滤器，返回最终应发布的定位。"""
+
+        now = time.monotonic() if now is None else now
+        fixes = [fix]
+        for fix_filter in self.filters:
+            fixes = [out for item in fixes for out in fix_filter.process(item, now)]
+        return fixes
+
+    def flush(self) -> list[Dict[str, Any]]:
+        """逐级发出各过滤器暂存的定位。"""
+
+        now = time.monotonic()
+        fixes: list[Dict[str, Any]] = []
+        for fix_filter in self.filters:
+            fixes = [out for item in fixes for out in fix_filter.process(item, now)]
+            fixes += fix_filter.flush()
+        return fixes
+
+    def stats(self) -> Dict[str, Any]:
+        """返回整体与各过滤器的放行/抑制计数。"""
+
+        per_filter = {fix_filter.name: fix_filter.stats() for fix_filter in self.filters}
+        received = self.filters[0].received if self.filters else 0
+        forwarded = self.filters[-1].forwarded if self.filters else 0
+        pending = sum(fix_filter.pending() for fix_filter in self.filters)
+        return {
+            "forwarded": forwarded,
+            "suppressed": received - forwarded - pending,
+            "filters": per_filter,
+        }
+
+
+class PublishBatcher:
+    """发布批处理：累计定位到指定条数或时间窗口后整体发出。"""
+
+    def __init__(self, batch_size: int = MQTT_BATCH_SIZE, interval_ms: int = MQTT_BATCH_INTERVAL_MS):
+        """batch_size 为 1 时每条立即发出（仅用于紧凑编码）。"""
+
+        self.batch_size = max(1, batch_size)
+        self.interval = max(0, interval_ms) / 1000.0
+        self._pending: list[Dict[str, Any]] = []
+        self._deadline = 0.0
+        self.batches = 0
+        self.fixes = 0
+
+    def add(self, fix: Dict[str, Any], now: Optional[float] = None) -> Optional[list[Dict[str, Any]]]:
+        """加入一条定位，凑满一批时返回该批。"""
+
+        now = time.monotonic() if now is None else now
+        if not self._pending:
+            self._deadline = now + self.interval
+        self._pending.append(fix)
+        if len(self._pending) >= self.batch_size:
+            return self.flush()
+        return None
+
+    def poll(self, now: Optional[float] = None) -> Optional[list[Dict[str, Any]]]:
+        """时间窗口到期时返回未满的批次。"""
+
+        now = time.monotonic() if now is None else now
+        if self._pending and now >= self._deadline:
+            return self.flush()
+        return None
+
+    def time_to_deadline(self, now: Optional[float] = None) -> Optional[float]:
+        """距离当前批次到期的秒数，无待发数据时返回 None。"""
+
+        if not self._pending:
+            return None
+        now = time.monotonic() if now is None else now
+        return max(0.0, self._deadline - now)
+
+    def flush(self) -> Optional[list[Dict[str, Any]]]:
+        """立即取出当前批次。"""
+
+        if not self._pending:
+            return None
+        batch = self._pending
+        self._pending = []
+        self.batches += 1
+        self.fixes += len(batch)
+        return batch
+
+    def stats(self) -> Dict[str, Any]:
+        """返回批处理计数，用于状态上报。"""
+
+        return {
+            "batches": self.batches,
+            "fixes": self.fixes,
+            "pending": len(self._pending),
+        }
+
+
+GEOFENCE_GRID_DEG = 0.01  # 围栏网格索引的单元边长（度，约 1 km）
+GEOFENCE_MAX_CELLS = 4096  # 覆盖单元数超过该值的大围栏不进网格，每条定位直接检查
+
+
+@dataclass(frozen=True)
+class Geofence:
+    """一个围栏：多边形（可含洞、可为多部分）或圆（中心与半径）。
+
+    margin_m 为进出判定的滞回距离，bbox 为按 margin_m 外扩后的外接矩形 (最小经度, 最小纬度, 最大经度, 最大纬度)。
+    """
+
+    fence_id: str
+    name: str
+    polygons: tuple = ()  # ((外环, 洞, ...), ...)，每个环为 ((经度, 纬度), ...)，不重复首点
+    center: Optional[tuple[float, float]] = None
+    radius_m: float = 0.0
+    margin_m: float = 0.0
+    bbox: tuple[float, float, float, float] = (0.0, 0.0, 0.0, 0.0)
+    devices: Optional[frozenset] = None
+
+    def applies_to(self, device_id: str) -> bool:
+        """围栏是否作用于该设备（未限定设备时作用于全部设备）。"""
+
+        return self.devices is None or device_id in self.devices
+
+    def signed_distance_m(self, lng: float, lat: float) -> float:
+        """点到围栏边界的距离（米），在围栏内为正、围栏外为负。
+
+        多边形在以该点为原点的局部平面中计算：射线法判断内外（奇偶规则，洞与多部分自然成立），
+        同时求到各边的最短距离。
+        """
+
+        if self.center is not None:
+            return self.radius_m - haversine_m(lat, lng, self.center[1], self.center[0])
+
+        kx = math.cos(math.radians(lat)) * METERS_PER_DEGREE
+        ky = METERS_PER_DEGREE
+        inside = False
+        nearest = math.inf
+        for rings in self.polygons:
+            for ring in rings:
+                px, py = (ring[-1][0] - lng) * kx, (ring[-1][1] - lat) * ky
+                for vertex_lng, vertex_lat in ring:
+                    x, y = (vertex_lng - lng) * kx, (vertex_lat - lat) * ky
+                    dx, dy = x - px, y - py
+                    if (py > 0) != (y > 0) and px - py * dx / dy > 0:
+                        inside = not inside
+                    length = dx * dx + dy * dy
+                    t = min(1.0, max(0.0, -(px * dx + py * dy) / length)) if length else 0.0
+                    cx, cy = px + t * dx, py + t * dy
+                    nearest = min(nearest, cx * cx + cy * cy)
+                    px, py = x, y
+        distance = math.sqrt(nearest)
+        return distance if inside else -distance
+
+
+def _fence_ring(coordinates: Any, fence_id: str) -> tuple:
+    """把 GeoJSON 线性环转换为 ((经度, 纬度), ...)，去掉重复的闭合点。"""
+
+    ring = tuple((float(point[0]), float(point[1])) for point in coordinates)
+    if len(ring) > 1 and ring[0] == ring[-1]:
+        ring = ring[:-1]
+    if len(ring) < 3:
+        raise ValueError(f"围栏 {fence_id} 的多边形环少于 3 个顶点")
+    return ring
+
+
+def _ring_area_m2(ring: tuple) -> float:
+    """环的近似面积（平方米，局部等距投影下的鞋带公式）。"""
+
+    kx = math.cos(math.radians(ring[0][1])) * METERS_PER_DEGREE
+    ky = METERS_PER_DEGREE
+    twice = 0.0
+    for (lng1, lat1), (lng2, lat2) in zip(ring, ring[1:] + ring[:1]):
+        twice += lng1 * kx * lat2 * ky - lng2 * kx * lat1 * ky
+    return abs(twice) / 2
+
+
+def parse_geofence(feature: Dict[str, Any], ordinal: int, hysteresis_m: float) -> Geofence:
+    """解析一个 GeoJSON Feature：Polygon/MultiPolygon 为多边形围栏，Point 加 properties.radius_m 为圆形围栏。
+
+    properties 中可选 id、name、devices（设备 ID 或列表，限定作用的设备）与 hysteresis_m（覆盖全局滞回距离）；
+    未指定滞回距离时，小围栏的滞回距离不超过其尺度的四分之一（圆为半径的一半），保证仍能进入。
+    """
+
+    if not isinstance(feature, dict) or feature.get("type") != "Feature":
+        raise ValueError(f"第 {ordinal} 个围栏不是 GeoJSON Feature")
+    properties = feature.get("properties") or {}
+    geometry = feature.get("geometry") or {}
+    fence_id = str(properties.get("id") or feature.get("id") or f"fence-{ordinal}")
+    name = str(properties.get("name") or fence_id)
+    devices = properties.get("devices", properties.get("device_id"))
+    if isinstance(devices, str):
+        devices = [devices]
+    coordinates = geometry.get("coordinates")
+    geometry_type = geometry.get("type")
+
+    try:
+        if geometry_type == "Point":
+            radius_m = float(properties.get("radius_m", properties.get("radius", 0)))
+            if radius_m <= 0:
+                raise ValueError(f"圆形围栏 {fence_id} 需要正的 properties.radius_m")
+            center = (float(coordinates[0]), float(coordinates[1]))
+            polygons: tuple = ()
+            scale_margin = radius_m / 2
+        elif geometry_type in {"Polygon", "MultiPolygon"}:
+            parts = coordinates if geometry_type == "MultiPolygon" else [coordinates]
+            polygons = tuple(tuple(_fence_ring(ring, fence_id) for ring in part) for part in parts if part)
+            if not polygons:
+                raise ValueError(f"围栏 {fence_id} 没有坐标")
+            center, radius_m = None, 0.0
+            area = sum(_ring_area_m2(rings[0]) - sum(_ring_area_m2(hole) for hole in rings[1:]) for rings in polygons)
+            scale_margin = math.sqrt(max(area, 0.0)) / 4
+            lngs = [lng for rings in polygons for lng, _ in rings[0]]
+            lats = [lat for rings in polygons for _, lat in rings[0]]
+        else:
+            raise ValueError(f"围栏 {fence_id} 的几何类型不受支持: {geometry_type}（可选: Polygon, MultiPolygon, Point）")
+        if "hysteresis_m" in properties:
+            margin_m = float(properties["hysteresis_m"])
+        else:
+            margin_m = min(hysteresis_m, scale_margin)
+    except (TypeError, IndexError, KeyError) as exc:
+        raise ValueError(f"围栏 {fence_id} 的坐标格式错误: {exc}") from exc
+
+    # 外接矩形按滞回距离（圆再加半径）外扩：矩形之外的点必然在围栏外且超出滞回带
+    extent_m = max(margin_m, 0.0) + radius_m
+    if center is not None:
+        lngs, lats = (center[0],), (center[1],)
+    max_lat = min(89.0, max(abs(min(lats)), abs(max(lats))) + extent_m / METERS_PER_DEGREE)
+    d_lat = extent_m / METERS_PER_DEGREE
+    d_lng = d_lat / math.cos(math.radians(max_lat))
+    return Geofence(
+        fence_id=fence_id,
+        name=name,
+        polygons=polygons,
+        center=center,
+        radius_m=radius_m,
+        margin_m=max(margin_m, 0.0),
+        bbox=(min(lngs) - d_lng, min(lats) - d_lat, max(lngs) + d_lng, max(lats) + d_lat),
+        devices=frozenset(str(device) for device in devices) if devices else None,
+    )
+
+
+class GeofenceIndex:
+    """不可变的围栏集合与均匀网格索引。
+
+    每个网格单元记录外接矩形与之相交的围栏，一条定位只检查所在单元的候选围栏，
+    判定代价取决于附近的围栏数而不是围栏总数；覆盖范围过大的围栏单独列出，每次都检查。
+    重新加载时构造新对象整体替换，不修改已有对象。
+    """
+
+    def __init__(self, fences: Iterable[Geofence], cell_deg: float = GEOFENCE_GRID_DEG, source: str = ""):
+        """fences 的 fence_id 不能重复。"""
+
+        self.fences: Dict[str, Geofence] = {}
+        for fence in fences:
+            if fence.fence_id in self.fences:
+                raise ValueError(f"围栏 ID 重复: {fence.fence_id}")
+            self.fences[fence.fence_id] = fence
+        self.cell_deg = cell_deg
+        self.source = source
+        self.loaded_at = datetime.utcnow().isoformat(timespec="seconds")
+        self._grid: Dict[tuple[int, int], list[Geofence]] = {}
+        self._large: list[Geofence] = []
+        for fence in self.fences.values():
+            min_lng, min_lat, max_lng, max_lat = fence.bbox
+            x0, y0 = math.floor(min_lng / cell_deg), math.floor(min_lat / cell_deg)
+            x1, y1 = math.floor(max_lng / cell_deg), math.floor(max_lat / cell_deg)
+            if (x1 - x0 + 1) * (y1 - y0 + 1) > GEOFENCE_MAX_CELLS:
+                self._large.append(fence)
+                continue
+            for x in range(x0, x1 + 1):
+                for y in range(y0, y1 + 1):
+                    self._grid.setdefault((x, y), []).append(fence)
+
+    @classmethod
+    def from_geojson(cls, data: Any, hysteresis_m: float, source: str = "") -> "GeofenceIndex":
+        """从 GeoJSON（FeatureCollection、单个 Feature 或 Feature 列表）构造索引，格式错误时抛出 ValueError。"""
+
+        if isinstance(data, dict) and data.get("type") == "FeatureCollection":
+            features = data.get("features") or []
+        elif isinstance(data, dict):
+            features = [data]
+        elif isinstance(data, list):
+            features = data
+        else:
+            raise ValueError("围栏应为 GeoJSON FeatureCollection、Feature 或 Feature 列表")
+        return cls(
+            (parse_geofence(feature, ordinal, hysteresis_m) for ordinal, feature in enumerate(features, 1)),
+            source=source,
+        )
+
+    def candidates(self, lng: float, lat: float) -> Iterator[Geofence]:
+        """外扩外接矩形包含该点的围栏（其余围栏必然在滞回带之外）。"""
+
+        cell = self._grid.get((math.floor(lng / self.cell_deg), math.floor(lat / self.cell_deg)), ())
+        for fence in itertools.chain(cell, self._large):
+            min_lng, min_lat, max_lng, max_lat = fence.bbox
+            if min_lng <= lng <= max_lng and min_lat <= lat <= max_lat:
+                yield fence
+
+    def stats(self) -> Dict[str, Any]:
+        """返回围栏数量、索引规模与来源。"""
+
+        return {
+            "fences": len(self.fences),
+            "grid_cells": len(self._grid),
+            "large_fences": len(self._large),
+            "source": self.source,
+            "loaded_at": self.loaded_at,
+        }
+
+
+def load_geofences(path: Optional[Path], hysteresis_m: float) -> Optional[GeofenceIndex]:
+    """读取 GeoJSON 围栏文件，文件不存在时返回 None，内容无效时抛出 ValueError。"""
+
+    if not path:
+        return None
+    try:
+        data = json.loads(Path(path).read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as exc:
+        raise ValueError(f"围栏文件无法读取: {exc}") from exc
+    index = GeofenceIndex.from_geojson(data, hysteresis_m, source=str(path))
+    logging.info("已加载 %d 个围栏: %s", len(index.fences), path)
+    return index
+
+
+def save_geofences(path: Path, data: Any):
+    """原子写入围栏文件（先写临时文件再替换），供下次启动使用。"""
+
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(data, ensure_ascii=False) + "\n", encoding="utf-8")
+    os.replace(tmp, path)
+
+
+class GeofenceTracker:
+    """单台设备的围栏状态：按滞回带判定进入与离开并生成事件。
+
+    进入要求在围栏内且距边界超过 margin_m 米，离开要求在围栏外超过 margin_m 米，
+    在边界附近来回跳动的定位不会反复触发事件；处理线程判定、命令线程替换围栏集合，二者由锁互斥。
+    """
+
+    def __init__(self, device_id: str, index: Optional[GeofenceIndex] = None):
+        """index 为 None 表示未加载围栏，此时不判定也不设置 isInsideFence。"""
+
+        self.device_id = device_id
+        self.index = index
+        self._inside: set[str] = set()
+        self._lock = threading.Lock()
+        self.evaluated = 0
+        self.events = {"enter": 0, "exit": 0}
+
+    def set_index(self, index: Optional[GeofenceIndex]):
+        """替换围栏集合：仍存在的围栏保留进入状态，已删除的围栏直接忘记（不产生离开事件）。"""
+
+        with self._lock:
+            self.index = index
+            self._inside &= set(index.fences) if index else set()
+
+    def evaluate(self, fix: Dict[str, Any]) -> tuple[Optional[bool], list[Dict[str, Any]]]:
+        """判定一条定位，返回 (是否在任一围栏内, 本次产生的进出事件)；未加载围栏或定位无坐标时返回 (None, [])。"""
+
+        if not self.index or not _has_position(fix):
+            return None, []
+
+        lng, lat = float(fix["longitude"]), float(fix["latitude"])
+        events: list[Dict[str, Any]] = []
+        with self._lock:
+            index = self.index
+            if not index or not index.fences:
+                return None, events
+            self.evaluated += 1
+            nearby: set[str] = set()
+            for fence in index.candidates(lng, lat):
+                if not fence.applies_to(self.device_id):
+                    continue
+                nearby.add(fence.fence_id)
+                distance = fence.signed_distance_m(lng, lat)
+                if fence.fence_id not in self._inside and distance > fence.margin_m:
+                    self._inside.add(fence.fence_id)
+                    events.append(self._event("enter", fence, fix, distance))
+                elif fence.fence_id in self._inside and distance < -fence.margin_m:
+                    self._inside.discard(fence.fence_id)
+                    events.append(self._event("exit", fence, fix, distance))
+            for fence_id in sorted(self._inside - nearby):  # 已远离到外扩矩形之外
+                self._inside.discard(fence_id)
+                fence = index.fences[fence_id]
+                events.append(self._event("exit", fence, fix, fence.signed_distance_m(lng, lat)))
+            for event in events:
+                event["inside_fences"] = sorted(self._inside)
+                self.events[event["event"]] += 1
+            return bool(self._inside), events
+
+    def _event(self, kind: str, fence: Geofence, fix: Dict[str, Any], distance: float) -> Dict[str, Any]:
+        """构造一条进出事件（distance_m 为到边界的距离，围栏内为正、围栏外为负）。"""
+
+        return {
+            "message_type": "FENCE_EVENT",
+            "device_id": self.device_id,
+            "event": kind,
+            "fence_id": fence.fence_id,
+            "fence_name": fence.name,
+            "latitude": fix["latitude"],
+            "longitude": fix["longitude"],
+            "distance_m": round(distance, 1),
+            "fix_timestamp": fix.get("timestamp"),
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        """返回围栏集合信息、当前所在围栏与事件计数。"""
+
+        with self._lock:
+            return {
+                **(self.index.stats() if self.index else {"fences": 0}),
+                "inside": sorted(self._inside),
+                "evaluated": self.evaluated,
+                "enter_events": self.events["enter"],
+                "exit_events": self.events["exit"],
+            }
+
+
+TRIP_SPEED_MIN_INTERVAL_S = 1.0  # 推算速度所需的最短定位间隔（同一秒内的多条语句不参与推算）
+TRIP_BATCH_CHUNK = 65536  # 批量统计时每块的定位条数
+
+
+def trip_options(config: "PublisherConfig") -> Dict[str, float]:
+    """从配置中取出行程切分参数，作为 TripAnalyzer/TripSegmenter/summarize_trips 的关键字参数。"""
+
+    return {
+        "moving_speed_ms": config.trip_moving_speed_ms,
+        "dwell_s": config.trip_stop_dwell_s,
+        "min_distance_m": config.trip_min_distance_m,
+    }
+
+
+def _trip_summary(
+    device_id: str,
+    start: tuple[float, float, float],
+    end: tuple[float, float, float],
+    distance_m: float,
+    points: int,
+    max_speed_ms: float,
+    end_reason: str,
+) -> Dict[str, Any]:
+    """构造一条行程摘要，start/end 为 (时间戳, 纬度, 经度)。"""
+
+    duration = end[0] - start[0]
+    return {
+        "message_type": "TRIP",
+        "device_id": device_id,
+        "start_time": datetime.fromtimestamp(start[0], BEIJING_TZ).strftime("%Y/%m/%d %H:%M:%S"),
+        "end_time": datetime.fromtimestamp(end[0], BEIJING_TZ).strftime("%Y/%m/%d %H:%M:%S"),
+        "start_ts": round(start[0], 3),
+        "end_ts": round(end[0], 3),
+        "start_lat": round(start[1], 7),
+        "start_lng": round(start[2], 7),
+        "end_lat": round(end[1], 7),
+        "end_lng": round(end[2], 7),
+        "distance_m": round(distance_m, 1),
+        "duration_s": round(duration, 1),
+        "avg_speed_ms": round(distance_m / duration, 2) if duration > 0 else 0.0,
+        "max_speed_ms": round(max_speed_ms, 2),
+        "points": points,
+        "end_reason": end_reason,
+    }
+
+
+class TripAnalyzer:
+    """流式行程切分：逐条接收定位，按速度与停留时间划分行程与停留，行程结束时返回摘要。
+
+    速度不低于 moving_speed_ms 的定位为移动点。行程从第一个移动点开始（与前一条定位相隔不足 dwell_s 时从前一条开始），
+    最后一个移动点之后 dwell_s 秒内没有新的移动点即在该点结束，其后的静止定位不计入行程。
+    结束原因：stop（停留）、signal_lost（之后没有收到定位）、flush（退出或数据结束时仍在行程中）。
+    """
+
+    def __init__(
+        self,
+        device_id: str,
+        moving_speed_ms: float = TRIP_MOVING_SPEED_MS,
+        dwell_s: float = TRIP_STOP_DWELL_S,
+        min_distance_m: float = TRIP_MIN_DISTANCE_M,
+    ):
+        """距离不足 min_distance_m 的行程视为静止漂移，丢弃不返回。"""
+
+        self.device_id = device_id
+        self.moving_speed_ms = moving_speed_ms
+        self.dwell_s = dwell_s
+        self.min_distance_m = min_distance_m
+        self._last: Optional[tuple[float, float, float]] = None
+        self._trip: Optional[Dict[str, Any]] = None
+        self.trips = 0
+        self.discarded = 0
+        self.distance_m = 0.0
+
+    def add_fix(self, fix: Dict[str, Any]) -> list[Dict[str, Any]]:
+        """处理一条实时定位：时间取 timestamp（无法解析时为当前时间），速度取 speed_ms，无坐标时忽略。"""
+
+        if not _has_position(fix):
+            return []
+        ts = history_timestamp_to_epoch(fix.get("timestamp"))
+        return self.add(
+            ts if ts is not None else time.time(),
+            float(fix["latitude"]),
+            float(fix["longitude"]),
+            fix.get("speed_ms"),
+        )
+
+    def add(self, ts: float, lat: float, lng: float, speed: Optional[float] = None) -> list[Dict[str, Any]]:
+        """处理一条按时间顺序到达的定位，speed 为 None 或 NaN 时按与上一条定位的距离推算。"""
+
+        last = self._last
+        step = haversine_m(last[1], last[2], lat, lng) if last else 0.0
+        interval = ts - last[0] if last else 0.0
+        if speed is None or speed != speed:
+            speed = step / interval if interval >= TRIP_SPEED_MIN_INTERVAL_S else 0.0
+        finished = self.poll(ts)
+        self._last = point = (ts, lat, lng)
+
+        trip = self._trip
+        if trip is None:
+            if speed >= self.moving_speed_ms:
+                linked = last is not None and interval < self.dwell_s
+                self._trip = {
+                    "start": last if linked else point,
+                    "end": point,
+                    "distance": step if linked else 0.0,
+                    "points": 2 if linked else 1,
+                    "max_speed": speed,
+                    "tail_distance": 0.0,
+                    "tail_points": 0,
+                }
+            return finished
+
+        # 静止的定位先记在尾部，之后再次移动才计入行程
+        trip["tail_distance"] += step
+        trip["tail_points"] += 1
+        if speed >= self.moving_speed_ms:
+            trip["distance"] += trip["tail_distance"]
+            trip["points"] += trip["tail_points"]
+            trip["tail_distance"] = 0.0
+            trip["tail_points"] = 0
+            trip["end"] = point
+            trip["max_speed"] = max(trip["max_speed"], speed)
+        return finished
+
+    def poll(self, now: Optional[float] = None) -> list[Dict[str, Any]]:
+        """最后一个移动点之后已过 dwell_s 秒时结束行程（长时间收不到定位时由定时检查触发）。"""
+
+        trip = self._trip
+        now = time.time() if now is None else now
+        if trip is None or now - trip["end"][0] < self.dwell_s:
+            return []
+        return self._close("stop" if trip["tail_points"] else "signal_lost")
+
+    def time_to_deadline(self, now: Optional[float] = None) -> Optional[float]:
+        """距离当前行程按停留结束还有多少秒，不在行程中时返回 None。"""
+
+        if self._trip is None:
+            return None
+        now = time.time() if now is None else now
+        return max(0.0, self._trip["end"][0] + self.dwell_s - now)
+
+    def flush(self) -> list[Dict[str, Any]]:
+        """退出或数据结束时结束进行中的行程。"""
+
+        return self._close("flush")
+
+    def _close(self, reason: str) -> list[Dict[str, Any]]:
+        """在最后一个移动点结束当前行程，过短的行程丢弃。"""
+
+        trip, self._trip = self._trip, None
+        if trip is None:
+            return []
+        if trip["distance"] < self.min_distance_m:
+            self.discarded += 1
+            return []
+        self.trips += 1
+        self.distance_m += trip["distance"]
+        return [
+            _trip_summary(
+                self.device_id,
+                trip["start"],
+                trip["end"],
+                trip["distance"],
+                trip["points"],
+                trip["max_speed"],
+                reason,
+            )
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        """返回行程计数与进行中行程的进度。"""
+
+        trip = self._trip
+        current = None
+        if trip is not None:
+            current = {
+                "start_ts": round(trip["start"][0], 3),
+                "distance_m": round(trip["distance"], 1),
+                "duration_s": round(trip["end"][0] - trip["start"][0], 1),
+                "max_speed_ms": round(trip["max_speed"], 2),
+            }
+        return {
+            "trips": self.trips,
+            "discarded": self.discarded,
+            "distance_m": round(self.distance_m, 1),
+            "current": current,
+        }
+
+
+class TripSegmenter:
+    """批量行程切分（需要 NumPy）：按块向量化计算相邻定位的距离与推算速度，切分规则与 TripAnalyzer 相同。
+
+    块末尾未结束的行程（没有行程时为最后一条定位）留到下一块，与新数据拼接后再切分。
+    """
+
+    def __init__(
+        self,
+        device_id: str,
+        moving_speed_ms: float = TRIP_MOVING_SPEED_MS,
+        dwell_s: float = TRIP_STOP_DWELL_S,
+        min_distance_m: float = TRIP_MIN_DISTANCE_M,
+    ):
+        """参数含义同 TripAnalyzer。"""
+
+        self.device_id = device_id
+        self.moving_speed_ms = moving_speed_ms
+        self.dwell_s = dwell_s
+        self.min_distance_m = min_distance_m
+        # (时间戳, 纬度, 经度, 与上一条的距离, 速度) 五列，距离与速度已按之前的数据算好
+        self._carry: Optional[tuple] = None
+        self.points = 0
+        self.trips = 0
+        self.discarded = 0
+        self.distance_m = 0.0
+
+    def feed(self, ts, lat, lng, speed) -> list[Dict[str, Any]]:
+        """追加一块按时间排序的定位（speed 为 NaN 表示未上报），返回其中已经结束的行程。"""
+
+        ts = np.asarray(ts, dtype=np.float64)
+        if not len(ts):
+            return []
+        lat = np.asarray(lat, dtype=np.float64)
+        lng = np.asarray(lng, dtype=np.float64)
+        speed = np.asarray(speed, dtype=np.float64)
+        self.points += len(ts)
+
+        carry = self._carry
+        # 每条定位与上一条比较，块首与上一块的最后一条比较（第一块的首条与自身比较，距离为 0）
+        heads = tuple(column[-1:] for column in carry[:3]) if carry is not None else (ts[:1], lat[:1], lng[:1])
+        prev_ts, prev_lat, prev_lng = (
+            np.concatenate((head, column[:-1])) for head, column in zip(heads, (ts, lat, lng))
+        )
+        step = haversine_m_array(prev_lat, prev_lng, lat, lng)
+        interval = ts - prev_ts
+        derived = np.zeros(len(ts))
+        np.divide(step, interval, out=derived, where=interval >= TRIP_SPEED_MIN_INTERVAL_S)
+        speed = np.where(np.isnan(speed), derived, speed)
+
+        columns = (ts, lat, lng, step, speed)
+        if carry is not None:
+            columns = tuple(np.concatenate((old, new)) for old, new in zip(carry, columns))
+        return self._segment(columns, final=False)
+
+    def finish(self) -> list[Dict[str, Any]]:
+        """数据结束：以 flush 结束仍在进行中的行程。"""
+
+        carry, self._carry = self._carry, None
+        return self._segment(carry, final=True) if carry is not None else []
+
+    def _segment(self, columns: tuple, final: bool) -> list[Dict[str, Any]]:
+        """在拼接后的数组上切分行程：相邻移动点相隔不足 dwell_s 的归为同一行程。"""
+
+        ts, lat, lng, step, speed = columns
+        count = len(ts)
+        moving = np.flatnonzero(speed >= self.moving_speed_ms)
+        if not len(moving):
+            self._carry = None if final else tuple(column[-1:] for column in columns)
+            return []
+
+        breaks = np.flatnonzero(np.diff(ts[moving]) >= self.dwell_s)
+        firsts = moving[np.concatenate(([0], breaks + 1))]
+        lasts = moving[np.concatenate((breaks, [len(moving) - 1]))]
+        linked = (firsts > 0) & (ts[firsts] - ts[np.maximum(firsts - 1, 0)] < self.dwell_s)
+        starts = firsts - linked
+        is_open = ts[-1] - ts[lasts[-1]] < self.dwell_s
+
+        cumulative = np.concatenate(([0.0], np.cumsum(step)))
+        distances = cumulative[lasts + 1] - cumulative[starts + 1]
+        bounds = np.empty(2 * len(starts), dtype=np.intp)
+        bounds[0::2] = starts
+        bounds[1::2] = lasts + 1
+        max_speeds = np.maximum.reduceat(np.append(speed, 0.0), bounds)[0::2]
+        following = np.minimum(lasts + 1, count - 1)
+        stopped = (lasts + 1 < count) & (ts[following] - ts[lasts] < self.dwell_s)
+
+        closed = len(lasts) - 1 if is_open and not final else len(lasts)
+        if final:
+            self._carry = None
+        elif is_open:
+            self._carry = tuple(column[starts[-1] :] for column in columns)
+        else:
+            self._carry = tuple(column[-1:] for column in columns)
+
+        trips = []
+        for number in range(closed):
+            if distances[number] < self.min_distance_m:
+                self.discarded += 1
+                continue
+            first, last = int(starts[number]), int(lasts[number])
+            if is_open and number == len(lasts) - 1:
+                reason = "flush"
+            else:
+                reason = "stop" if stopped[number] else "signal_lost"
+            self.trips += 1
+            self.distance_m += float(distances[number])
+            trips.append(
+                _trip_summary(
+                    self.device_id,
+                    (float(ts[first]), float(lat[first]), float(lng[first])),
+                    (float(ts[last]), float(lat[last]), float(lng[last])),
+                    float(distances[number]),
+                    last - first + 1,
+                    float(max_speeds[number]),
+                    reason,
+                )
+            )
+        return trips
+
+
+def _history_trip_point(fix: Dict[str, Any]) -> Optional[tuple[float, float, float, float]]:
+    """从历史查询结果取出 (时间戳, 纬度, 经度, 速度)，未记录速度时速度为 NaN，缺少坐标时返回 None。"""
+
+    try:
+        point = (float(fix["ts"]), float(fix["lat"]), float(fix["lng"]))
+    except (KeyError, TypeError, ValueError):
+        return None
+    try:
+        speed = float(fix.get("speed"))
+    except (TypeError, ValueError):
+        speed = math.nan
+    return (*point, speed)
+
+
+def _iter_trip_chunks(query: "HistoryQuery", device_id: str, start: Optional[float], end: Optional[float], size: int):
+    """按块生成 (时间戳, 纬度, 经度, 速度) 数组：二进制后端直接使用记录块，JSON Lines 每 size 条组成一块。"""
+
+    if query.binary_store is not None:
+        for chunk in query.binary_store.scan(device_id, start, end):
+            # 速度与 binary_fix_to_dict 一样保留 3 位小数，两种后端的结果一致
+            speed = np.round(chunk["speed"].astype(np.float64), 3)
+            yield chunk["ts"], chunk["lat"] / BINARY_COORD_SCALE, chunk["lng"] / BINARY_COORD_SCALE, speed
+        return
+
+    rows: list[tuple[float, float, float, float]] = []
+    for fix in query.iter_fixes(device_id, start, end):
+        point = _history_trip_point(fix)
+        if point is None:
+            continue
+        rows.append(point)
+        if len(rows) >= size:
+            yield tuple(np.array(column) for column in zip(*rows))
+            rows = []
+    if rows:
+        yield tuple(np.array(column) for column in zip(*rows))
+
+
+def summarize_trips(
+    query: "HistoryQuery",
+    device_id: Optional[str] = None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    moving_speed_ms: float = TRIP_MOVING_SPEED_MS,
+    dwell_s: float = TRIP_STOP_DWELL_S,
+    min_distance_m: float = TRIP_MIN_DISTANCE_M,
+    chunk_size: int = TRIP_BATCH_CHUNK,
+) -> Iterator[Dict[str, Any]]:
+    """逐台设备统计 [start, end] 历史中的行程，按时间顺序生成摘要（跨越范围边界的行程被截断）。
+
+    安装 NumPy 时按块向量化计算，否则逐条交给 TripAnalyzer，两者结果相同。
+    """
+
+    options = {"moving_speed_ms": moving_speed_ms, "dwell_s": dwell_s, "min_distance_m": min_distance_m}
+    for device in [device_id] if device_id else query.devices():
+        if np is None:
+            analyzer = TripAnalyzer(device, **options)
+            for fix in query.iter_fixes(device, start, end):
+                point = _history_trip_point(fix)
+                if point is not None:
+                    yield from analyzer.add(*point)
+            yield from analyzer.flush()
+            continue
+
+        segmenter = TripSegmenter(device, **options)
+        for ts, lat, lng, speed in _iter_trip_chunks(query, device, start, end, chunk_size):
+            yield from segmenter.feed(ts, lat, lng, speed)
+        yield from segmenter.finish()
+
+
+# 直方图分桶上界（秒）：发布确认与历史写入按毫秒级，单行解析按微秒级
+LATENCY_BUCKETS: tuple[float, ...] = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PARSE_BUCKETS: tuple[float, ...] = (5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 5e-3)
+
+
+def _escape_label_value(value: str) -> str:
+    """按 Prometheus 文本格式转义标签值中的反斜杠、双引号与换行。"""
+
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: tuple[tuple[str, str], ...], extra: str = "") -> str:
+    """按 Prometheus 文本格式输出标签，如 {device="gps-01",le="0.5"}。"""
+
+    parts = [f'{key}="{_escape_label_value(value)}"' for key, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_metric_value(value: float) -> str:
+    """整数按整数输出，其余按 repr（与 Prometheus 客户端一致）。"""
+
+    if isinstance(value, int) or (isinstance(value, float) and value.is_integer()):
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    """单调递增计数器。每个指标一把锁，无竞争时开销约为一次字典查找。"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: tuple[tuple[str, str], ...] = ()):
+        """名称、说明与固定标签在创建时确定。"""
+
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1):
+        """增加计数。"""
+
+        with self._lock:
+            self.value += amount
+
+    def samples(self) -> Iterator[tuple[str, str, float]]:
+        """导出样本：(名称, 标签文本, 值)。"""
+
+        yield self.name, _format_labels(self.labels), self.value
+
+
+class Histogram:
+    """固定分桶直方图：observe() 只做一次二分查找与三次加法，导出时再累加为累计分桶。"""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+        labels: tuple[tuple[str, str], ...] = (),
+    ):
+        """buckets 为升序的分桶上界，最后隐含 +Inf 桶。"""
+
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.bounds = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        """记录一次观测值。"""
+
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self) -> tuple[list[int], float, int]:
+        """返回 (各桶计数, 总和, 次数) 的一致快照。"""
+
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+    def samples(self) -> Iterator[tuple[str, str, float]]:
+        """导出累计分桶、_sum 与 _count 样本。"""
+
+        counts, total, count = self.snapshot()
+        cumulative = 0
+        for bound, bucket in zip(self.bounds, counts):
+            cumulative += bucket
+            yield f"{self.name}_bucket", _format_labels(self.labels, f'le="{bound}"'), cumulative
+        yield f"{self.name}_bucket", _format_labels(self.labels, 'le="+Inf"'), count
+        yield f"{self.name}_sum", _format_labels(self.labels), total
+        yield f"{self.name}_count", _format_labels(self.labels), count
+
+
+def histogram_quantile(bounds: tuple[float, ...], counts: list[int], q: float) -> Optional[float]:
+    """按分桶线性插值估计分位数（与 PromQL histogram_quantile 相同），落在 +Inf 桶时返回最大上界。"""
+
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    cumulative = 0
+    for index, bucket in enumerate(counts):
+        if cumulative + bucket >= rank and bucket:
+            if index >= len(bounds):
+                return bounds[-1]
+            lower = bounds[index - 1] if index else 0.0
+            return lower + (bounds[index] - lower) * (rank - cumulative) / bucket
+        cumulative += bucket
+    return bounds[-1]
+
+
+MetricSample = tuple[str, str, str, Dict[str, str], float]  # 名称、类型、说明、标签、值
+
+
+class MetricsRegistry:
+    """进程内指标注册表：计数器与直方图由热路径直接更新；队列深度等现有计数由收集函数在导出时读取。"""
+
+    def __init__(self):
+        """创建空注册表。"""
+
+        self._metrics: Dict[tuple[str, tuple[tuple[str, str], ...]], Counter | Histogram] = {}
+        self._collectors: list[Callable[[], Iterable[MetricSample]]] = []
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, factory, name: str, labels: Optional[Dict[str, str]], **kwargs):
+        """同名同标签的指标只创建一次，重复获取返回同一对象。"""
+
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = self._metrics[key] = factory(name, labels=key[1], **kwargs)
+            return metric
+
+    def counter(self, name: str, help_text: str, labels: Optional[Dict[str, str]] = None) -> Counter:
+        """获取或创建计数器。"""
+
+        return self._get_or_create(Counter, name, labels, help_text=help_text)
+
+    def histogram(
+        self,
+        name: str,
+        help_text: str,
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+        labels: Optional[Dict[str, str]] = None,
+    ) -> Histogram:
+        """获取或创建直方图。"""
+
+        return self._get_or_create(Histogram, name, labels, help_text=help_text, buckets=buckets)
+
+    def register_collector(self, collector: Callable[[], Iterable[MetricSample]]):
+        """注册导出时调用的收集函数。"""
+
+        with self._lock:
+            self._collectors.append(collector)
+
+    def unregister_collector(self, collector: Callable[[], Iterable[MetricSample]]):
+        """移除收集函数（不存在时忽略）。"""
+
+        with self._lock:
+            with contextlib.suppress(ValueError):
+                self._collectors.remove(collector)
+
+    def render(self) -> str:
+        """按 Prometheus 文本格式（0.0.4）导出全部指标，同名指标合并在一组 HELP/TYPE 之下。"""
+
+        families: Dict[str, tuple[str, str, list[str]]] = {}
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+
+        for metric in metrics:
+            lines = families.setdefault(metric.name, (metric.kind, metric.help, []))[2]
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_format_metric_value(value)}")
+
+        for collector in collectors:
+            try:
+                for name, kind, help_text, labels, value in collector():
+                    if value is None:
+                        continue
+                    lines = families.setdefault(name, (kind, help_text, []))[2]
+                    label_text = _format_labels(tuple(sorted(labels.items())))
+                    lines.append(f"{name}{label_text} {_format_metric_value(value)}")
+            except Exception as exc:  # noqa: BLE001
+                logging.error("收集运行指标失败: %s", exc)
+
+        out = []
+        for name, (kind, help_text, lines) in families.items():
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(lines)
+        return "\n".join(out) + "\n"
+
+    def summary(self) -> Dict[str, Any]:
+        """STATUS 用的指标摘要：按 device 以外的标签合并（多接收机时汇总），直方图给出次数、均值与 p50/p95/p99 毫秒。"""
+
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        merged: Dict[str, Any] = {}
+        for metric in metrics:
+            extra = ",".join(f"{key}={value}" for key, value in metric.labels if key != "device")
+            key = f"{metric.name}{{{extra}}}" if extra else metric.name
+            if isinstance(metric, Counter):
+                merged[key] = merged.get(key, 0) + metric.value
+                continue
+            counts, total, count = metric.snapshot()
+            entry = merged.setdefault(key, {"bounds": metric.bounds, "counts": [0] * len(counts), "sum": 0.0})
+            entry["counts"] = [a + b for a, b in zip(entry["counts"], counts)]
+            entry["sum"] += total
+
+        summary: Dict[str, Any] = {}
+        for key, value in sorted(merged.items()):
+            if not isinstance(value, dict):
+                summary[key] = value
+                continue
+            count = sum(value["counts"])
+            if not count:
+                continue
+            entry = {"count": count, "mean_ms": round(value["sum"] / count * 1000, 3)}
+            for label, q in (("p50_ms", 0.5), ("p95_ms", 0.95), ("p99_ms", 0.99)):
+                estimate = histogram_quantile(value["bounds"], value["counts"], q)
+                entry[label] = round(estimate * 1000, 3) if estimate is not None else None
+            summary[key] = entry
+        return summary
+
+
+METRICS = MetricsRegistry()
+
+
+class ReceiverMetrics:
+    """一台接收机的指标句柄（带 device 标签），热路径上直接持有对象，避免按名称查找。"""
+
+    def __init__(self, device_id: str, registry: MetricsRegistry = METRICS):
+        """创建或取回该设备的计数器与直方图。"""
+
+        labels = {"device": device_id}
+        self.registry = registry
+        self.device_id = device_id
+        self.serial_bytes = registry.counter("gps_serial_bytes_total", "串口读取的字节数", labels)
+        self.serial_lines = registry.counter("gps_serial_lines_total", "串口读取的行数", labels)
+        self.mqtt_connects = registry.counter("gps_mqtt_connects_total", "MQTT 连接成功次数（含重连）", labels)
+        self.mqtt_disconnects = registry.counter("gps_mqtt_disconnects_total", "MQTT 连接断开次数", labels)
+        self.publish_ack = registry.histogram(
+            "gps_publish_ack_seconds",
+            "定位消息进入发布窗口到 paho on_publish 回调的时长（QoS 0 为写入套接字，QoS 1 为收到 PUBACK）",
+            LATENCY_BUCKETS,
+            labels,
+        )
+        self._parse: Dict[bytes, Histogram] = {}
+
+    def parse_histogram(self, sentence_id: bytes) -> Histogram:
+        """按语句类型取解析耗时直方图；未注册的类型归入 other，避免噪声行产生无限多的标签。"""
+
+        histogram = self._parse.get(sentence_id)
+        if histogram is None:
+            label = sentence_id.decode("ascii") if sentence_id in NMEA_PARSERS else "other"
+            histogram = self.registry.histogram(
+                "gps_nmea_parse_seconds",
+                "单行 NMEA 校验与解析耗时",
+                PARSE_BUCKETS,
+                {"device": self.device_id, "type": label},
+            )
+            if sentence_id in NMEA_PARSERS:
+                self._parse[sentence_id] = histogram
+        return histogram
+
+
+@dataclass
+class OutgoingMessage:
+    """发布窗口中的一条消息：fixes 为其中的定位（确认后写入历史时使用），enqueued 为进入窗口的 perf_counter 时刻。"""
+
+    topic: str
+    payload: bytes | str
+    qos: int
+    fixes: list[Dict[str, Any]]
+    enqueued: float
+
+
+class PublishWindow:
+    """定位消息的发布窗口：最多 max_inflight 条消息已交给 paho 尚未确认（QoS 1 等 PUBACK，QoS 0 等写入套接字），
+    其余在有界队列中等待，确认一条再发下一条，paho 内部队列不会随服务器变慢而无限增长。
+
+    队列满时按 policy 处理："drop-oldest"/"drop-newest" 把被挤出的消息交给 on_overflow（写入断线发送队列或丢弃），
+    "block" 阻塞发布线程直到有空位（MQTT 断开或窗口已关闭时队列不会排空，不再等待，新消息交给 on_overflow）。
+    MQTT 断开期间只入队不发送，已交给 paho 的 QoS 0 消息会随连接丢失，交给 on_overflow。
+    send(message) 返回 mid，发送失败返回 None（交给 on_failed）；确认时调用 on_acked(message)。
+    不持锁调用 paho：paho 在持有自身锁时回调 on_publish，持锁发布会与网络线程互相等待。
+    """
+
+    def __init__(
+        self,
+        send: Callable[[OutgoingMessage], Optional[int]],
+        max_inflight: int = MQTT_MAX_INFLIGHT,
+        queue_size: int = MQTT_QUEUE_SIZE,
+        policy: str = MQTT_QUEUE_POLICY,
+        on_acked: Optional[Callable[[OutgoingMessage], None]] = None,
+        on_overflow: Optional[Callable[[OutgoingMessage], None]] = None,
+        on_failed: Optional[Callable[[OutgoingMessage], None]] = None,
+    ):
+        """max_inflight 与 queue_size 均为消息条数。"""
+
+        if max_inflight <= 0 or queue_size <= 0:
+            raise ValueError(f"发布窗口与队列容量必须为正数: {max_inflight}, {queue_size}")
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f"未知的发布队列策略: {policy}（可选: {', '.join(QUEUE_POLICIES)}）")
+        self.send = send
+        self.max_inflight = max_inflight
+        self.queue_size = queue_size
+        self.policy = policy
+        self.on_acked = on_acked
+        self.on_overflow = on_overflow
+        self.on_failed = on_failed
+        self.connected = False
+        self.closed = False
+        self.submitted = 0
+        self.sent = 0
+        self.acked_count = 0
+        self.dropped = 0
+        self.failed = 0
+        self.lost = 0
+        self.high_watermark = 0
+        self._queue: deque[OutgoingMessage] = deque()
+        self._inflight: Dict[int, OutgoingMessage] = {}
+        self._reserved = 0  # 已占用窗口、正在调用 send() 的消息数
+        self._early: set[int] = set()
+        self._cond = threading.Condition()
+
+    def submit(self, message: OutgoingMessage):
+        """提交一条消息：窗口有空位且已连接时立即发送，否则入队。"""
+
+        evicted = None
+        with self._cond:
+            self.submitted += 1
+            if len(self._queue) >= self.queue_size:
+                if self.policy == "drop-newest":
+                    evicted = message
+                elif self.policy == "drop-oldest":
+                    evicted = self._queue.popleft()
+                else:
+                    while len(self._queue) >= self.queue_size and self.connected and not self.closed:
+                        self._cond.wait(0.5)
+                    if len(self._queue) >= self.queue_size:
+                        evicted = message
+                if evicted is not None:
+                    self.dropped += 1
+            if evicted is not message:
+                self._queue.append(message)
+                self.high_watermark = max(self.high_watermark, len(self._queue))
+        if evicted is not None and self.on_overflow:
+            self.on_overflow(evicted)
+        self._pump()
+
+    def acked(self, mid: int) -> bool:
+        """on_publish 回调；返回 mid 是否属于本窗口。"""
+
+        with self._cond:
+            message = self._inflight.pop(mid, None)
+            if message is None:
+                if self._reserved:
+                    # send() 尚未返回 mid（asyncio 模式下 publish() 内即可完成写入并回调）
+                    self._early.add(mid)
+                return False
+            self.acked_count += 1
+            self._cond.notify_all()
+        if self.on_acked:
+            self.on_acked(message)
+        self._pump()
+        return True
+
+    def resume(self):
+        """MQTT 已连接：开始发送队列中的消息。"""
+
+        with self._cond:
+            self.connected = True
+        self._pump()
+
+    def pause(self):
+        """MQTT 断开：停止发送；QoS 0 的在途消息不会再有确认，视为丢失交给 on_overflow（QoS 1 由 paho 重连后重发）。"""
+
+        with self._cond:
+            self.connected = False
+            lost = [mid for mid, message in self._inflight.items() if not message.qos]
+            messages = [self._inflight.pop(mid) for mid in lost]
+            self.lost += len(messages)
+            self._cond.notify_all()
+        for message in messages:
+            if self.on_overflow:
+                self.on_overflow(message)
+
+    def close(self):
+        """开始退出：block 策略不再等待空位，之后提交的消息照常入队或交给 on_overflow。"""
+
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def wait_drained(self, timeout: float) -> bool:
+        """等待队列与在途消息清空（断开期间不等待），返回是否已清空。"""
+
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self.connected and (self._queue or self._inflight or self._reserved):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(min(remaining, 0.1))
+            return not (self._queue or self._inflight or self._reserved)
+
+    def pending(self) -> int:
+        """队列中与在途的消息总数。"""
+
+        with self._cond:
+            return len(self._queue) + len(self._inflight) + self._reserved
+
+    def take_pending(self) -> list[OutgoingMessage]:
+        """取出所有未确认的消息（在途在前、队列在后），退出前交给断线发送队列。"""
+
+        with self._cond:
+            pending = [*self._inflight.values(), *self._queue]
+            self._inflight.clear()
+            self._queue.clear()
+            self._cond.notify_all()
+            return pending
+
+    def stats(self) -> Dict[str, Any]:
+        """窗口与队列的当前深度和累计计数（写入状态消息）。"""
+
+        with self._cond:
+            return {
+                "queued": len(self._queue),
+                "inflight": len(self._inflight) + self._reserved,
+                "max_inflight": self.max_inflight,
+                "queue_size": self.queue_size,
+                "policy": self.policy,
+                "submitted": self.submitted,
+                "sent": self.sent,
+                "acked": self.acked_count,
+                "dropped": self.dropped,
+                "lost": self.lost,
+                "failed": self.failed,
+                "high_watermark": self.high_watermark,
+            }
+
+    def _pump(self):
+        """在窗口容量内依次发送队首消息。"""
+
+        while True:
+            with self._cond:
+                if not self.connected or not self._queue or len(self._inflight) + self._reserved >= self.max_inflight:
+                    return
+                message = self._queue.popleft()
+                self._reserved += 1
+                self._cond.notify_all()
+
+            try:
+                mid = self.send(message)
+            except Exception as exc:  # noqa: BLE001
+                logging.error("发布消息异常: %s", exc)
+                mid = None
+
+            with self._cond:
+                self._reserved -= 1
+                early = mid is not None and mid in self._early
+                if mid is None:
+                    self.failed += 1
+                elif early:
+                    self._early.discard(mid)
+                    self.sent += 1
+                    self.acked_count += 1
+                else:
+                    self.sent += 1
+                    self._inflight[mid] = message
+                if not self._reserved:
+                    self._early.clear()
+                self._cond.notify_all()
+
+            if mid is None and self.on_failed:
+                self.on_failed(message)
+            elif early and self.on_acked:
+                self.on_acked(message)
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    """运行指标 HTTP 接口：GET /metrics 返回 Prometheus 文本格式。"""
+
+    def do_GET(self):  # noqa: N802 - BaseHTTPRequestHandler 约定
+        """导出指标。"""
+
+        if urllib.parse.urlsplit(self.path).path != "/metrics":
+            self.send_error(404)
+            return
+        registry: MetricsRegistry = self.server.metrics_registry  # type: ignore[attr-defined]
+        data = registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args: Any):  # noqa: A002 - 与父类签名一致
+        """将访问日志转到 logging 的调试级别。"""
+
+        logging.debug("运行指标 %s - %s", self.address_string(), format % args)
+
+
+def start_metrics_http_server(registry: MetricsRegistry, host: str, port: int) -> ThreadingHTTPServer:
+    """在后台线程启动运行指标 HTTP 服务并返回服务对象。"""
+
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    server.metrics_registry = registry  # type: ignore[attr-defined]
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logging.info("运行指标服务已启动: http://%s:%s/metrics", host, server.server_address[1])
+    return server
+
+
+SPOOL_RECORD_HEADER = struct.Struct("<IIH")  # 负载长度、CRC32（主题+负载）、主题长度
+
+
+class OutboundSpool:
+    """MQTT 断线期间的磁盘发送队列：按分段追加写入，带 CRC 的记录与原子更新的读取偏移保证断电后可恢复。
+
+    目录结构为 spool-<序号>.log 分段与 offset 文件；offset 记录已确认送达的位置，
+    重启后从该位置继续重放（至多重复最后一个提交间隔内的少量消息）。
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        max_bytes: int = SPOOL_MAX_BYTES,
+        segment_bytes: int = SPOOL_SEGMENT_BYTES,
+        commit_every: int = 50,
+        commit_interval: float = 1.0,
+    ):
+        """打开或创建队列目录，丢弃已确认的分段并修复最后一个分段的残缺尾部。"""
+
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.segment_bytes = max(1, segment_bytes)
+        self.commit_every = max(1, commit_every)
+        self.commit_interval = commit_interval
+
+        self._lock = threading.Lock()
+        self._segments = sorted(
+            int(path.stem.split("-", 1)[1])
+            for path in self.directory.glob("spool-*.log")
+            if path.stem.split("-", 1)[1].isdigit()
+        )
+        self._offset = self._load_offset()
+        self._uncommitted = 0
+        self._last_commit = time.monotonic()
+        self._file = None
+        self._write_pos = 0
+
+        self.appended = 0
+        self.replayed = 0
+        self.dropped_bytes = 0
+        self.corrupt = 0
+
+        for seq in [seq for seq in self._segments if seq < self._offset[0]]:
+            self._remove_segment(seq)
+        if self._segments:
+            self._offset = max(self._offset, (self._segments[0], 0))
+            self._open_segment(self._segments[-1])
+        else:
+            self._open_segment(max(self._offset[0], 1))
+
+    def _segment_path(self, seq: int) -> Path:
+        """分段文件路径。"""
+
+        return self.directory / f"spool-{seq:08d}.log"
+
+    def _load_offset(self) -> tuple[int, int]:
+        """读取已提交的偏移，文件缺失或损坏时从头开始。"""
+
+        try:
+            data = json.loads((self.directory / "offset").read_text(encoding="utf-8"))
+            return int(data["segment"]), int(data["position"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return (self._segments[0] if self._segments else 1), 0
+
+    def _persist_offset(self):
+        """原子写入偏移文件（先写临时文件并 fsync，再替换）。"""
+
+        path = self.directory / "offset"
+        tmp = path.with_suffix(".tmp")
+        with tmp.open("w", encoding="utf-8") as file:
+            json.dump({"segment": self._offset[0], "position": self._offset[1]}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, path)
+        self._uncommitted = 0
+        self._last_commit = time.monotonic()
+
+    def _open_segment(self, seq: int):
+        """打开追加分段，截断断电留下的半条记录。"""
+
+        path = self._segment_path(seq)
+        if seq not in self._segments:
+            self._segments.append(seq)
+        self._file = path.open("a+b")
+        self._file.seek(0)
+        valid = 0
+        while True:
+            record = self._read_record(self._file, valid)
+            if record is None:
+                break
+            valid = record[2]
+        if valid != self._file.seek(0, os.SEEK_END):
+            logging.warning("发送队列分段 %s 尾部不完整，截断到 %d 字节", path.name, valid)
+            self._file.truncate(valid)
+        self._write_pos = valid
+
+    def _remove_segment(self, seq: int):
+        """删除分段文件。"""
+
+        with contextlib.suppress(ValueError):
+            self._segments.remove(seq)
+        with contextlib.suppress(FileNotFoundError):
+            self._segment_path(seq).unlink()
+
+    def _read_record(self, file, position: int) -> Optional[tuple[str, bytes, int]]:
+        """从指定位置读取一条记录，返回 (主题, 负载, 下一条位置)；不完整或校验失败返回 None。"""
+
+        file.seek(position)
+        header = file.read(SPOOL_RECORD_HEADER.size)
+        if len(header) < SPOOL_RECORD_HEADER.size:
+            return None
+        length, crc, topic_length = SPOOL_RECORD_HEADER.unpack(header)
+        body = file.read(topic_length + length)
+        if len(body) < topic_length + length:
+            return None
+        if zlib.crc32(body) != crc:
+            self.corrupt += 1
+            return None
+        return body[:topic_length].decode("utf-8"), body[topic_length:], position + SPOOL_RECORD_HEADER.size + len(body)
+
+    def append(self, topic: str, payload: bytes | str):
+        """追加一条待发送消息并落盘；超过容量上限时丢弃最旧分段。"""
+
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        topic_bytes = topic.encode("utf-8")
+        body = topic_bytes + payload
+        record = SPOOL_RECORD_HEADER.pack(len(payload), zlib.crc32(body), len(topic_bytes)) + body
+
+        with self._lock:
+            if self._write_pos >= self.segment_bytes:
+                self._file.close()
+                self._open_segment(self._segments[-1] + 1)
+            self._file.write(record)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._write_pos += len(record)
+            self.appended += 1
+            self._enforce_budget()
+
+    def _enforce_budget(self):
+        """总大小超过上限时删除最旧分段（包括尚未重放的），保留正在写入的分段。"""
+
+        if self.max_bytes <= 0:
+            return
+        while len(self._segments) > 1 and self._size_locked() > self.max_bytes:
+            oldest = self._segments[0]
+            size = self._segment_path(oldest).stat().st_size
+            consumed = self._offset[1] if self._offset[0] == oldest else 0
+            self.dropped_bytes += max(0, size - consumed)
+            self._remove_segment(oldest)
+            if self._offset[0] <= oldest:
+                self._offset = (self._segments[0], 0)
+                self._persist_offset()
+            logging.warning("发送队列超过 %d 字节，已丢弃最旧分段 %d", self.max_bytes, oldest)
+
+    def _size_locked(self) -> int:
+        """全部分段的总字节数。"""
+
+        return sum(
+            self._write_pos if seq == self._segments[-1] else self._segment_path(seq).stat().st_size
+            for seq in self._segments
+        )
+
+    def committed(self) -> tuple[int, int]:
+        """已确认送达的位置。"""
+
+        with self._lock:
+            return self._offset
+
+    def read(self, cursor: tuple[int, int]) -> Optional[tuple[str, bytes, tuple[int, int]]]:
+        """读取游标处的下一条消息，返回 (主题, 负载, 下一游标)；没有更多消息时返回 None。"""
+
+        with self._lock:
+            seq, position = max(cursor, self._offset)
+            while True:
+                if seq == self._segments[-1]:
+                    if position >= self._write_pos:
+                        return None
+                    file = self._file
+                elif seq in self._segments:
+                    file = None
+                else:
+                    # 游标所在分段已因容量上限被删除
+                    seq, position = self._next_segment(seq), 0
+                    continue
+
+                if file is None:
+                    with self._segment_path(seq).open("rb") as segment:
+                        record = self._read_record(segment, position)
+                else:
+                    record = self._read_record(file, position)
+                    file.seek(0, os.SEEK_END)
+
+                if record is None:
+                    if seq == self._segments[-1]:
+                        return None
+                    # 旧分段读完（或遇到无法校验的记录）时跳到下一个分段
+                    seq, position = self._next_segment(seq), 0
+                    continue
+                topic, payload, end = record
+                return topic, payload, (seq, end)
+
+    def _next_segment(self, seq: int) -> int:
+        """序号大于 seq 的第一个分段（调用方保证 seq 小于当前写入分段）。"""
+
+        return self._segments[bisect.bisect_right(self._segments, seq)]
+
+    def commit(self, cursor: tuple[int, int]):
+        """确认游标之前的消息已送达；按条数或时间间隔持久化偏移，并删除已读完的分段。"""
+
+        with self._lock:
+            if cursor <= self._offset:
+                return
+            self._offset = cursor
+            self.replayed += 1
+            self._uncommitted += 1
+            finished = [seq for seq in self._segments[:-1] if seq < cursor[0]]
+            if (
+                finished
+                or self._uncommitted >= self.commit_every
+                or time.monotonic() - self._last_commit >= self.commit_interval
+            ):
+                self._persist_offset()
+                for seq in finished:
+                    self._remove_segment(seq)
+
+    def pending(self) -> bool:
+        """是否还有未确认送达的消息。"""
+
+        with self._lock:
+            return self._offset < (self._segments[-1], self._write_pos)
+
+    def flush_offset(self):
+        """立即持久化当前偏移。"""
+
+        with self._lock:
+            if self._uncommitted:
+                self._persist_offset()
+
+    def close(self):
+        """持久化偏移并关闭分段文件。"""
+
+        with self._lock:
+            if self._uncommitted:
+                self._persist_offset()
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    def stats(self) -> Dict[str, Any]:
+        """返回队列计数，用于状态上报。"""
+
+        with self._lock:
+            seq, position = self._offset
+            pending_bytes = self._size_locked() - (position if seq in self._segments else 0)
+            return {
+                "pending_bytes": pending_bytes,
+                "segments": len(self._segments),
+                "appended": self.appended,
+                "replayed": self.replayed,
+                "dropped_bytes": self.dropped_bytes,
+                "corrupt": self.corrupt,
+            }
+
+
+class SpoolDrainer:
+    """MQTT 连接恢复后在后台按限速以 QoS 1 重放发送队列（从最旧开始），不阻塞实时定位发布。"""
+
+    def __init__(
+        self,
+        spool: OutboundSpool,
+        publish: Callable[[str, bytes], Any],
+        rate: float = SPOOL_DRAIN_RATE,
+        window: int = SPOOL_DRAIN_WINDOW,
+        ack_timeout: float = 30.0,
+    ):
+        """publish(topic, payload) 需以 QoS 1 发送并返回 paho 的 MQTTMessageInfo。"""
+
+        self.spool = spool
+        self.publish = publish
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.window = max(1, window)
+        self.ack_timeout = ack_timeout
+        self._connected = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """启动重放线程。"""
+
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="spool-drainer", daemon=True)
+        self._thread.start()
+
+    def resume(self):
+        """连接建立时调用，开始（或继续）重放。"""
+
+        self._connected.set()
+
+    def pause(self):
+        """连接断开时调用，未确认的消息在下次连接后从已提交位置重发。"""
+
+        self._connected.clear()
+
+    def stop(self, timeout: float = 5.0):
+        """停止重放线程并持久化偏移。"""
+
+        self._stop.set()
+        self._connected.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+        self.spool.flush_offset()
+
+    def _run(self):
+        """线程主循环：每次连接期间执行一轮重放。"""
+
+        while not self._stop.is_set():
+            if not self._connected.wait(1.0) or self._stop.is_set():
+                continue
+            try:
+                self._drain_session()
+            except Exception as exc:  # noqa: BLE001
+                logging.error("发送队列重放异常: %s", exc)
+                self._stop.wait(1.0)
+
+    def _drain_session(self):
+        """在窗口内流水线发送，按顺序确认后推进偏移；超时或断线时退出，由下一轮从已提交位置重发。"""
+
+        cursor = self.spool.committed()
+        inflight: deque = deque()
+        next_send = time.monotonic()
+        while self._connected.is_set() and not self._stop.is_set():
+            while inflight and inflight[0][0].is_published():
+                self.spool.commit(inflight.popleft()[1])
+            if inflight and time.monotonic() - inflight[0][2] > self.ack_timeout:
+                logging.warning("发送队列重放等待确认超时，稍后从已提交位置重试")
+                self._stop.wait(1.0)
+                break
+
+            now = time.monotonic()
+            if len(inflight) >= self.window or now < next_send:
+                self._stop.wait(min(0.01, max(0.0, next_send - now)) or 0.01)
+                continue
+
+            record = self.spool.read(cursor)
+            if record is None:
+                if not inflight:
+                    self.spool.flush_offset()
+                self._stop.wait(0.5 if not inflight else 0.01)
+                continue
+
+            topic, payload, next_cursor = record
+            info = self.publish(topic, payload)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                self._stop.wait(1.0)
+                break
+            inflight.append((info, next_cursor, now))
+            cursor = next_cursor
+            next_send = max(next_send + self.interval, now)
+        self.spool.flush_offset()
+
+
+class HistoryWriter:
+    """后台历史写入线程：保持文件打开，按条数或时间窗口批量追加 JSON Lines。"""
+
+    def __init__(
+        self,
+        path: Path,
+        batch_size: int = HISTORY_BATCH_SIZE,
+        batch_interval: float = HISTORY_BATCH_INTERVAL,
+        fsync_policy: str = HISTORY_FSYNC_POLICY,
+        fsync_interval: float = HISTORY_FSYNC_INTERVAL,
+        max_pending: int = HISTORY_MAX_PENDING,
+        rotate_bytes: int = 0,
+        rotate_daily: bool = False,
+        compression: str = "none",
+        retention_bytes: int = 0,
+        write_jsonl: bool = True,
+        binary_store: Optional[BinaryHistoryStore] = None,
+    ):
+        """保存写入参数，线程在第一次提交记录时启动。"""
+
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"未知的落盘策略: {fsync_policy}（可选: {', '.join(FSYNC_POLICIES)}）")
+        if compression not in HISTORY_COMPRESSIONS:
+            raise ValueError(f"未知的压缩方式: {compression}（可选: {', '.join(HISTORY_COMPRESSIONS)}）")
+        if compression == "zstd" and _zstd_module() is None:
+            logging.warning("当前 Python 不支持 zstd，历史分段改用 gzip 压缩")
+            compression = "gzip"
+
+        self.path = path
+        self.batch_size = max(1, batch_size)
+        self.batch_interval = max(0.0, batch_interval)
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.max_pending = max_pending
+        self.rotate_bytes = rotate_bytes
+        self.rotate_daily = rotate_daily
+        self.compression = compression
+        self.retention_bytes = retention_bytes
+        self.write_jsonl = write_jsonl
+        self.binary_store = binary_store
+        self.on_submit: Optional[Callable[[Dict[str, Any]], None]] = None  # 记录入队后调用（轨迹金字塔标记晚到数据）
+        self._segment_size = 0
+        self._segment_day: Optional[date] = None
+        self._maintenance: queue.Queue = queue.Queue()
+        self._maintenance_thread: Optional[threading.Thread] = None
+        self._pending: deque[Dict[str, Any]] = deque()
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._closing = False
+        self._file = None
+        self._dirty = False
+        self._last_fsync = time.monotonic()
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.fsyncs = 0
+        self.errors = 0
+        self.rotations = 0
+        self.compressed = 0
+        self.deleted_segments = 0
+        self.write_seconds = METRICS.histogram("gps_history_write_seconds", "一批历史记录写入（含落盘）的耗时")
+
+    def submit(self, record: Dict[str, Any]) -> bool:
+        """提交一条记录，由后台线程批量写入；积压超限时丢弃并计数。"""
+
+        with self._cond:
+            if len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                return False
+
+            self._pending.append(record)
+            if self._thread is None or not self._thread.is_alive():
+                self._closing = False
+                self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+                self._thread.start()
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify_all()
+        if self.on_submit:
+            self.on_submit(record)
+        return True
+
+    def close(self, timeout: float = 5.0):
+        """写完所有积压记录并关闭文件，退出前调用以免丢失数据。"""
+
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+            thread = self._thread
+
+        if thread and thread.is_alive():
+            thread.join(timeout)
+        stuck = thread is not None and thread.is_alive()
+
+        with self._cond:
+            remaining = list(self._pending)
+            self._pending.clear()
+            if stuck:
+                # 写入线程仍在写文件，不能并发写入或关闭文件，剩余积压计为丢弃
+                self.dropped += len(remaining)
+        if stuck:
+            logging.warning("历史写入线程 %.1f 秒内未退出，丢弃 %d 条积压记录", timeout, len(remaining))
+        else:
+            # 线程未启动或已退出时在当前线程补写剩余记录
+            if remaining:
+                self._write_batch(remaining)
+            self._close_file()
+            if self.binary_store:
+                self.binary_store.close()
+
+        maintenance = self._maintenance_thread
+        if maintenance and maintenance.is_alive():
+            # 未完成的压缩会在下次启动时继续，这里只做有限等待
+            self._maintenance.put(None)
+            maintenance.join(timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回写入计数与积压深度，用于状态上报。"""
+
+        with self._cond:
+            pending = len(self._pending)
+        return {
+            "pending": pending,
+            "written": self.written,
+            "dropped": self.dropped,
+            "batches": self.batches,
+            "fsyncs": self.fsyncs,
+            "errors": self.errors,
+            "fsync_policy": self.fsync_policy,
+            "segment_bytes": self._segment_size,
+            "rotations": self.rotations,
+            "compressed_segments": self.compressed,
+            "deleted_segments": self.deleted_segments,
+        }
+
+    def _run(self):
+        """后台线程主循环：凑满一批或时间窗口到期后写入。"""
+
+        while True:
+            with self._cond:
+                while not self._pending and not self._closing:
+                    if not self._cond.wait(self._idle_timeout()):
+                        break
+
+                if self._pending:
+                    deadline = time.monotonic() + self.batch_interval
+                    while len(self._pending) < self.batch_size and not self._closing:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+
+                batch = list(self._pending)
+                self._pending.clear()
+                closing = self._closing
+
+            if batch:
+                self._write_batch(batch)
+            else:
+                self._maybe_fsync()
+
+            if closing:
+                return
+
+    def _idle_timeout(self) -> Optional[float]:
+        """空闲时的等待时长：按间隔落盘且有未同步数据时需要定时唤醒。"""
+
+        if self.fsync_policy == "interval" and self._dirty:
+            return max(0.0, self._last_fsync + self.fsync_interval - time.monotonic())
+        return None
+
+    def _open_file(self):
+        """按需以追加模式打开历史文件，并记录当前分段的大小与日期。"""
+
+        if self._file is None:
+            first_open = self._segment_day is None
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = self.path.open("ab")
+            self._segment_size = self._file.tell()
+            if self._segment_size:
+                self._segment_day = datetime.fromtimestamp(self.path.stat().st_mtime).date()
+            else:
+                self._segment_day = date.today()
+            if first_open:
+                # 处理上次运行遗留的未压缩分段并检查保留额度
+                for segment in history_segments(self.path):
+                    if segment.suffix == self.path.suffix:
+                        self._schedule_maintenance(segment)
+                self._schedule_maintenance(None)
+        return self._file
+
+    def _write_batch(self, batch: list[Dict[str, Any]]):
+        """将一批记录一次写入文件，并按策略刷新与落盘。"""
+
+        started = time.perf_counter()
+        try:
+            if self.write_jsonl:
+                data = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in batch).encode("utf-8")
+                self._maybe_rotate(len(data))
+                file = self._open_file()
+                file.write(data)
+                file.flush()
+                self._segment_size += len(data)
+            if self.binary_store:
+                self.binary_store.append_records(batch)
+            self._dirty = True
+            self.written += len(batch)
+            self.batches += 1
+            if self.fsync_policy == "batch":
+                self._fsync()
+            else:
+                self._maybe_fsync()
+            self.write_seconds.observe(time.perf_counter() - started)
+        except Exception as exc:  # noqa: BLE001
+            self.errors += len(batch)
+            logging.error("写入历史轨迹文件失败: %s", exc)
+            self._close_file()
+            if self.binary_store:
+                self.binary_store.close()
+
+    def _maybe_rotate(self, incoming: int):
+        """当前分段超过大小上限或跨天时滚动为新分段。"""
+
+        self._open_file()
+        if not self._segment_size:
+            return
+
+        too_big = self.rotate_bytes > 0 and self._segment_size + incoming > self.rotate_bytes
+        new_day = self.rotate_daily and self._segment_day != date.today()
+        if too_big or new_day:
+            self._rotate()
+
+    def _rotate(self):
+        """关闭当前文件并重命名为带时间戳的分段，随后交给后台压缩。"""
+
+        self._close_file()
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        segment = self.path.with_name(f"{self.path.stem}-{stamp}{self.path.suffix}")
+        counter = 1
+        while any(segment.parent.glob(glob.escape(segment.name) + "*")):
+            segment = self.path.with_name(f"{self.path.stem}-{stamp}-{counter}{self.path.suffix}")
+            counter += 1
+
+        os.replace(self.path, segment)
+        self.rotations += 1
+        self._segment_size = 0
+        self._segment_day = date.today()
+        logging.info("历史文件已滚动: %s", segment.name)
+        self._schedule_maintenance(segment)
+        self._schedule_maintenance(None)
+
+    def _schedule_maintenance(self, segment: Optional[Path]):
+        """提交后台任务：segment 为待压缩分段，None 表示检查保留额度。"""
+
+        if segment is not None and self.compression == "none":
+            return
+        if segment is None and self.retention_bytes <= 0:
+            return
+
+        self._maintenance.put(("compress", segment) if segment is not None else ("retention", None))
+        if self._maintenance_thread is None or not self._maintenance_thread.is_alive():
+            self._maintenance_thread = threading.Thread(
+                target=self._maintenance_loop,
+                name="history-maintenance",
+                daemon=True,
+            )
+            self._maintenance_thread.start()
+
+    def _maintenance_loop(self):
+        """后台线程：依次压缩已关闭的分段并执行保留策略。"""
+
+        while True:
+            try:
+                task = self._maintenance.get(timeout=30)
+            except queue.Empty:
+                return
+            if task is None:
+                return
+
+            action, segment = task
+            try:
+                if action == "compress":
+                    self._compress_segment(segment)
+                else:
+                    self._enforce_retention()
+            except Exception as exc:  # noqa: BLE001
+                logging.error("历史分段维护失败: %s", exc)
+
+    def _compress_segment(self, segment: Path):
+        """压缩单个分段：先写临时文件再改名，中途断电不会损坏原分段。"""
+
+        if not segment.exists():
+            return
+
+        suffix = ".zst" if self.compression == "zstd" else ".gz"
+        target = segment.with_name(segment.name + suffix)
+        temp = target.with_name(target.name + ".tmp")
+        if self.compression == "zstd":
+            opener = _zstd_module().open  # type: ignore[union-attr]
+        else:
+            opener = gzip.open
+
+        with segment.open("rb") as source, opener(temp, "wb") as sink:
+            shutil.copyfileobj(source, sink, 1024 * 1024)
+        os.replace(temp, target)
+        segment.unlink()
+        self.compressed += 1
+        logging.info("历史分段已压缩: %s", target.name)
+
+    def _enforce_retention(self):
+        """所有历史文件总大小超出额度时，从最旧的分段开始删除。"""
+
+        segments = history_segments(self.path)
+        sizes = {segment: segment.stat().st_size for segment in segments}
+        total = sum(sizes.values()) + self._segment_size
+        for segment in segments:
+            if total <= self.retention_bytes:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                segment.unlink()
+                self.deleted_segments += 1
+                logging.info("历史分段超出保留额度，已删除: %s", segment.name)
+            total -= sizes[segment]
+
+    def _maybe_fsync(self):
+        """按间隔策略检查是否需要落盘。"""
+
+        if (
+            self.fsync_policy == "interval"
+            and self._dirty
+            and time.monotonic() - self._last_fsync >= self.fsync_interval
+        ):
+            self._fsync()
+
+    def _fsync(self):
+        """将文件内容同步到存储设备。"""
+
+        if self._file is None and self.binary_store is None:
+            return
+        try:
+            if self._file is not None:
+                os.fsync(self._file.fileno())
+            if self.binary_store:
+                self.binary_store.fsync()
+            self.fsyncs += 1
+        except OSError as exc:
+            logging.error("历史文件落盘失败: %s", exc)
+        self._dirty = False
+        self._last_fsync = time.monotonic()
+
+    def _close_file(self):
+        """关闭文件，按策略在关闭前落盘。"""
+
+        if self._file is None:
+            return
+        with contextlib.suppress(Exception):
+            self._file.flush()
+            if self.fsync_policy != "none" and self._dirty:
+                self._fsync()
+            self._file.close()
+        self._file = None
+
+
+def parse_query_time(value: str) -> float:
+    """解析查询时间：Unix 秒/毫秒、"YYYY/MM/DD HH:MM:SS"（北京时间）或 ISO 8601。"""
+
+    try:
+        number = float(value)
+    except ValueError:
+        epoch = history_timestamp_to_epoch(value.strip())
+        if epoch is None:
+            raise ValueError(f"无法识别的时间: {value}") from None
+        return epoch
+    return number / 1000.0 if number > 1e12 else number
+
+
+def parse_query_bbox(value: str) -> tuple[float, float, float, float]:
+    """解析 "最小经度,最小纬度,最大经度,最大纬度" 形式的范围。"""
+
+    try:
+        min_lng, min_lat, max_lng, max_lat = (float(part) for part in value.split(","))
+    except ValueError:
+        raise ValueError(f"无效的范围: {value}（格式: 最小经度,最小纬度,最大经度,最大纬度）") from None
+    if min_lng > max_lng or min_lat > max_lat:
+        raise ValueError(f"无效的范围: {value}（最小值大于最大值）")
+    return min_lng, min_lat, max_lng, max_lat
+
+
+class HistoryQuery:
+    """历史轨迹查询：按设备、时间范围与经纬度范围流式返回定位。
+
+    使用二进制后端时借助稀疏时间索引与粗网格只读取命中的记录块；
+    JSON Lines 后端按分段文件名中的滚动时间跳过不相关的分段，再逐行过滤。
+    """
+
+    def __init__(self, history_file: Path, binary_store: Optional[BinaryHistoryStore] = None):
+        """binary_store 为 None 时查询 JSON Lines 历史文件。"""
+
+        self.history_file = history_file
+        self.binary_store = binary_store
+
+    def devices(self) -> list[str]:
+        """返回有历史数据的设备列表。"""
+
+        if self.binary_store is not None:
+            return self.binary_store.devices()
+
+        devices = set()
+        for record in self._iter_jsonl(None, None, None, None):
+            if record.get("deviceId"):
+                devices.add(str(record["deviceId"]))
+        return sorted(devices)
+
+    def iter_fixes(
+        self,
+        device_id: Optional[str] = None,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+        bbox: Optional[tuple[float, float, float, float]] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """逐条生成满足条件的定位（时间升序），不会一次性载入全部结果。"""
+
+        if self.binary_store is not None:
+            fixes = self._iter_binary(device_id, start, end, bbox)
+        else:
+            fixes = self._iter_jsonl(device_id, start, end, bbox)
+
+        for number, fix in enumerate(fixes):
+            if limit is not None and number >= limit:
+                return
+            yield fix
+
+    def _iter_binary(self, device_id, start, end, bbox) -> Iterator[Dict[str, Any]]:
+        """从二进制存储读取命中的记录块并转换为字典。"""
+
+        devices = [device_id] if device_id else self.binary_store.devices()
+        for device in devices:
+            for chunk in self.binary_store.scan(device, start, end, bbox):
+                rows = chunk.tolist() if np is not None else chunk
+                for row in rows:
+                    yield binary_fix_to_dict(row, device)
+
+    def _iter_jsonl(self, device_id, start, end, bbox) -> Iterator[Dict[str, Any]]:
+        """按时间顺序扫描 JSON Lines 分段，跳过滚动时间早于 start 的分段。"""
+
+        previous_rotation: Optional[float] = None
+        for path in history_paths(self.history_file):
+            rotation = self._rotation_time(path)
+            # 分段在滚动时刻关闭：滚动早于 start 的分段全部记录都更早；上一分段滚动晚于 end 时后续分段都更晚
+            if start is not None and rotation is not None and rotation < start:
+                previous_rotation = rotation
+                continue
+            if end is not None and previous_rotation is not None and previous_rotation > end:
+                return
+            previous_rotation = rotation
+
+            with open_history_text(path) as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if device_id and record.get("deviceId") != device_id:
+                        continue
+                    ts = history_timestamp_to_epoch(record.get("timestamp"))
+                    if ts is None or (start is not None and ts < start) or (end is not None and ts > end):
+                        continue
+                    if bbox is not None:
+                        try:
+                            lng, lat = float(record["lng"]), float(record["lat"])
+                        except (KeyError, TypeError, ValueError):
+                            continue
+                        if not (bbox[0] <= lng <= bbox[2] and bbox[1] <= lat <= bbox[3]):
+                            continue
+                    record["ts"] = ts
+                    yield record
+
+    def _rotation_time(self, path: Path) -> Optional[float]:
+        """从分段文件名解析滚动时间（本地时间），当前文件返回 None。"""
+
+        if path == self.history_file:
+            return None
+        stamp = path.name[len(self.history_file.stem) + 1 :].split(".", 1)[0]
+        try:
+            return datetime.strptime(stamp[:15], "%Y%m%d-%H%M%S").timestamp()
+        except ValueError:
+            return None
+
+
+def write_query_results(fixes: Iterator[Dict[str, Any]], output_format: str, write: Callable[[str], Any]):
+    """以 NDJSON 或 JSON 数组格式流式输出查询结果，write 每次接收一段文本。"""
+
+    buffer: list[str] = []
+    size = 0
+    first = True
+    if output_format == "json":
+        buffer.append("[")
+    for fix in fixes:
+        text = json.dumps(fix, ensure_ascii=False)
+        if output_format == "json":
+            text = text if first else "," + text
+            first = False
+        else:
+            text += "\n"
+        buffer.append(text)
+        size += len(text)
+        if size >= 64 * 1024:
+            write("".join(buffer))
+            buffer.clear()
+            size = 0
+    if output_format == "json":
+        buffer.append("]\n")
+    if buffer:
+        write("".join(buffer))
+
+
+TRACK_LOD_ZOOMS: tuple[int, ...] = (6, 8, 10, 12, 14, 16, 18)  # 预先计算的地图缩放级别
+TRACK_LOD_GAP_S = 300.0  # 相邻定位间隔超过该值时断开折线
+TRACK_LOD_SETTLE_S = 120.0  # 小时结束后再等待多久视为不再变化（历史写入批处理与断线重放会晚到）
+TRACK_LOD_MAX_DAYS = 31  # 一次请求最多覆盖的天数
+TRACK_LOD_MEMORY_DAYS = 64  # 内存中缓存的日文件数
+TRACK_LOD_ACTIVE_DEVICES = 16  # 后台刷新的设备数上限（超出时去掉最久未请求的设备）
+TRACK_LOD_ACTIVE_TTL_S = 3600.0  # 设备超过该时长没有 /track 请求即停止后台刷新
+TRACK_LOD_VERSION = 1
+WEB_MERCATOR_M_PER_PX = 156543.03392  # 缩放级别 0 时赤道处每像素对应的米数（256 像素瓦片）
+
+
+def encode_polyline(points: Iterable[tuple[float, float]], precision: int = 5) -> str:
+    """Google 编码折线：(纬度, 经度) 按 10^precision 取整后与上一点差分，每 5 位一组编码为可打印字符。"""
+
+    scale = 10**precision
+    out: list[str] = []
+    previous_lat = previous_lng = 0
+    for lat, lng in points:
+        int_lat, int_lng = round(lat * scale), round(lng * scale)
+        for delta in (int_lat - previous_lat, int_lng - previous_lng):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                out.append(chr((0x20 | (value & 0x1F)) + 63))
+                value >>= 5
+            out.append(chr(value + 63))
+        previous_lat, previous_lng = int_lat, int_lng
+    return "".join(out)
+
+
+def decode_polyline(text: str, precision: int = 5) -> list[tuple[float, float]]:
+    """encode_polyline 的逆过程，返回 (纬度, 经度) 列表。"""
+
+    scale = 10**precision
+    points: list[tuple[float, float]] = []
+    index = 0
+    coords = [0, 0]
+    while index < len(text):
+        for axis in (0, 1):
+            shift = result = 0
+            while True:
+                byte = ord(text[index]) - 63
+                index += 1
+                result |= (byte & 0x1F) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            coords[axis] += ~(result >> 1) if result & 1 else result >> 1
+        points.append((coords[0] / scale, coords[1] / scale))
+    return points
+
+
+def simplification_ranks(lats: list[float], lngs: list[float], floor_m: float = 0.0) -> list[float]:
+    """Douglas-Peucker 重要度：每个点在简化中被保留所需的容差上限（米），端点为无穷大。
+
+    只计算一次，任意容差下的简化结果就是重要度大于容差的点；子区间的重要度不超过父区间，
+    各级简化逐级包含，缩放时轨迹不会跳变。区间内最大偏差不超过 floor_m 时不再细分。
+    """
+
+    count = len(lats)
+    ranks = [0.0] * count
+    if not count:
+        return ranks
+    ranks[0] = ranks[-1] = math.inf
+    kx = math.cos(math.radians(lats[0])) * METERS_PER_DEGREE
+    xs = [(lng - lngs[0]) * kx for lng in lngs]
+    ys = [(lat - lats[0]) * METERS_PER_DEGREE for lat in lats]
+
+    stack = [(0, count - 1, math.inf)]
+    while stack:
+        first, last, cap = stack.pop()
+        if last - first < 2:
+            continue
+        ax, ay = xs[first], ys[first]
+        dx, dy = xs[last] - ax, ys[last] - ay
+        length = dx * dx + dy * dy
+        farthest, index = -1.0, first + 1
+        for i in range(first + 1, last):
+            px, py = xs[i] - ax, ys[i] - ay
+            t = min(1.0, max(0.0, (px * dx + py * dy) / length)) if length else 0.0
+            ex, ey = px - t * dx, py - t * dy
+            distance = ex * ex + ey * ey
+            if distance > farthest:
+                farthest, index = distance, i
+        rank = min(math.sqrt(farthest), cap)
+        if rank <= floor_m:
+            # 任何级别都不会保留这些点，不必继续细分（也避免共线点退化为平方复杂度）
+            for i in range(first + 1, last):
+                ranks[i] = rank
+            continue
+        ranks[index] = rank
+        stack.append((first, index, rank))
+        stack.append((index, last, rank))
+    return ranks
+
+
+def _beijing_day_start(day: date) -> float:
+    """北京日期零点的 Unix 时间戳。"""
+
+    return datetime(day.year, day.month, day.day, tzinfo=BEIJING_TZ).timestamp()
+
+
+class TrackPyramid:
+    """轨迹多分辨率金字塔：从历史查询构建各缩放级别的简化折线（编码折线），按 设备/北京日期 缓存在磁盘。
+
+    缓存为 <root>/<设备>/<YYYYMMDD>.json，每天按整点分为 24 块；小时结束 TRACK_LOD_SETTLE_S 秒后该块封闭，
+    之后只重建尚未封闭的末尾小时。每块内的轨迹在间隔超过 TRACK_LOD_GAP_S 处断开，
+    并带上前一小时的最后一点，使相邻小时的折线首尾相接。
+    """
+
+    def __init__(
+        self,
+        query: HistoryQuery,
+        root: Path,
+        pixel_tolerance: float = TRACK_LOD_PIXEL_TOLERANCE,
+        zooms: Iterable[int] = TRACK_LOD_ZOOMS,
+        refresh_interval: float = TRACK_LOD_REFRESH_INTERVAL,
+    ):
+        """pixel_tolerance 为各级别简化允许的误差（屏幕像素），未封闭的小时块最多每 refresh_interval 秒重建一次。"""
+
+        self.query = query
+        self.root = Path(root)
+        self.pixel_tolerance = pixel_tolerance
+        self.zooms = tuple(sorted(zooms))
+        self.refresh_interval = refresh_interval
+        # _lock 保护日文件文档与计数，只在读写文档时短暂持有；_build_lock 串行化历史扫描与重建
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._memory: Dict[Path, Dict[str, Any]] = {}
+        self._active: Dict[str, float] = {}  # 设备 -> 最近一次请求的 monotonic 时刻（按请求先后排序）
+        self._device_cache: tuple[float, set[str]] = (float("-inf"), set())
+        # 设备 -> {小时起点: 最近一次写入该小时记录的时刻}，只记录已封闭的小时（断线回填、回放等晚到的数据）
+        self._late: Dict[str, Dict[float, float]] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.requests = 0
+        self.chunks_built = 0
+        self.points_processed = 0
+        self.build_seconds = 0.0
+
+    # ------------------------ 查询 ------------------------
+    def level_for(self, zoom: float) -> int:
+        """不超过 zoom 的最大预计算级别，低于最小级别时取最小级别。"""
+
+        candidates = [level for level in self.zooms if level <= zoom]
+        return candidates[-1] if candidates else self.zooms[0]
+
+    def track(self, device_id: str, start: float, end: float, zoom: float) -> Dict[str, Any]:
+        """返回时间范围内与该缩放级别对应的折线段（按小时块内的连续轨迹划分，时间粒度为折线段）。
+
+        缺失的块先构建，未封闭的末尾小时超过刷新间隔才重建；最近请求过的设备由后台线程刷新。
+        """
+
+        if end < start:
+            raise ValueError("结束时间早于起始时间")
+        first_day = datetime.fromtimestamp(start, BEIJING_TZ).date()
+        last_day = datetime.fromtimestamp(end, BEIJING_TZ).date()
+        if (last_day - first_day).days >= TRACK_LOD_MAX_DAYS:
+            raise ValueError(f"时间范围超过 {TRACK_LOD_MAX_DAYS} 天")
+
+        if not self._known_device(device_id):
+            raise ValueError(f"没有该设备的历史数据: {device_id}")
+
+        level = str(self.level_for(zoom))
+        segments: list[Dict[str, Any]] = []
+        self._touch(device_id)
+        days = self._ensure(device_id, first_day, last_day, time.time(), self.refresh_interval)
+        with self._lock:
+            self.requests += 1
+            for doc in [self._load(device_id, day) for day in days]:
+                for hour in sorted(doc["hours"], key=int):
+                    for run in doc["hours"][hour]["runs"]:
+                        if run["end"] >= start and run["start"] <= end:
+                            segments.append(
+                                {
+                                    "start": run["start"],
+                                    "end": run["end"],
+                                    "points": run["kept"][level],
+                                    "polyline": run["polylines"][level],
+                                }
+                            )
+        return {
+            "device": device_id,
+            "zoom": int(level),
+            "start": start,
+            "end": end,
+            "points": sum(segment["points"] for segment in segments),
+            "segments": segments,
+        }
+
+    def _known_device(self, device_id: str) -> bool:
+        """设备是否有历史数据；设备列表（JSON Lines 后端需要全量扫描）最多每 refresh_interval 秒重新读取一次。"""
+
+        key = BinaryHistoryStore.device_dirname(device_id) if self.query.binary_store is not None else device_id
+        loaded, devices = self._device_cache
+        if key not in devices and time.monotonic() - loaded >= max(self.refresh_interval, 1.0):
+            devices = set(self.query.devices())
+            self._device_cache = (time.monotonic(), devices)
+        return key in devices
+
+    def _touch(self, device_id: str):
+        """记录设备的请求时刻，超过 TRACK_LOD_ACTIVE_DEVICES 个时去掉最久未请求的设备。"""
+
+        with self._lock:
+            self._active.pop(device_id, None)
+            self._active[device_id] = time.monotonic()
+            while len(self._active) > TRACK_LOD_ACTIVE_DEVICES:
+                self._active.pop(next(iter(self._active)))
+
+    def note_record(self, record: Dict[str, Any]):
+        """历史写入器提交记录时调用：记录落在已封闭的小时里时标记该小时，下次请求到该小时时重建。"""
+
+        ts = history_timestamp_to_epoch(record.get("timestamp"))
+        device_id = record.get("deviceId")
+        if ts is None or not device_id:
+            return
+        hour = math.floor(ts / 3600) * 3600
+        now = time.time()
+        if now < hour + 3600 + TRACK_LOD_SETTLE_S:
+            return  # 尚未封闭的小时按刷新间隔重建
+        with self._lock:
+            self._late.setdefault(str(device_id), {})[hour] = now
+
+    # ------------------------ 构建 ------------------------
+    def refresh(self, device_id: str, now: Optional[float] = None):
+        """立即重建设备尚未封闭的小时（跨零点后也包括前一天的最后一小时）。"""
+
+        now = time.time() if now is None else now
+        first_day = datetime.fromtimestamp(now - 3600 - TRACK_LOD_SETTLE_S, BEIJING_TZ).date()
+        self._ensure(device_id, first_day, datetime.fromtimestamp(now, BEIJING_TZ).date(), now, 0.0)
+
+    def build(
+        self, device_id: Optional[str] = None, start: Optional[float] = None, end: Optional[float] = None
+    ) -> Dict[str, Any]:
+        """一次流式读取历史，重建指定设备（缺省为全部设备）在时间范围内的全部小时块，返回构建统计。"""
+
+        now = time.time()
+        devices = [device_id] if device_id else self.query.devices()
+        chunks, points, started = self.chunks_built, self.points_processed, time.perf_counter()
+        with self._build_lock:
+            for device in devices:
+                self._build(
+                    device,
+                    math.floor(start / 3600) * 3600 if start is not None else None,
+                    math.ceil(end / 3600) * 3600 if end is not None else None,
+                    now,
+                )
+        return {
+            "devices": len(devices),
+            "chunks": self.chunks_built - chunks,
+            "points": self.points_processed - points,
+            "elapsed_s": round(time.perf_counter() - started, 3),
+        }
+
+    def _ensure(self, device_id: str, first_day: date, last_day: date, now: float, max_age: float) -> list[date]:
+        """用一次历史扫描重建日期范围内缺失或过期的小时块，返回日期列表（调用方持 _lock 读取日文件）。
+
+        已封闭的小时在生成之后又写入了记录时也视为过期，单独重建；写入器批量落盘有延迟，
+        标记之后 TRACK_LOD_SETTLE_S 秒内按刷新间隔再重建，之后清除标记。
+        """
+
+        days = [first_day + timedelta(days=offset) for offset in range((last_day - first_day).days + 1)]
+        with self._build_lock:
+            stale_start = stale_end = None
+            late: list[float] = []
+            with self._lock:
+                marks = self._late.get(device_id, {})
+                for day in days:
+                    doc = self._load(device_id, day)
+                    day_start = _beijing_day_start(day)
+                    for hour in range(24):
+                        hour_start = day_start + hour * 3600
+                        if hour_start > now:
+                            break
+                        chunk = doc["hours"].get(str(hour))
+                        marked = marks.get(hour_start)
+                        if chunk is None or (not chunk["final"] and now - chunk["built"] >= max_age):
+                            stale_start = hour_start if stale_start is None else stale_start
+                            stale_end = hour_start + 3600
+                        elif marked is not None and chunk["built"] < marked + TRACK_LOD_SETTLE_S:
+                            if chunk["built"] < marked or now - chunk["built"] >= max_age:
+                                late.append(hour_start)
+                        elif marked is not None:
+                            del marks[hour_start]
+            if stale_start is not None:
+                self._build(device_id, stale_start, stale_end, now)
+            late = [hour for hour in late if stale_start is None or not stale_start <= hour < stale_end]
+            if late:
+                self._rebuild_hours(device_id, late, now)
+        return days
+
+    def _build(self, device_id: str, start: Optional[float], end: Optional[float], now: float):
+        """流式读取 [start, end) 的历史（start/end 为整点，None 表示从最早/到最晚的记录），逐小时生成块并写入日文件。
+
+        每个定位按自身时间归入小时；历史通常按时间顺序写入，扫描越过某小时一小时以上才生成该块。
+        更早小时的定位在之后才出现时（断线回填、回放）记下该小时，扫描结束后由 _rebuild_hours 重建。
+        调用方持有 _build_lock；扫描历史时不持 _lock，只在写入文档时短暂持有，不阻塞缓存命中的请求。
+        """
+
+        started = time.perf_counter()
+        cursor = start
+        lead: Optional[tuple] = None
+        pending: Dict[float, list[tuple]] = {}
+        late: set[float] = set()
+        current: Optional[tuple[Path, Dict[str, Any]]] = None
+
+        def emit():
+            """生成 cursor 所在小时的块，写入对应的日文件。"""
+
+            nonlocal current, lead
+            points = pending.pop(cursor, [])
+            current = self._store_chunk(device_id, cursor, self._build_chunk(points, lead, cursor, now), current)
+            if points:
+                lead = points[-1]  # _build_chunk 已按时间排序
+
+        for fix in self.query.iter_fixes(device_id, start - TRACK_LOD_GAP_S if start is not None else None, end):
+            try:
+                point = (float(fix["ts"]), float(fix["lat"]), float(fix["lng"]))
+            except (KeyError, TypeError, ValueError):
+                continue
+            if start is not None and point[0] < start:
+                if lead is None or point[0] > lead[0]:
+                    lead = point
+                continue
+            if end is not None and point[0] >= end:
+                continue
+            hour = math.floor(point[0] / 3600) * 3600
+            if cursor is None:
+                cursor = hour
+            if hour < cursor:
+                late.add(hour)
+                continue
+            pending.setdefault(hour, []).append(point)
+            while cursor < hour - 3600:
+                emit()
+                cursor += 3600
+
+        if cursor is not None:
+            last = end if end is not None else max([cursor, *pending]) + 3600
+            while cursor < last and cursor <= now:
+                emit()
+                cursor += 3600
+        if current is not None:
+            self._save(*current)
+        if late:
+            self._rebuild_hours(device_id, late, now)
+        self.build_seconds += time.perf_counter() - started
+
+    def _rebuild_hours(self, device_id: str, hours: Iterable[float], now: float):
+        """重建若干（不必相邻的）小时块：一次扫描覆盖这些小时，只保留其中的定位与各小时开头前的衔接点。"""
+
+        buckets: Dict[float, list[tuple]] = {hour: [] for hour in hours}
+        leads: Dict[float, tuple] = {}
+        for fix in self.query.iter_fixes(device_id, min(buckets) - TRACK_LOD_GAP_S, max(buckets) + 3600):
+            try:
+                point = (float(fix["ts"]), float(fix["lat"]), float(fix["lng"]))
+            except (KeyError, TypeError, ValueError):
+                continue
+            hour = math.floor(point[0] / 3600) * 3600
+            if hour in buckets:
+                buckets[hour].append(point)
+            following = hour + 3600
+            if following in buckets and point[0] >= following - TRACK_LOD_GAP_S:
+                if following not in leads or point[0] > leads[following][0]:
+                    leads[following] = point
+
+        current: Optional[tuple[Path, Dict[str, Any]]] = None
+        for hour in sorted(buckets):
+            chunk = self._build_chunk(buckets.pop(hour), leads.get(hour), hour, now)
+            current = self._store_chunk(device_id, hour, chunk, current)
+        if current is not None:
+            self._save(*current)
+
+    def _store_chunk(
+        self, device_id: str, hour_start: float, chunk: Dict[str, Any], current: Optional[tuple[Path, Dict[str, Any]]]
+    ) -> tuple[Path, Dict[str, Any]]:
+        """把小时块写入所在日文件的文档（换到另一天时先保存上一天），返回当前的 (路径, 文档)。"""
+
+        moment = datetime.fromtimestamp(hour_start, BEIJING_TZ)
+        path = self._day_path(device_id, moment.date())
+        if current is not None and current[0] != path:
+            self._save(*current)
+        with self._lock:
+            if current is None or current[0] != path:
+                current = (path, self._load(device_id, moment.date()))
+            current[1]["hours"][str(moment.hour)] = chunk
+        return current
+
+    def _build_chunk(self, points: list[tuple], lead: Optional[tuple], hour_start: float, now: float) -> Dict[str, Any]:
+        """把一小时的定位（按时间排序，必要时以前一小时的最后一点开头）切分为连续轨迹并逐段简化。"""
+
+        points.sort()
+        count = len(points)
+        if lead is not None and points and 0 < points[0][0] - lead[0] <= TRACK_LOD_GAP_S:
+            points = [lead] + points
+        runs: list[list[tuple]] = []
+        for point in points:
+            if not runs or point[0] - runs[-1][-1][0] > TRACK_LOD_GAP_S:
+                runs.append([])
+            runs[-1].append(point)
+        self.chunks_built += 1
+        self.points_processed += count
+        return {
+            "final": now >= hour_start + 3600 + TRACK_LOD_SETTLE_S,
+            "built": round(now, 3),
+            "points": count,
+            "runs": [self._build_run(run) for run in runs],
+        }
+
+    def _build_run(self, run: list[tuple]) -> Dict[str, Any]:
+        """一段连续轨迹：计算一次简化重要度，再按各级别的米级容差（像素容差 × 该纬度每像素米数）取点编码。"""
+
+        lats = [point[1] for point in run]
+        lngs = [point[2] for point in run]
+        metres_per_px = WEB_MERCATOR_M_PER_PX * math.cos(math.radians(sum(lats) / len(lats)))
+        tolerances = {level: self.pixel_tolerance * metres_per_px / 2**level for level in self.zooms}
+        ranks = simplification_ranks(lats, lngs, floor_m=min(tolerances.values()))
+        polylines: Dict[str, str] = {}
+        kept: Dict[str, int] = {}
+        for level, tolerance in tolerances.items():
+            selected = [(lat, lng) for lat, lng, rank in zip(lats, lngs, ranks) if rank > tolerance]
+            polylines[str(level)] = encode_polyline(selected)
+            kept[str(level)] = len(selected)
+        return {"start": run[0][0], "end": run[-1][0], "kept": kept, "polylines": polylines}
+
+    # ------------------------ 缓存文件 ------------------------
+    def _day_path(self, device_id: str, day: date) -> Path:
+        """日文件路径。"""
+
+        return self.root / BinaryHistoryStore.device_dirname(device_id) / f"{day:%Y%m%d}.json"
+
+    def _load(self, device_id: str, day: date) -> Dict[str, Any]:
+        """读取日文件（优先取内存缓存）；不存在、损坏或参数已变化时返回空文档。"""
+
+        path = self._day_path(device_id, day)
+        doc = self._memory.pop(path, None)
+        if doc is None:
+            try:
+                doc = json.loads(path.read_text(encoding="utf-8"))
+            except FileNotFoundError:
+                doc = None
+            except (OSError, ValueError) as exc:
+                logging.warning("轨迹金字塔缓存无法读取，将重建: %s（%s）", path, exc)
+                doc = None
+            signature = (TRACK_LOD_VERSION, self.pixel_tolerance, list(self.zooms))
+            if doc is None or (doc.get("version"), doc.get("pixel_tolerance"), doc.get("zooms")) != signature:
+                doc = {
+                    "version": TRACK_LOD_VERSION,
+                    "device": device_id,
+                    "day": f"{day:%Y%m%d}",
+                    "pixel_tolerance": self.pixel_tolerance,
+                    "zooms": list(self.zooms),
+                    "hours": {},
+                }
+        self._memory[path] = doc
+        while len(self._memory) > TRACK_LOD_MEMORY_DAYS:
+            self._memory.pop(next(iter(self._memory)))
+        return doc
+
+    def _save(self, path: Path, doc: Dict[str, Any]):
+        """原子写入日文件，失败时只记录警告（内存中的结果仍可使用）。"""
+
+        tmp = path.with_name(path.name + ".tmp")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp.write_text(json.dumps(doc, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+            os.replace(tmp, path)
+        except OSError as exc:
+            logging.warning("轨迹金字塔缓存写入失败: %s（%s）", path, exc)
+
+    # ------------------------ 后台刷新 ------------------------
+    def start(self):
+        """启动后台线程，每 refresh_interval 秒刷新最近请求过的设备的末尾小时（间隔为 0 时不启动）。"""
+
+        if self.refresh_interval <= 0 or self._thread:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._refresh_loop, name="track-lod", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止后台刷新。"""
+
+        self._stop.set()
+        thread, self._thread = self._thread, None
+        if thread and thread is not threading.current_thread():
+            thread.join(timeout=5)
+
+    def _refresh_loop(self):
+        """刷新线程主循环。"""
+
+        while not self._stop.wait(self.refresh_interval):
+            cutoff = time.monotonic() - TRACK_LOD_ACTIVE_TTL_S
+            with self._lock:
+                for device_id, requested in list(self._active.items()):
+                    if requested < cutoff:
+                        del self._active[device_id]
+                devices = list(self._active)
+            for device_id in devices:
+                try:
+                    self.refresh(device_id)
+                except Exception as exc:  # noqa: BLE001
+                    logging.error("刷新轨迹金字塔失败: %s", exc)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回请求与构建计数。"""
+
+        with self._lock:
+            devices = sorted(self._active)
+        return {
+            "requests": self.requests,
+            "chunks_built": self.chunks_built,
+            "points_processed": self.points_processed,
+            "build_s": round(self.build_seconds, 3),
+            "cached_days": len(self._memory),
+            "devices": devices,
+        }
+
+
+class _HistoryRequestHandler(BaseHTTPRequestHandler):
+    """历史查询 HTTP 接口：GET /devices、GET /history、GET /track（按缩放级别的简化轨迹）与 GET /trips（行程摘要）。"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):  # noqa: N802 - BaseHTTPRequestHandler 约定
+        """根据路径分发请求。"""
+
+        url = urllib.parse.urlsplit(self.path)
+        params = {key: values[-1] for key, values in urllib.parse.parse_qs(url.query).items()}
+        query: HistoryQuery = self.server.history_query  # type: ignore[attr-defined]
+
+        if url.path == "/devices":
+            self._send_json(200, {"devices": query.devices()})
+            return
+        if url.path == "/track":
+            self._send_track(params)
+            return
+        if url.path == "/trips":
+            self._send_trips(query, params)
+            return
+        if url.path != "/history":
+            self._send_json(404, {"error": f"未知的路径: {url.path}"})
+            return
+
+        try:
+            output_format = params.get("format", "ndjson")
+            if output_format not in {"ndjson", "json"}:
+                raise ValueError(f"未知的输出格式: {output_format}")
+            fixes = query.iter_fixes(
+                device_id=params.get("device") or None,
+                start=parse_query_time(params["start"]) if params.get("start") else None,
+                end=parse_query_time(params["end"]) if params.get("end") else None,
+                bbox=parse_query_bbox(params["bbox"]) if params.get("bbox") else None,
+                limit=int(params["limit"]) if params.get("limit") else None,
+            )
+        except ValueError as exc:
+            self._send_json(400, {"error": str(exc)})
+            return
+
+        self.send_response(200)
+        content_type = "application/x-ndjson" if output_format == "ndjson" else "application/json"
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+
+        def write_chunk(text: str):
+            data = text.encode("utf-8")
+            self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+
+        try:
+            write_query_results(fixes, output_format, write_chunk)
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            logging.debug("历史查询客户端已断开")
+        except Exception as exc:  # noqa: BLE001
+            logging.error("历史查询失败: %s", exc)
+            self.close_connection = True
+
+    def _send_track(self, params: Dict[str, str]):
+        """GET /track?device=&start=&end=&zoom=：返回该缩放级别的编码折线，缺省为最近 24 小时、最高级别。"""
+
+        pyramid: Optional[TrackPyramid] = getattr(self.server, "track_pyramid", None)
+        if pyramid is None:
+            self._send_json(404, {"error": "未启用轨迹金字塔"})
+            return
+        try:
+            device_id = params.get("device")
+            if not device_id:
+                raise ValueError("缺少 device 参数")
+            end = parse_query_time(params["end"]) if params.get("end") else time.time()
+            start = parse_query_time(params["start"]) if params.get("start") else end - 86400
+            zoom = float(params["zoom"]) if params.get("zoom") else pyramid.zooms[-1]
+            result = pyramid.track(device_id, start, end, zoom)
+        except ValueError as exc:
+            self._send_json(400, {"error": str(exc)})
+            return
+        self._send_json(200, result)
+
+    def _send_trips(self, query: HistoryQuery, params: Dict[str, str]):
+        """GET /trips?device=&start=&end=：返回时间范围内（缺省为最近 24 小时）的行程摘要，省略 device 时统计全部设备。"""
+
+        try:
+            end = parse_query_time(params["end"]) if params.get("end") else time.time()
+            start = parse_query_time(params["start"]) if params.get("start") else end - 86400
+            device_id = params.get("device") or None
+            options = getattr(self.server, "trip_options", None) or {}
+            trips = list(summarize_trips(query, device_id, start, end, **options))
+        except ValueError as exc:
+            self._send_json(400, {"error": str(exc)})
+            return
+        self._send_json(200, {"device": device_id, "start": start, "end": end, "trips": trips})
+
+    def _send_json(self, status: int, payload: Dict[str, Any]):
+        """发送一个完整的 JSON 响应。"""
+
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args: Any):  # noqa: A002 - 与父类签名一致
+        """将访问日志转到 logging 的调试级别。"""
+
+        logging.debug("历史查询 %s - %s", self.address_string(), format % args)
+
+
+def start_history_http_server(
+    query: HistoryQuery,
+    host: str,
+    port: int,
+    pyramid: Optional[TrackPyramid] = None,
+    trip_settings: Optional[Dict[str, float]] = None,
+) -> ThreadingHTTPServer:
+    """在后台线程启动历史查询 HTTP 服务并返回服务对象。
+
+    给出 pyramid 时提供 GET /track；trip_settings 为 GET /trips 的行程切分参数（见 trip_options），缺省用默认值。
+    """
+
+    server = ThreadingHTTPServer((host, port), _HistoryRequestHandler)
+    server.daemon_threads = True
+    server.history_query = query  # type: ignore[attr-defined]
+    server.track_pyramid = pyramid  # type: ignore[attr-defined]
+    server.trip_options = trip_settings  # type: ignore[attr-defined]
+    threading.Thread(target=server.serve_forever, name="history-http", daemon=True).start()
+    logging.info("历史查询服务已启动: http://%s:%s/history", host, server.server_address[1])
+    return server
+
+
+def build_track_pyramid(config: "PublisherConfig", query: HistoryQuery) -> Optional[TrackPyramid]:
+    """按配置构造轨迹金字塔，未配置缓存目录时返回 None。"""
+
+    if not config.track_lod_dir:
+        return None
+    return TrackPyramid(
+        query,
+        config.track_lod_dir,
+        pixel_tolerance=config.track_lod_pixel_tolerance,
+        refresh_interval=config.track_lod_refresh_interval,
+    )
+
+
+def _manual_point(record: Dict[str, Any]) -> Dict[str, Any]:
+    """把一行记录规范为手动发布点：经纬度必需，速度、时间与设备 ID 可选。"""
+
+    def pick(*names: str) -> Any:
+        for name in names:
+            value = record.get(name)
+            if value not in (None, ""):
+                return value
+        return None
+
+    longitude = pick("lng", "longitude", "lon")
+    latitude = pick("lat", "latitude")
+    if longitude is None or latitude is None:
+        raise ValueError("缺少经纬度")
+
+    point: Dict[str, Any] = {
+        "longitude": float(longitude),
+        "latitude": float(latitude),
+        "speed_ms": float(pick("speed_ms", "speed") or 0.0),
+    }
+    stamp = pick("time", "timestamp")
+    if stamp is not None:
+        point["time"] = parse_query_time(str(stamp))
+    device_id = pick("device_id", "deviceId")
+    if device_id:
+        point["device_id"] = str(device_id)
+    return point
+
+
+def iter_manual_points(lines: Iterable[str]) -> Iterator[Dict[str, Any]]:
+    """逐行解析手动发布点：JSONL（每行一个对象）或 CSV（可带表头，无表头时按 lng,lat,speed,time 顺序）。
+
+    字段：lng/longitude、lat/latitude、speed/speed_ms（m/s）、time/timestamp（Unix 时间、
+    "YYYY/MM/DD HH:MM:SS" 北京时间或 ISO 8601）、device_id；无法解析的行记录警告后跳过。
+    """
+
+    header: Optional[list[str]] = None
+    for number, line in enumerate(lines, 1):
+        text = line.strip()
+        if not text or text.startswith("#"):
+            continue
+        try:
+            if text.startswith("{"):
+                record = json.loads(text)
+            else:
+                row = [value.strip() for value in next(csv.reader([text]))]
+                if header is None and row and not row[0].lstrip("+-").replace(".", "", 1).isdigit():
+                    header = [name.lower() for name in row]
+                    continue
+                record = dict(zip(header or ("lng", "lat", "speed", "time"), row))
+            point = _manual_point(record)
+        except (ValueError, TypeError, AttributeError) as exc:
+            logging.warning("第 %d 行无法解析，已跳过: %s", number, exc)
+            continue
+        yield point
+
+
+def parse_replay_speed(value: str) -> Optional[float]:
+    """解析回放速度："max" 返回 None（不等待），"10x" 或 "10" 返回倍速。"""
+
+    text = value.strip().lower()
+    if text == "max":
+        return None
+    speed = float(text[:-1] if text.endswith("x") else text)
+    if speed <= 0:
+        raise ValueError(f"回放速度必须大于 0: {value}")
+    return speed
+
+
+# 各语句中 UTC 时间字段的位置
+_NMEA_TIME_FIELD = {b"RMC": 1, b"GGA": 1, b"GLL": 5}
+
+
+def nmea_line_seconds(line: bytes) -> Optional[float]:
+    """取出 RMC/GGA/GLL 语句中的 UTC 时间（当天秒数，保留小数），其他语句返回 None。"""
+
+    fields = line.split(b",", 6)
+    index = _NMEA_TIME_FIELD.get(fields[0][-3:])
+    if index is None or len(fields) <= index or len(fields[index]) < 6:
+        return None
+    value = fields[index]
+    try:
+        return int(value[:2]) * 3600 + int(value[2:4]) * 60 + float(value[4:])
+    except ValueError:
+        return None
+
+
+def nmea_capture_day(lines: Iterable[bytes], limit: int = 10000) -> Optional[float]:
+    """根据前 limit 行中第一条带日期的 RMC 语句，返回记录第一条带时间语句所在 UTC 日零点的 Unix 时间戳。
+
+    找不到日期时返回 None；日期之前跨越 UTC 零点的情况按时间回绕扣除。
+    """
+
+    last: Optional[float] = None
+    days = 0
+    for line in itertools.islice(lines, limit):
+        moment = nmea_line_seconds(line)
+        if moment is None:
+            continue
+        if last is not None and moment < last - 43200:
+            days += 1
+        last = moment
+        fields = line.split(b",", 10)
+        if fields[0][-3:] != b"RMC" or len(fields) < 10 or len(fields[9]) != 6:
+            continue
+        value = fields[9]
+        try:
+            day = calendar.timegm((2000 + int(value[4:6]), int(value[2:4]), int(value[0:2]), 0, 0, 0))
+        except ValueError:
+            continue
+        return float(day - days * 86400)
+    return None
+
+
+# UM220-III 配置命令模板（Unicore 协议，命令无需校验和）；固件版本不同时在此调整
+UM220_COMMANDS: Dict[str, str] = {
+    "baud": "$CFGPRT,1,0,{baud},3,3",  # 当前 UART 的波特率，输入输出均为 NMEA
+    "rate": "$CFGNAV,{interval_ms},{interval_ms},1000",  # 定位与输出间隔（毫秒）
+    "disable_all": "$CFGMSG,0,,0",  # 关闭所有 NMEA 输出
+    "enable": "$CFGMSG,0,{message_id},1",  # 每个定位历元输出一次该语句
+}
+UM220_MESSAGE_IDS: Dict[str, int] = {"GGA": 0, "GLL": 1, "GSA": 2, "GSV": 3, "RMC": 4, "VTG": 5, "ZDA": 6}
+# 各语句的典型长度（字节，GSV 按 4 条计），用于估算串口占用率
+NMEA_SENTENCE_BYTES: Dict[str, int] = {"GGA": 75, "GLL": 52, "GSA": 66, "GSV": 280, "RMC": 72, "VTG": 40, "ZDA": 38}
+RECEIVER_RATES = (1.0, 2.0, 5.0, 10.0)
+RECEIVER_BAUDRATES = (9600, 19200, 38400, 57600, 115200, 230400, 460800)
+RECEIVER_COMMAND_GAP = 0.05  # 接收机不回应答时命令之间的间隔（秒）
+RECEIVER_UART_BUDGET = 0.8  # 输出字节率超过串口容量的该比例即视为饱和
+
+
+@dataclass(frozen=True)
+class ReceiverProfile:
+    """声明式接收机配置：启用哪些语句、输出频率（0 表示保持接收机当前设置）与目标波特率（0 表示不切换）。"""
+
+    sentences: tuple[str, ...] = RECEIVER_SENTENCES
+    rate_hz: float = RECEIVER_RATE_HZ
+    baudrate: int = RECEIVER_BAUDRATE
+
+    def validate(self):
+        """检查语句、频率与波特率是否受支持，不支持时抛出 ValueError。"""
+
+        unknown = [name for name in self.sentences if name not in UM220_MESSAGE_IDS]
+        if unknown or not self.sentences:
+            raise ValueError(f"不支持的语句: {', '.join(unknown) or '空'}（可选: {', '.join(UM220_MESSAGE_IDS)}）")
+        if self.rate_hz and self.rate_hz not in RECEIVER_RATES:
+            raise ValueError(f"不支持的输出频率: {self.rate_hz:g} Hz（可选: {', '.join(f'{r:g}' for r in RECEIVER_RATES)}）")
+        if self.baudrate and self.baudrate not in RECEIVER_BAUDRATES:
+            raise ValueError(f"不支持的波特率: {self.baudrate}（可选: {', '.join(map(str, RECEIVER_BAUDRATES))}）")
+
+    def bytes_per_second(self) -> float:
+        """按典型语句长度估算的输出字节率。"""
+
+        return sum(NMEA_SENTENCE_BYTES[name] for name in self.sentences) * (self.rate_hz or 1.0)
+
+    def minimum_baudrate(self) -> int:
+        """不超过串口预算的最低标准波特率（8N1 每字节 10 位）。"""
+
+        for baudrate in RECEIVER_BAUDRATES:
+            if self.bytes_per_second() <= baudrate / 10 * RECEIVER_UART_BUDGET:
+                return baudrate
+        return RECEIVER_BAUDRATES[-1]
+
+    def setup_commands(self) -> list[bytes]:
+        """切换波特率之后依次发送的命令：关闭全部输出、设置频率、逐条启用语句。"""
+
+        commands = [UM220_COMMANDS["disable_all"]]
+        if self.rate_hz:
+            interval_ms = round(1000 / self.rate_hz)
+            commands.append(UM220_COMMANDS["rate"].format(interval_ms=interval_ms))
+        commands.extend(
+            UM220_COMMANDS["enable"].format(message_id=UM220_MESSAGE_IDS[name]) for name in self.sentences
+        )
+        return [f"{command}\r\n".encode("ascii") for command in commands]
+
+
+def _valid_nmea_line(line: bytes) -> bool:
+    """是否为校验和正确的 NMEA 语句（用于确认波特率切换成功）。"""
+
+    line = line.strip()
+    star = line.rfind(b"*")
+    if not line.startswith(b"$") or star < 0:
+        return False
+    try:
+        return nmea_checksum(line[1:star]) == int(line[star + 1 : star + 3], 16)
+    except ValueError:
+        return False
+
+
+class ReceiverConfigurator:
+    """按 ReceiverProfile 配置接收机：每条命令等待应答（命令回显或 $OK）而不是固定休眠，
+    最后等到启用的语句各出现一次即完成。接收机不回应答时，第一条命令超时后其余命令改为短间隔连续发送，
+    由最终出现的语句确认配置生效。
+    """
+
+    def __init__(self, ser: serial.Serial, profile: ReceiverProfile, ack_timeout: float = RECEIVER_ACK_TIMEOUT):
+        """ser 为已打开的串口，配置期间独占读取。"""
+
+        self.ser = ser
+        self.profile = profile
+        self.ack_timeout = ack_timeout
+        self._acks_supported: Optional[bool] = None
+        self.acked = 0
+        self.unacked = 0
+
+    def apply(self) -> Dict[str, Any]:
+        """执行配置并返回报告（耗时、应答数、最终波特率与是否确认到全部语句）。"""
+
+        started = time.monotonic()
+        original_timeout = self.ser.timeout
+        self.ser.timeout = RECEIVER_COMMAND_GAP
+        baud_switched = None
+        try:
+            if self.profile.baudrate and self.profile.baudrate != self.ser.baudrate:
+                baud_switched = self._switch_baud(self.profile.baudrate)
+            self._check_bandwidth()
+            for command in self.profile.setup_commands():
+                self._send(command)
+            verified = self._verify()
+        finally:
+            self.ser.timeout = original_timeout
+
+        report = {
+            "sentences": list(self.profile.sentences),
+            "rate_hz": self.profile.rate_hz or None,
+            "baudrate": self.ser.baudrate,
+            "baud_switched": baud_switched,
+            "acked": self.acked,
+            "unacked": self.unacked,
+            "verified": verified,
+            "elapsed_ms": round((time.monotonic() - started) * 1000, 1),
+        }
+        logging.info(
+            "接收机配置%s: %s @ %s Hz，%d 波特，耗时 %.0f ms（应答 %d，未应答 %d）",
+            "完成" if verified else "未确认",
+            ",".join(self.profile.sentences),
+            f"{self.profile.rate_hz:g}" if self.profile.rate_hz else "默认",
+            self.ser.baudrate,
+            report["elapsed_ms"],
+            self.acked,
+            self.unacked,
+        )
+        return report
+
+    def _write(self, command: bytes):
+        """写入一条命令。"""
+
+        self.ser.write(command)
+        logging.info("发送配置命令: %s", command.decode("ascii").strip())
+
+    def _send(self, command: bytes) -> bool:
+        """发送命令并等待应答；已确认接收机不回应答时只保留短间隔。"""
+
+        self._write(command)
+        head = command.split(b",", 1)[0]
+        if self._acks_supported is False:
+            self._read_until(lambda line: line.startswith(head) or line.startswith(b"$OK"), RECEIVER_COMMAND_GAP)
+            return False
+
+        if self._read_until(lambda line: line.startswith(head) or line.startswith(b"$OK"), self.ack_timeout):
+            self._acks_supported = True
+            self.acked += 1
+            return True
+        if self._acks_supported is None:
+            logging.info("接收机未回应配置命令，后续命令改为连续发送，以输出语句确认")
+            self._acks_supported = False
+        self.unacked += 1
+        return False
+
+    def _switch_baud(self, baudrate: int) -> bool:
+        """切换接收机与本机串口的波特率，新波特率下收到有效语句即成功，否则恢复原波特率。"""
+
+        previous = self.ser.baudrate
+        self._write(UM220_COMMANDS["baud"].format(baud=baudrate).encode("ascii") + b"\r\n")
+        self.ser.flush()
+        time.sleep(RECEIVER_COMMAND_GAP)
+        self.ser.baudrate = baudrate
+        self.ser.reset_input_buffer()
+        if self._read_until(_valid_nmea_line, max(2.0, 3.0 / (self.profile.rate_hz or 1.0))):
+            logging.info("串口波特率已切换: %d -> %d", previous, baudrate)
+            return True
+        logging.warning("切换到 %d 波特后未收到有效语句，恢复 %d 波特", baudrate, previous)
+        self.ser.baudrate = previous
+        self.ser.reset_input_buffer()
+        return False
+
+    def _check_bandwidth(self):
+        """估算的输出字节率超过串口预算时给出建议波特率（高频率下串口饱和会导致语句堆积和丢失）。"""
+
+        needed = self.profile.bytes_per_second()
+        capacity = self.ser.baudrate / 10
+        if needed > capacity * RECEIVER_UART_BUDGET:
+            logging.warning(
+                "预计输出 %.0f 字节/秒，占 %d 波特串口容量的 %.0f%%，建议使用 --receiver-baud %d 或减少语句",
+                needed,
+                self.ser.baudrate,
+                needed / capacity * 100,
+                self.profile.minimum_baudrate(),
+            )
+
+    def _verify(self) -> bool:
+        """等到启用的每种语句都出现一次（最多约 2.5 个输出周期）。"""
+
+        waiting = {name.encode("ascii") for name in self.profile.sentences}
+        timeout = max(1.5, 2.5 / (self.profile.rate_hz or 1.0))
+
+        def seen(line: bytes) -> bool:
+            sentence_id = line.strip()[3:6]
+            if sentence_id in waiting and _valid_nmea_line(line):
+                waiting.discard(sentence_id)
+            return not waiting
+
+        return self._read_until(seen, timeout) is not None
+
+    def _read_until(self, predicate: Callable[[bytes], bool], timeout: float) -> Optional[bytes]:
+        """读取串口直到某行满足 predicate 或超时，返回该行。"""
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            line = self.ser.readline()
+            if line and predicate(line):
+                return line
+        return None
+
+
+SERIAL_PROBE_DWELL = 1.2  # 每个波特率最多等待的秒数（1 Hz 输出下足以收到一组语句）
+SERIAL_PROBE_MIN_LINES = 2  # 连续收到几条校验正确的语句才认定端口与波特率
+
+
+@dataclass(frozen=True)
+class SerialProbeResult:
+    """探测到的 GPS 串口：设备路径、波特率与 USB 序列号（用于重新枚举后找回同一设备）。"""
+
+    port: str
+    baudrate: int
+    serial_number: Optional[str] = None
+    source: str = "probe"  # "config" 配置指定、"cache" 上次结果、"probe" 本次探测
+    elapsed_ms: float = 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        """状态消息与缓存文件使用的字典。"""
+
+        return {
+            "port": self.port,
+            "baudrate": self.baudrate,
+            "serial_number": self.serial_number,
+            "source": self.source,
+            "elapsed_ms": self.elapsed_ms,
+        }
+
+
+def _await_valid_nmea(
+    ser: serial.Serial, timeout: float, needed: int = SERIAL_PROBE_MIN_LINES, stop: Optional[threading.Event] = None
+) -> Optional[bool]:
+    """读取串口直到连续收到 needed 条校验正确的语句：成功返回 True，有数据但无效返回 False，完全无数据返回 None。"""
+
+    deadline = time.monotonic() + timeout
+    received = False
+    valid = 0
+    while time.monotonic() < deadline and not (stop and stop.is_set()):
+        line = ser.readline()
+        if not line:
+            continue
+        received = True
+        valid = valid + 1 if _valid_nmea_line(line) else 0
+        if valid >= needed:
+            return True
+    return False if received else None
+
+
+def _probe_one_port(
+    device: str, baudrates: tuple[int, ...], deadline: float, stop: threading.Event
+) -> Optional[int]:
+    """依次尝试各波特率，返回输出有效 NMEA 的波特率；端口无法打开、第一个波特率下毫无数据或超时返回 None。"""
+
+    try:
+        ser = serial.Serial(port=device, baudrate=baudrates[0], timeout=0.2)
+    except (serial.SerialException, OSError, ValueError):
+        return None
+    try:
+        for index, baudrate in enumerate(baudrates):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or stop.is_set():
+                return None
+            if index:
+                ser.baudrate = baudrate
+            ser.reset_input_buffer()
+            result = _await_valid_nmea(ser, min(SERIAL_PROBE_DWELL, remaining), stop=stop)
+            if result:
+                return baudrate
+            if result is None and index == 0:
+                # 波特率不对时也会收到乱码，完全静默说明该端口没有在输出（例如空闲的蓝牙 UART）
+                return None
+    except (serial.SerialException, OSError):
+        return None
+    finally:
+        with contextlib.suppress(Exception):
+            ser.close()
+    return None
+
+
+def probe_serial_ports(
+    ports: Iterable[Any], baudrates: tuple[int, ...], timeout: float = SERIAL_PROBE_TIMEOUT
+) -> Optional[SerialProbeResult]:
+    """并行打开候选串口，逐个波特率等待校验正确的 NMEA 语句，返回最先确认的端口（都失败时返回 None）。
+
+    ports 为 serial.tools.list_ports.comports() 的结果；每个端口一个线程，任一端口确认后其余线程随即退出。
+    """
+
+    ports = list(ports)
+    if not ports:
+        return None
+
+    started = time.monotonic()
+    deadline = started + timeout
+    stop = threading.Event()
+    found: list[SerialProbeResult] = []
+    lock = threading.Lock()
+
+    def worker(port_info):
+        baudrate = _probe_one_port(port_info.device, baudrates, deadline, stop)
+        if baudrate is None:
+            return
+        with lock:
+            if not found:
+                found.append(
+                    SerialProbeResult(
+                        port=port_info.device,
+                        baudrate=baudrate,
+                        serial_number=getattr(port_info, "serial_number", None),
+                        elapsed_ms=round((time.monotonic() - started) * 1000, 1),
+                    )
+                )
+        stop.set()
+
+    threads = [
+        threading.Thread(target=worker, args=(port_info,), name=f"serial-probe-{port_info.device}", daemon=True)
+        for port_info in ports
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(max(0.0, deadline - time.monotonic()) + 1.0)
+    stop.set()
+    return found[0] if found else None
+
+
+def load_port_cache(path: Optional[Path], ports: Iterable[Any]) -> Optional[SerialProbeResult]:
+    """读取上次探测结果并在当前枚举中找回该设备：有 USB 序列号时按序列号匹配（设备路径可能已变化），否则要求路径仍存在。"""
+
+    if not path:
+        return None
+    try:
+        cached = json.loads(Path(path).read_text(encoding="utf-8"))
+        port, baudrate = str(cached["port"]), int(cached["baudrate"])
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError) as exc:
+        logging.warning("串口缓存无法读取，已忽略: %s", exc)
+        return None
+
+    serial_number = cached.get("serial_number")
+    if serial_number:
+        matches = [info.device for info in ports if getattr(info, "serial_number", None) == serial_number]
+        if not matches:
+            return None
+        port = port if port in matches else matches[0]
+    elif not os.path.exists(port):
+        return None
+    return SerialProbeResult(port=port, baudrate=baudrate, serial_number=serial_number, source="cache")
+
+
+def save_port_cache(path: Optional[Path], result: SerialProbeResult):
+    """原子写入探测结果（先写临时文件再替换），失败只记录警告。"""
+
+    if not path:
+        return
+    path = Path(path)
+    record = {
+        "port": result.port,
+        "baudrate": result.baudrate,
+        "serial_number": result.serial_number,
+        "updated": datetime.now().isoformat(timespec="seconds"),
+    }
+    tmp = path.with_name(path.name + ".tmp")
+    try:
+        tmp.write_text(json.dumps(record, ensure_ascii=False) + "\n", encoding="utf-8")
+        os.replace(tmp, path)
+    except OSError as exc:
+        logging.warning("串口缓存写入失败: %s", exc)
+
+
+NETLINK_KOBJECT_UEVENT = 15  # Linux：内核设备热插拔事件（socket 模块未导出该常量）
+HOTPLUG_SETTLE_S = 0.5  # 设备插入后等待 udev 创建节点、设置权限的时间
+
+
+class SerialReconnector:
+    """串口断开后的后台重连：设备重新出现（按 USB 序列号或路径判断）后用 reopen() 重新打开，
+    失败按指数退避加抖动重试；Linux 上订阅内核 tty 插入事件，插回即提前重试，无需等满退避时间。
+
+    reopen 与 present 由发布器提供，在重连线程中调用，不占用 MQTT 网络线程。
+    """
+
+    def __init__(
+        self,
+        reopen: Callable[[], bool],
+        present: Callable[[], bool],
+        min_delay: float = SERIAL_RECONNECT_MIN_DELAY,
+        max_delay: float = SERIAL_RECONNECT_MAX_DELAY,
+        name: str = "serial-reconnect",
+        on_recovered: Optional[Callable[[], None]] = None,
+    ):
+        """reopen() 返回是否恢复成功，present() 返回设备当前是否可见；恢复并更新计数后调用 on_recovered()。"""
+
+        self.reopen = reopen
+        self.present = present
+        self.on_recovered = on_recovered
+        self.min_delay = max(0.1, min_delay)
+        self.max_delay = max(self.min_delay, max_delay)
+        self.name = name
+        self.outages = 0
+        self.reconnects = 0
+        self.attempts = 0
+        self.total_outage_s = 0.0
+        self.last_outage_s: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.hotplug: Optional[bool] = None  # 最近一次重连是否订阅到了热插拔事件
+        self._outage_started: Optional[float] = None
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._wake: Optional[tuple[socket.socket, socket.socket]] = None
+        self._uevent: Optional[socket.socket] = None
+
+    @property
+    def active(self) -> bool:
+        """是否处于断线重连中。"""
+
+        return self._outage_started is not None
+
+    def begin(self, error: Any = None):
+        """记录一次断线并启动重连线程（已在重连时只更新错误信息）。"""
+
+        with self._lock:
+            self.last_error = str(error) if error else self.last_error
+            if self._thread:
+                return
+            self.outages += 1
+            self._outage_started = time.monotonic()
+            # 每次重连使用独立的停止事件与套接字，上一轮线程尚未退出时也不会互相影响
+            self._stop = threading.Event()
+            self._uevent = self._open_hotplug_watch()
+            self._wake = socket.socketpair() if self._uevent else None
+            self.hotplug = self._uevent is not None
+            self._thread = threading.Thread(
+                target=self._run, args=(self._stop, self._uevent, self._wake), name=self.name, daemon=True
+            )
+            self._thread.start()
+
+    def cancel(self):
+        """放弃重连（主动停止采集或退出时），断线时长计入统计。
+
+        不等待重连线程退出：它可能正等待调用方所在的线程（如事件循环）完成重新打开，线程看到停止事件后自行结束。
+        """
+
+        with self._lock:
+            self._thread = None
+            self._stop.set()
+            if self._wake:
+                with contextlib.suppress(OSError):
+                    self._wake[1].send(b"\0")
+            self._end_outage()
+
+    def stats(self) -> Dict[str, Any]:
+        """重连状态与计数（写入状态消息）。"""
+
+        started = self._outage_started
+        return {
+            "state": "reconnecting" if started is not None else "ok",
+            "current_outage_s": round(time.monotonic() - started, 1) if started is not None else None,
+            "outages": self.outages,
+            "reconnects": self.reconnects,
+            "attempts": self.attempts,
+            "last_outage_s": self.last_outage_s,
+            "total_outage_s": round(self.total_outage_s + (time.monotonic() - started if started else 0.0), 1),
+            "hotplug": self.hotplug,
+            "last_error": self.last_error,
+        }
+
+    def _end_outage(self):
+        """结束当前断线（调用方持有锁）。"""
+
+        if self._outage_started is not None:
+            self.last_outage_s = round(time.monotonic() - self._outage_started, 1)
+            self.total_outage_s += self.last_outage_s
+            self._outage_started = None
+
+    def _run(self, stop: threading.Event, uevent: Optional[socket.socket], wake: Optional[tuple[socket.socket, ...]]):
+        """重连循环：设备可见时尝试打开，失败后退避等待（插入事件可提前唤醒）。"""
+
+        delay = self.min_delay
+        while not stop.is_set():
+            if self.present():
+                self.attempts += 1
+                try:
+                    recovered = self.reopen()
+                except Exception as exc:  # noqa: BLE001
+                    logging.error("串口重连出错: %s", exc)
+                    self.last_error = str(exc)
+                    recovered = False
+                if recovered or stop.is_set():
+                    break
+            # 等待时长在 [delay/2, delay] 间随机，避免多台设备同时重试
+            if self._wait(random.uniform(delay / 2, delay), stop, uevent, wake):
+                delay = self.min_delay
+                stop.wait(HOTPLUG_SETTLE_S)
+            else:
+                delay = min(delay * 2, self.max_delay)
+
+        recovered = False
+        with self._lock:
+            if self._thread is threading.current_thread():
+                self._thread = None
+                if not stop.is_set():
+                    recovered = True
+                    self.reconnects += 1
+                    self._end_outage()
+                    logging.info("串口已恢复，断线 %.1f 秒（累计重连 %d 次）", self.last_outage_s, self.reconnects)
+            if self._uevent is uevent:
+                self._uevent = None
+                self._wake = None
+        for sock in (uevent, *(wake or ())):
+            if sock:
+                sock.close()
+        if recovered and self.on_recovered:
+            try:
+                self.on_recovered()
+            except Exception as exc:  # noqa: BLE001
+                logging.error("串口恢复回调出错: %s", exc)
+
+    @staticmethod
+    def _open_hotplug_watch() -> Optional[socket.socket]:
+        """订阅内核 uevent（设备插拔事件），非 Linux 或无权限（如容器内）时返回 None，退化为定时轮询。"""
+
+        if not hasattr(socket, "AF_NETLINK"):
+            return None
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            sock.bind((0, 1))
+            sock.setblocking(False)
+            return sock
+        except OSError as exc:
+            logging.debug("无法订阅设备热插拔事件: %s", exc)
+            return None
+
+    @staticmethod
+    def _wait(
+        timeout: float,
+        stop: threading.Event,
+        uevent: Optional[socket.socket],
+        wake: Optional[tuple[socket.socket, ...]],
+    ) -> bool:
+        """等待退避时间或停止请求；期间收到 tty 设备插入事件时返回 True。"""
+
+        if not uevent or not wake:
+            stop.wait(timeout)
+            return False
+
+        deadline = time.monotonic() + timeout
+        while not stop.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            try:
+                readable, _, _ = select.select([uevent, wake[0]], [], [], remaining)
+            except (OSError, ValueError):
+                stop.wait(remaining)
+                return False
+            if uevent not in readable:
+                continue
+            plugged = False
+            with contextlib.suppress(OSError):
+                while True:
+                    message = uevent.recv(65536)
+                    if not message:
+                        break
+                    fields = message.split(b"\0")
+                    plugged = plugged or (b"ACTION=add" in fields and b"SUBSYSTEM=tty" in fields)
+            if plugged:
+                logging.info("检测到串口设备插入，立即尝试重连")
+                return True
+        return False
+
+
+SIOCGIFADDR = 0x8915  # Linux ioctl：读取网卡 IPv4 地址
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+MEMINFO_KEYS = (b"MemTotal:", b"MemAvailable:")
+
+
+def read_meminfo() -> Dict[str, Any]:
+    """只读取 /proc/meminfo 中需要的两项（位于文件开头，读到即停），转换为 MB。"""
+
+    values: Dict[bytes, int] = {}
+    try:
+        with open("/proc/meminfo", "rb") as file:
+            for line in file:
+                for key in MEMINFO_KEYS:
+                    if line.startswith(key):
+                        values[key] = int(line.split()[1])
+                if len(values) == len(MEMINFO_KEYS):
+                    break
+    except (OSError, ValueError, IndexError):
+        return {}
+
+    if not values:
+        return {}
+    return {
+        "total_mb": round(values.get(b"MemTotal:", 0) / 1024, 2),
+        "available_mb": round(values.get(b"MemAvailable:", 0) / 1024, 2),
+    }
+
+
+def default_route_interface() -> Optional[str]:
+    """从 /proc/net/route 找出默认路由所在网卡（跃点数最小者）。"""
+
+    best: Optional[tuple[int, str]] = None
+    try:
+        with open("/proc/net/route", encoding="ascii") as file:
+            next(file, None)
+            for line in file:
+                fields = line.split()
+                if len(fields) < 7 or fields[1] != "00000000":
+                    continue
+                metric = int(fields[6])
+                if best is None or metric < best[0]:
+                    best = (metric, fields[0])
+    except (OSError, ValueError):
+        return None
+    return best[1] if best else None
+
+
+def interface_ipv4(name: str) -> Optional[str]:
+    """用 SIOCGIFADDR 读取网卡的 IPv4 地址，网卡无地址或平台不支持时返回 None。"""
+
+    if fcntl is None:
+        return None
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            result = fcntl.ioctl(sock.fileno(), SIOCGIFADDR, struct.pack("256s", name[:15].encode()))
+    except OSError:
+        return None
+    return socket.inet_ntoa(result[20:24])
+
+
+def local_ipv4() -> str:
+    """枚举本机网卡取 IPv4 地址：优先默认路由网卡，其次第一个非回环地址；不发出任何网络报文。"""
+
+    candidates = []
+    default = default_route_interface()
+    if default:
+        candidates.append(default)
+    with contextlib.suppress(OSError, AttributeError):
+        candidates.extend(name for _, name in socket.if_nameindex() if name != default)
+
+    for name in candidates:
+        address = interface_ipv4(name)
+        if address and not address.startswith("127."):
+            return address
+    return ""
+
+
+STATUS_IDENTITY_KEYS = frozenset({"message_type", "device_id", "timestamp"})
+
+
+def status_changes(previous: Dict[str, Any], current: Dict[str, Any]) -> Dict[str, Any]:
+    """逐层比较两次状态，返回变化的字段：嵌套字典只保留变化的键，已删除的键记为 None。"""
+
+    changes: Dict[str, Any] = {}
+    for key, value in current.items():
+        old = previous.get(key)
+        if isinstance(value, dict) and isinstance(old, dict):
+            nested = status_changes(old, value)
+            if nested:
+                changes[key] = nested
+        elif key not in previous or value != old:
+            changes[key] = value
+    for key in previous.keys() - current.keys():
+        changes[key] = None
+    return changes
+
+
+class SystemInfoSampler:
+    """后台采样设备信息（CPU 负载、内存、IP 地址），状态消息直接读取缓存。
+
+    未启动后台线程时（一次性命令）按 TTL 在读取时刷新；Linux 上同时订阅 netlink 地址变化，
+    IP 变更后立即重新采样，不必等到下一个周期。
+    """
+
+    def __init__(self, interval: float = SYSTEM_INFO_INTERVAL):
+        """interval 为采样周期（秒），同时作为缓存的有效期。"""
+
+        self.interval = max(1.0, interval)
+        self.samples = 0
+        self.ip_changes = 0
+        self._info: Dict[str, Any] = {}
+        self._sampled_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._wake: Optional[tuple[socket.socket, socket.socket]] = None
+        self._netlink: Optional[socket.socket] = None
+
+    def start(self):
+        """启动后台采样线程（重复调用无副作用）。"""
+
+        if self._thread:
+            return
+        self._stop.clear()
+        self._netlink = self._open_address_watch()
+        if self._netlink:
+            self._wake = socket.socketpair()
+        self._thread = threading.Thread(target=self._run, name="sysinfo", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 2.0):
+        """停止后台线程并关闭 netlink 套接字。"""
+
+        thread, self._thread = self._thread, None
+        self._stop.set()
+        if self._wake:
+            with contextlib.suppress(OSError):
+                self._wake[1].send(b"\0")
+        if thread:
+            thread.join(timeout)
+        for sock in (self._netlink, *(self._wake or ())):
+            if sock:
+                sock.close()
+        self._netlink = None
+        self._wake = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        """返回缓存的设备信息；缓存过期（后台线程未运行或停滞）时当场刷新。"""
+
+        ttl = self.interval * 2 if self._thread else self.interval
+        sampled_at = self._sampled_at
+        if sampled_at is None or time.monotonic() - sampled_at > ttl:
+            self.refresh()
+        with self._lock:
+            return dict(self._info)
+
+    def refresh(self):
+        """重新采样。每次生成新的字典，读取方拿到的快照不会被修改。"""
+
+        info: Dict[str, Any] = {"cpu_cores": os.cpu_count()}
+        try:
+            load1, load5, load15 = os.getloadavg()
+            info["cpu_load"] = {"1m": round(load1, 2), "5m": round(load5, 2), "15m": round(load15, 2)}
+        except OSError:
+            pass
+
+        memory_info = read_meminfo()
+        if memory_info:
+            info["memory"] = memory_info
+
+        ip_address = local_ipv4()
+        if ip_address:
+            info["ip_address"] = ip_address
+
+        with self._lock:
+            previous = self._info.get("ip_address")
+            if self.samples and ip_address != previous:
+                self.ip_changes += 1
+                logging.info("IP 地址变化: %s -> %s", previous or "无", ip_address or "无")
+            self._info = info
+            self._sampled_at = time.monotonic()
+            self.samples += 1
+
+    @staticmethod
+    def _open_address_watch() -> Optional[socket.socket]:
+        """订阅 netlink 网卡与 IPv4 地址变化通知，非 Linux 或无权限时返回 None。"""
+
+        if not hasattr(socket, "AF_NETLINK"):
+            return None
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR))
+            sock.setblocking(False)
+            return sock
+        except OSError as exc:
+            logging.debug("无法订阅 netlink 地址变化: %s", exc)
+            return None
+
+    def _run(self):
+        """按周期采样；收到 netlink 通知时提前采样。"""
+
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception as exc:  # noqa: BLE001
+                logging.error("采样设备信息失败: %s", exc)
+            self._wait(self.interval)
+
+    def _wait(self, timeout: float):
+        """等待下一个周期、停止请求或地址变化通知。"""
+
+        if not self._netlink:
+            self._stop.wait(timeout)
+            return
+        try:
+            readable, _, _ = select.select([self._netlink, self._wake[0]], [], [], timeout)
+        except (OSError, ValueError):
+            self._stop.wait(timeout)
+            return
+        if self._netlink in readable:
+            # 一次变更通常连发多条通知，全部读完后只采样一次
+            with contextlib.suppress(OSError):
+                while self._netlink.recv(65536):
+                    pass
+
+
+@dataclass
+class ControlCommand:
+    """一条控制命令：command_id 取自消息（command_id 或 id 字段），缺省时自动生成。"""
+
+    command: str
+    command_id: str
+    data: Dict[str, Any]
+    explicit_id: bool = False
+
+    @property
+    def key(self) -> str:
+        """去重键：命令名与其余参数相同即视为同一条命令。"""
+
+        params = {k: v for k, v in self.data.items() if k not in {"command", "command_id", "id"}}
+        return self.command + json.dumps(params, sort_keys=True, ensure_ascii=False, default=str)
+
+
+_command_ids = itertools.count(1)
+
+
+def parse_control_command(payload: bytes) -> ControlCommand:
+    """解析控制主题的消息：纯文本命令或 {"command": ..., "command_id": ...} JSON。"""
+
+    text = payload.decode("utf-8", errors="ignore").strip()
+    command = text.lower()
+    data: Dict[str, Any] = {}
+    try:
+        parsed = json.loads(text)
+        if isinstance(parsed, dict):
+            data = parsed
+            command = str(parsed.get("command", command)).lower()
+    except json.JSONDecodeError:
+        pass
+
+    explicit = data.get("command_id", data.get("id"))
+    if explicit not in (None, ""):
+        return ControlCommand(command, str(explicit), data, explicit_id=True)
+    return ControlCommand(command, f"{int(time.time())}-{next(_command_ids)}", data)
+
+
+class ControlCommandExecutor:
+    """控制命令执行器：paho 回调中只做解析、去重与入队，命令在专用线程（或 asyncio 任务）中按顺序执行。
+
+    去重规则：同一 command_id 重发时，已完成的命令直接重发原结果，排队或执行中的回复 duplicate；
+    未带 command_id 的命令若与队列中尚未开始的命令完全相同则合并。
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[ControlCommand], tuple[bool, str, Optional[Dict[str, Any]]]],
+        publish_result: Callable[[ControlCommand, bool, str, Dict[str, Any]], None],
+        max_pending: int = 32,
+        remember: int = 256,
+        threaded: bool = True,
+    ):
+        """handler 执行命令并返回 (成功, 说明, 附加字段)；threaded 为 False 时由调用方执行 run_pending()。"""
+
+        self.handler = handler
+        self.publish_result = publish_result
+        self.max_pending = max_pending
+        self.remember = remember
+        self.threaded = threaded
+        self.on_submit: Optional[Callable[[], None]] = None
+        self._pending: deque[ControlCommand] = deque()
+        self._recent: Dict[str, Optional[tuple[bool, str, Dict[str, Any]]]] = {}
+        self._running: Optional[ControlCommand] = None
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._closing = False
+        self.accepted = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+
+    def submit(self, command: ControlCommand):
+        """登记一条命令并立即回复 accepted / duplicate / rejected，最终结果在执行后另行发布。"""
+
+        with self._cond:
+            outcome, existing, result = self._admit_locked(command)
+            position = len(self._pending)
+            if outcome == "accepted" and self.threaded and self._thread is None and not self._closing:
+                self._thread = threading.Thread(target=self._run, name="control-commands", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+        if outcome == "accepted":
+            self.publish_result(command, True, "命令已接受，等待执行", {"phase": "accepted", "queue_position": position})
+            if self.on_submit:
+                self.on_submit()
+        elif outcome == "rejected":
+            self.publish_result(command, False, "命令队列已满，请稍后重试", {"phase": "rejected"})
+        elif result is not None:
+            success, message, extra = result
+            self.publish_result(existing, success, message, {**extra, "duplicate": True})
+        else:
+            self.publish_result(existing, True, "相同命令已在队列中或正在执行", {"phase": "duplicate"})
+
+    def _admit_locked(self, command: ControlCommand):
+        """判定命令是新命令、重复还是因队列已满被拒绝。"""
+
+        if command.explicit_id and command.command_id in self._recent:
+            self.duplicates += 1
+            return "duplicate", command, self._recent[command.command_id]
+        if not command.explicit_id:
+            key = command.key
+            for queued in self._pending:
+                if queued.key == key:
+                    self.duplicates += 1
+                    return "duplicate", queued, None
+        if len(self._pending) >= self.max_pending:
+            self.rejected += 1
+            return "rejected", command, None
+
+        self._pending.append(command)
+        self._recent[command.command_id] = None
+        while len(self._recent) > self.remember:
+            self._recent.pop(next(iter(self._recent)))
+        self.accepted += 1
+        return "accepted", command, None
+
+    def run_pending(self):
+        """依次执行当前排队的全部命令（在执行线程或事件循环中调用）。"""
+
+        while True:
+            with self._cond:
+                if not self._pending:
+                    return
+                command = self._running = self._pending.popleft()
+            self._execute(command)
+
+    def _execute(self, command: ControlCommand):
+        """执行一条命令并发布最终结果。"""
+
+        started = time.monotonic()
+        try:
+            success, message, extra = self.handler(command)
+        except Exception as exc:  # noqa: BLE001
+            logging.error("执行控制命令 %s 出错: %s", command.command, exc)
+            success, message, extra = False, f"执行出错: {exc}", None
+        extra = {
+            **(extra or {}),
+            "phase": "completed" if success else "failed",
+            "duration_ms": round((time.monotonic() - started) * 1000, 1),
+        }
+        with self._cond:
+            self._running = None
+            if command.command_id in self._recent:
+                self._recent[command.command_id] = (success, message, extra)
+            if success:
+                self.completed += 1
+            else:
+                self.failed += 1
+        self.publish_result(command, success, message, extra)
+
+    def _run(self):
+        """执行线程：等待新命令并按顺序执行。"""
+
+        while True:
+            with self._cond:
+                while not self._pending and not self._closing:
+                    self._cond.wait()
+                if self._closing:
+                    return
+            self.run_pending()
+
+    def stop(self, timeout: float = 5.0):
+        """停止执行线程（正在执行的命令会先完成，未执行的命令丢弃）。"""
+
+        with self._cond:
+            self._closing = True
+            self._pending.clear()
+            self._cond.notify_all()
+        thread, self._thread = self._thread, None
+        if thread and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回命令计数与队列深度，用于状态上报。"""
+
+        with self._cond:
+            return {
+                "pending": len(self._pending),
+                "running": self._running.command if self._running else None,
+                "accepted": self.accepted,
+                "duplicates": self.duplicates,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "failed": self.failed,
+            }
+
+
+class GPSPublisher:
+    """负责读取串口、解析 NMEA 并发布到 MQTT 的核心类。"""
+
+    def __init__(self, config: PublisherConfig, history_writer: Optional[HistoryWriter] = None):
+        """初始化发布器，保存配置并准备运行所需的状态字段；多接收机时共用传入的 history_writer。"""
+
+        self.config = config
+        self.service_active = False
+        self.gps_streaming = False
+        self.ser: Optional[serial.Serial] = None
+        self.mqtt_client: Optional[mqtt.Client] = None
+        self.history_file = config.history_file
+        self.history_file.touch(exist_ok=True)
+        self.history_writer = history_writer or HistoryWriter(
+            self.history_file,
+            batch_size=config.history_batch_size,
+            batch_interval=config.history_batch_interval,
+            fsync_policy=config.history_fsync_policy,
+            fsync_interval=config.history_fsync_interval,
+            rotate_bytes=config.history_rotate_bytes,
+            rotate_daily=config.history_rotate_daily,
+            compression=config.history_compression,
+            retention_bytes=config.history_retention_bytes,
+            write_jsonl=config.history_backend in {"jsonl", "both"},
+            binary_store=(
+                BinaryHistoryStore(config.history_binary_dir) if config.history_backend in {"binary", "both"} else None
+            ),
+        )
+        self._mqtt_connected = False
+        self._data_count = 0
+        self._last_start_error: Optional[str] = None
+        self.receiver_profile = ReceiverProfile(
+            config.receiver_sentences,
+            config.receiver_rate_hz,
+            config.receiver_baudrate,
+        )
+        self.receiver_profile.validate()
+        self.receiver_config: Optional[Dict[str, Any]] = None
+        self.serial_port: Optional[SerialProbeResult] = None
+        self.serial_reconnect = SerialReconnector(
+            self._reopen_serial,
+            self._serial_present,
+            config.serial_reconnect_min_delay,
+            config.serial_reconnect_max_delay,
+            name=f"serial-reconnect-{config.device_id}",
+            on_recovered=self.publish_status,
+        )
+        self._line_buffer = LineRingBuffer(config.queue_size, config.queue_policy)
+        self._reader_thread: Optional[threading.Thread] = None
+        self.nmea_parser = NMEABytesParser()
+        self._history_http: Optional[ThreadingHTTPServer] = None
+        self.track_pyramid: Optional[TrackPyramid] = None
+        self._metrics_http: Optional[ThreadingHTTPServer] = None
+        self.metrics = ReceiverMetrics(config.device_id)
+        if config.mqtt_qos not in (0, 1):
+            raise ValueError(f"不支持的 QoS: {config.mqtt_qos}（可选: 0, 1）")
+        self._discarded_messages = 0
+        self.publish_window = PublishWindow(
+            self._send_window_message,
+            config.mqtt_max_inflight,
+            config.mqtt_queue_size,
+            config.mqtt_queue_policy,
+            on_acked=self._on_message_acked,
+            on_overflow=self._on_message_overflow,
+            on_failed=self._on_message_failed,
+        )
+        METRICS.register_collector(self._collect_metrics)
+        self.system_info = SystemInfoSampler(config.system_info_interval)
+        self._status_lock = threading.Lock()
+        self._last_status: Optional[Dict[str, Any]] = None
+        # 未连接时 paho 丢弃 QoS 0 的状态消息，连接成功后补发
+        self._status_pending = False
+        self._heartbeat_thread: Optional[threading.Thread] = None
+        self._heartbeat_stop = threading.Event()
+        # 串口与采集状态可能同时被命令执行线程、读取线程（出错时）和退出流程修改
+        self._streaming_lock = threading.RLock()
+        self.command_executor = ControlCommandExecutor(self._execute_command, self._publish_command_outcome)
+        self.epoch_assembler = (
+            EpochAssembler(config.epoch_sentences, config.epoch_timeout) if config.epoch_fusion else None
+        )
+        self.fix_filters = FixFilterChain.from_config(config)
+        self.geofence = GeofenceTracker(config.device_id)
+        try:
+            self.geofence.set_index(load_geofences(config.fence_file, config.fence_hysteresis_m))
+        except ValueError as exc:
+            logging.error("%s，围栏判定未启用", exc)
+        self.trip_analyzer = TripAnalyzer(config.device_id, **trip_options(config))
+        # 回放时当前语句的记录时间（Unix 时间戳），实时采集时为 None
+        self._replay_clock: Optional[float] = None
+        # 断线发送队列在建立常驻 MQTT 连接时才打开（手动发布、查询等一次性命令不使用）
+        self.spool: Optional[OutboundSpool] = None
+        self.spool_drainer: Optional[SpoolDrainer] = None
+        self.publish_batcher = (
+            PublishBatcher(config.batch_size, config.batch_interval_ms)
+            if config.batch_size > 1 or config.payload_encoding != "json"
+            else None
+        )
+        self.command_help = {
+            "start": "启动或恢复 GPS 采集",
+            "stop": "停止 GPS 采集",
+            "status": "返回设备状态",
+            "help": "列出支持的命令及作用",
+            "reload_fences": "重新加载围栏文件；带 geojson 字段时替换围栏集合并保存到围栏文件",
+        }
+
+    # ------------------------ 公共接口 ------------------------
+    def run(self):
+        """阻塞式运行，支持 MQTT 控制启动/停止与状态查询。"""
+
+        if self.service_active:
+            logging.warning("GPS 服务已在运行中")
+            return
+
+        self.service_active = True
+        try:
+            self._initialize_mqtt()
+            self._start_history_http()
+            self._start_metrics_http()
+            self._start_monitoring()
+            self.start_streaming()
+            self._process_loop()
+
+        except KeyboardInterrupt:
+            logging.info("收到中断信号，准备退出...")
+        except Exception as exc:  # noqa: BLE001
+            logging.error("GPS 发布器错误: %s", exc)
+        finally:
+            self.service_active = False
+            self.cleanup_resources()
+
+    def _process_loop(self):
+        """处理循环：从环形缓冲区取行解析发布，并按时执行历元融合与批量发布的超时检查。"""
+
+        while self.service_active:
+            line_bytes = self._line_buffer.get(timeout=self._next_timer_timeout())
+
+            try:
+                if line_bytes is not None:
+                    self._process_line(line_bytes)
+                self._poll_timers()
+            except Exception as exc:  # noqa: BLE001
+                logging.error("处理数据时出错: %s", exc)
+
+    def _start_history_http(self):
+        """按配置启动本地历史查询 HTTP 服务，以及为地图提供简化轨迹的金字塔与其后台刷新。"""
+
+        if self.config.history_http_port:
+            query = self.build_history_query()
+            self.track_pyramid = build_track_pyramid(self.config, query)
+            if self.track_pyramid:
+                self.history_writer.on_submit = self.track_pyramid.note_record
+                self.track_pyramid.start()
+            self._history_http = start_history_http_server(
+                query,
+                self.config.history_http_host,
+                self.config.history_http_port,
+                self.track_pyramid,
+                trip_options(self.config),
+            )
+
+    def publish_manual_location(
+        self,
+        longitude: float,
+        latitude: float,
+        speed_ms: float,
+        device_id: Optional[str] = None,
+    ) -> None:
+        """在无设备时手动发布一条测试数据。"""
+
+        point = {"longitude": longitude, "latitude": latitude, "speed_ms": speed_ms}
+        if device_id:
+            point["device_id"] = device_id
+        if self.publish_manual_points([point], window=1)["acked"]:
+            logging.info(
+                "手动发布数据成功: 纬度=%s, 经度=%s, 速度=%.3f m/s",
+                latitude,
+                longitude,
+                speed_ms,
+            )
+
+    def _manual_payload(self, point: Dict[str, Any]) -> Dict[str, Any]:
+        """构造手动发布的消息，带时间的点使用其自身时间。"""
+
+        speed_ms = point.get("speed_ms") or 0.0
+        moment = point.get("time")
+        if moment is not None:
+            utc_time = datetime.fromtimestamp(moment, timezone.utc).replace(tzinfo=None)
+        else:
+            utc_time = datetime.utcnow()
+
+        payload: Dict[str, Any] = {
+            "message_type": "MANUAL",
+            "device_id": point.get("device_id") or self.config.device_id,
+            "timestamp": utc_time.isoformat(),
+            "latitude": point["latitude"],
+            "longitude": point["longitude"],
+            "speed_ms": speed_ms,
+            "speed_knots": round(speed_ms / 0.51444, 3) if speed_ms else 0.0,
+            "source": "manual_input",
+        }
+
+        try:
+            beijing_time = utc_time + timedelta(hours=8)
+            payload["time"] = beijing_time.strftime("%Y/%m/%d %H:%M:%S")
+        except Exception:  # noqa: BLE001
+            payload["time"] = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+        return payload
+
+    def publish_manual_points(
+        self,
+        points: Iterable[Dict[str, Any]],
+        rate: float = MANUAL_PUBLISH_RATE,
+        window: int = MANUAL_INFLIGHT_WINDOW,
+    ) -> Dict[str, Any]:
+        """通过一个 MQTT 连接以 QoS 1 流水线发布多条手动数据。
+
+        最多 window 条消息等待确认，rate 大于 0 时限制每秒条数；每条确认后交给历史写入线程批量写入。
+        """
+
+        window = max(1, window)
+        interval = 1.0 / rate if rate > 0 else 0.0
+        inflight: deque = deque()
+        sent = acked = failed = 0
+
+        client = mqtt.Client()
+        if self.config.mqtt_user and self.config.mqtt_pass:
+            client.username_pw_set(self.config.mqtt_user, self.config.mqtt_pass)
+        client.max_inflight_messages_set(window)
+
+        def settle():
+            """等待最早一条消息确认并记录历史。"""
+
+            nonlocal acked, failed
+            info, payload = inflight.popleft()
+            try:
+                info.wait_for_publish()
+            except (RuntimeError, ValueError) as exc:
+                failed += 1
+                logging.error("手动发布数据失败: %s", exc)
+                return
+            acked += 1
+            self.append_history_file(payload)
+
+        start = time.monotonic()
+        next_send = start
+        try:
+            client.connect(self.config.mqtt_host, self.config.mqtt_port, 60)
+            client.loop_start()
+            for point in points:
+                if interval:
+                    now = time.monotonic()
+                    if next_send > now:
+                        time.sleep(next_send - now)
+                    next_send = max(next_send + interval, now)
+
+                payload = self._manual_payload(point)
+                info = client.publish(self.config.mqtt_topic, json.dumps(payload, ensure_ascii=False), qos=1)
+                inflight.append((info, payload))
+                sent += 1
+                while len(inflight) >= window:
+                    settle()
+            while inflight:
+                settle()
+        except Exception as exc:  # noqa: BLE001
+            logging.error("手动发布数据失败: %s", exc)
+        finally:
+            # 先断开再停止网络线程，网络线程随断开立即退出，无需等待 select 超时
+            with contextlib.suppress(Exception):
+                client.disconnect()
+                client.loop_stop()
+
+        elapsed = max(time.monotonic() - start, 1e-9)
+        report = {"sent": sent, "acked": acked, "failed": failed + len(inflight), "elapsed_s": round(elapsed, 3)}
+        if sent > 1:
+            logging.info(
+                "手动发布完成: 共 %d 条，确认 %d 条，失败 %d 条，用时 %.1f 秒（%.0f 条/秒）",
+                sent,
+                acked,
+                report["failed"],
+                elapsed,
+                acked / elapsed,
+            )
+        return report
+
+    def replay(self, path: Path, speed: Optional[float] = 1.0, connect_timeout: float = 10.0) -> Dict[str, Any]:
+        """流式回放记录的 NMEA 文件（可为 .gz/.zst），经过与实时数据相同的解析、融合、过滤、发布与历史记录。
+
+        按语句中的 UTC 时间间隔除以 speed 控制节奏，speed 为 None 时尽快回放；定位的时间戳、历史记录与行程统计
+        均使用语句中的 UTC 日期与时间（而非回放时刻）。全程使用一个 MQTT 连接，返回吞吐统计。
+        """
+
+        # 异步连接：Broker 不可达时不抛出异常，由 paho 网络线程在后台重连，其间数据写入断线发送队列
+        self._create_mqtt_client()
+        self.mqtt_client.connect_async(self.config.mqtt_host, self.config.mqtt_port, 60)
+        self.mqtt_client.loop_start()
+        logging.info("MQTT 连接中: %s:%s", self.config.mqtt_host, self.config.mqtt_port)
+        deadline = time.monotonic() + connect_timeout
+        while not self._mqtt_connected and time.monotonic() < deadline:
+            time.sleep(0.05)
+        if not self._mqtt_connected:
+            logging.warning("MQTT 未连接，回放数据将写入断线发送队列")
+
+        logging.info("开始回放: %s（速度 %s）", path, "max" if speed is None else f"{speed:g}x")
+        with open_compressed(path) as file:
+            capture_day = nmea_capture_day(file)
+        if capture_day is None:
+            logging.warning("回放文件中没有带日期的 RMC 语句，按当天日期计算定位时间")
+            capture_day = float(calendar.timegm(time.gmtime()[:3] + (0, 0, 0)))
+
+        lines = 0
+        first_time: Optional[float] = None
+        last_time: Optional[float] = None
+        day_offset = 0.0
+        start = time.monotonic()
+        try:
+            with open_compressed(path) as file:
+                for line in file:
+                    lines += 1
+                    moment = nmea_line_seconds(line)
+                    if moment is not None:
+                        # 跨越 UTC 零点时时间回绕
+                        if last_time is not None and moment + day_offset < last_time - 43200:
+                            day_offset += 86400
+                        last_time = moment + day_offset
+                        if first_time is None:
+                            first_time = last_time
+                        self._replay_clock = capture_day + last_time
+                        if speed is not None:
+                            delay = start + (last_time - first_time) / speed - time.monotonic()
+                            if delay > 0:
+                                time.sleep(delay)
+
+                    gps_data = self._parse_line(line)
+                    if gps_data:
+                        if self._replay_clock is not None:
+                            gps_data["timestamp"] = datetime.fromtimestamp(self._replay_clock).isoformat()
+                        self._process_sentence(gps_data)
+                    self._poll_timers()
+                    if lines % 256 == 0:
+                        self._wait_publish_backlog()
+
+            self._shutdown_pipeline()
+        finally:
+            self._replay_clock = None
+        self._wait_publish_backlog()
+        elapsed = max(time.monotonic() - start, 1e-9)
+        span = (last_time - first_time) if first_time is not None else 0.0
+        report = {
+            "lines": lines,
+            "sentences": self.nmea_parser.parsed,
+            "published": self._data_count,
+            "elapsed_s": round(elapsed, 3),
+            "lines_per_s": round(lines / elapsed, 1),
+            "fixes_per_s": round(self._data_count / elapsed, 1),
+            "capture_span_s": round(span, 3),
+            "effective_speed": round(span / elapsed, 2),
+        }
+        logging.info(
+            "回放完成: %d 行，发布 %d 条，用时 %.1f 秒（%.0f 行/秒，%.0f 条/秒，相当于 %.1f 倍速）",
+            lines,
+            self._data_count,
+            elapsed,
+            report["lines_per_s"],
+            report["fixes_per_s"],
+            report["effective_speed"],
+        )
+        return report
+
+    def _start_metrics_http(self):
+        """按配置启动 Prometheus 运行指标 HTTP 服务。"""
+
+        if self.config.metrics_http_port:
+            self._metrics_http = start_metrics_http_server(
+                METRICS,
+                self.config.metrics_http_host,
+                self.config.metrics_http_port,
+            )
+
+    def _start_monitoring(self):
+        """启动设备信息后台采样与周期心跳。"""
+
+        self.system_info.start()
+        if self.config.heartbeat_interval > 0 and not self._heartbeat_thread:
+            self._heartbeat_stop.clear()
+            self._heartbeat_thread = threading.Thread(target=self._heartbeat_loop, name="heartbeat", daemon=True)
+            self._heartbeat_thread.start()
+
+    def _heartbeat_loop(self):
+        """心跳线程：每 heartbeat_interval 秒发布一次心跳。"""
+
+        while not self._heartbeat_stop.wait(self.config.heartbeat_interval):
+            self.publish_heartbeat()
+
+    def _stop_monitoring(self):
+        """停止心跳与设备信息采样。"""
+
+        self._heartbeat_stop.set()
+        thread, self._heartbeat_thread = self._heartbeat_thread, None
+        if thread and thread is not threading.current_thread():
+            thread.join(timeout=2)
+        self.system_info.stop()
+
+    def _wait_publish_backlog(self, timeout: float = 30.0):
+        """等待发布窗口中的消息全部确认，避免尽快回放时超出队列容量而丢弃。"""
+
+        self.publish_window.wait_drained(timeout)
+
+    def _process_line(self, line_bytes: bytes):
+        """处理线程：解析一行原始 NMEA，发布并记录历史。"""
+
+        logging.debug("收到原始 NMEA: %r", line_bytes)
+
+        gps_data = self._parse_line(line_bytes)
+        if gps_data:
+            self._process_sentence(gps_data)
+
+    def _parse_line(self, line_bytes: bytes) -> Optional[Dict[str, Any]]:
+        """解析一行并按语句类型（$GPRMC 的 RMC 部分）记录解析耗时。"""
+
+        started = time.perf_counter()
+        gps_data = self.nmea_parser.parse(line_bytes, self.config.device_id)
+        self.metrics.parse_histogram(line_bytes[3:6]).observe(time.perf_counter() - started)
+        return gps_data
+
+    def _process_sentence(self, gps_data: Dict[str, Any]):
+        """把一条解析后的语句交给历元融合或直接发布。"""
+
+        if self.epoch_assembler:
+            for fix in self.epoch_assembler.add(gps_data):
+                self._publish_fix(fix)
+        else:
+            self._publish_fix(gps_data)
+
+    def _next_timer_timeout(self, default: float = 0.5) -> float:
+        """处理线程等待新数据的最长时间：不超过历元融合与批量发布的最近截止时刻。"""
+
+        timeout = default
+        for timer in (self.epoch_assembler, self.publish_batcher, self.trip_analyzer):
+            remaining = timer.time_to_deadline() if timer else None
+            if remaining is not None:
+                timeout = min(timeout, remaining)
+        return timeout
+
+    def _poll_timers(self):
+        """发出已超时的历元与已到期的发布批次，并结束停留超时（或长时间收不到定位）的行程。"""
+
+        if self.epoch_assembler:
+            for fix in self.epoch_assembler.poll():
+                self._publish_fix(fix)
+        if self.publish_batcher:
+            batch = self.publish_batcher.poll()
+            if batch:
+                self._publish_batch(batch, self.config.mqtt_topic)
+        for trip in self.trip_analyzer.poll(self._replay_clock):
+            self.publish_trip_summary(trip)
+
+    def _publish_fix(self, gps_data: Dict[str, Any]):
+        """判定围栏、更新行程统计后让定位（单条语句或融合历元）通过发布前过滤链，发布放行的定位并更新计数。
+
+        围栏与行程在过滤之前处理，被过滤掉的定位同样能触发进出事件、计入行程距离。
+        """
+
+        self._evaluate_geofences(gps_data)
+        for trip in self.trip_analyzer.add_fix(gps_data):
+            self.publish_trip_summary(trip)
+        for fix in self.fix_filters.process(gps_data):
+            self._publish_filtered(fix)
+
+    def _evaluate_geofences(self, gps_data: Dict[str, Any]):
+        """按当前围栏集合设置定位的 isInsideFence（未加载围栏时不设置），并发布产生的进出事件。"""
+
+        inside, events = self.geofence.evaluate(gps_data)
+        if inside is not None:
+            gps_data["isInsideFence"] = inside
+        for event in events:
+            self.publish_fence_event(event)
+
+    def reload_geofences(self, geojson: Any = None) -> Optional[GeofenceIndex]:
+        """重新加载围栏：给出 GeoJSON 时替换围栏集合并保存到围栏文件，否则重新读取围栏文件。
+
+        解析失败时保留原有围栏并抛出 ValueError。
+        """
+
+        if geojson is None:
+            if not self.config.fence_file:
+                raise ValueError("未配置围栏文件")
+            index = load_geofences(self.config.fence_file, self.config.fence_hysteresis_m)
+        else:
+            index = GeofenceIndex.from_geojson(geojson, self.config.fence_hysteresis_m, source="control")
+            if self.config.fence_file:
+                try:
+                    save_geofences(self.config.fence_file, geojson)
+                    index.source = str(self.config.fence_file)
+                except OSError as exc:
+                    logging.warning("围栏文件保存失败，新围栏仅在本次运行中生效: %s", exc)
+        self._set_geofence_index(index)
+        return index
+
+    def _set_geofence_index(self, index: Optional[GeofenceIndex]):
+        """让新的围栏集合对后续定位生效。"""
+
+        self.geofence.set_index(index)
+
+    def _publish_filtered(self, gps_data: Dict[str, Any]):
+        """发布一条已通过过滤的定位。"""
+
+        self.publish_gps_data(gps_data, self.config.mqtt_topic)
+        self._data_count += 1
+
+        if self._data_count % 10 == 0:
+            logging.info("运行中... 已发送 %d 条数据", self._data_count)
+
+    def _serial_reader_loop(self, ser: serial.Serial):
+        """读取线程：持续排空串口，将原始行写入环形缓冲区。"""
+
+        while self.service_active and self.gps_streaming and self.ser is ser:
+            try:
+                line_bytes = ser.readline()
+            except (serial.SerialException, OSError, TypeError) as exc:
+                # 主动停止时串口被关闭也会触发异常，此时无需再次处理
+                self._serial_lost(ser, exc)
+                return
+
+            if line_bytes:
+                self.metrics.serial_lines.inc()
+                self.metrics.serial_bytes.inc(len(line_bytes))
+                self._line_buffer.put(line_bytes)
+
+    def _start_reader_thread(self):
+        """为当前串口启动读取线程。"""
+
+        if not self.ser:
+            return
+
+        self._line_buffer.open()
+        self._reader_thread = threading.Thread(
+            target=self._serial_reader_loop,
+            args=(self.ser,),
+            name="serial-reader",
+            daemon=True,
+        )
+        self._reader_thread.start()
+
+    def _stop_reader_thread(self):
+        """等待读取线程退出（读取线程自身调用时跳过等待）。"""
+
+        thread = self._reader_thread
+        self._reader_thread = None
+        self._line_buffer.close()
+        if thread and thread.is_alive() and thread is not threading.current_thread():
+            thread.join(timeout=2)
+
+    def build_history_query(self) -> HistoryQuery:
+        """按当前历史后端构造查询对象（二进制后端时复用写入器的存储）。"""
+
+        return HistoryQuery(self.history_file, self.history_writer.binary_store)
+
+    # ---------------------- 初始化流程 -----------------------
+    def _initialize_serial(self):
+        """打开配置的串口（未指定串口或波特率时自动探测），校验可用设备并给出清晰的错误提示。"""
+
+        port = self.config.port
+        self.serial_port = None
+        if port and not os.path.exists(port):
+            # 伪终端与 /dev/serial/by-id 等符号链接不会出现在枚举结果中，路径存在即可
+            available_ports = [info.device for info in serial.tools.list_ports.comports()]
+            suggestion = "，可能是大小写问题？" if any(p.lower() == port.lower() for p in available_ports) else ""
+            available = ", ".join(available_ports) or "无可用串口"
+            raise RuntimeError(f"指定的串口不存在: {port}（可用: {available}）{suggestion}")
+
+        if port and self.config.baudrate:
+            self.serial_port = SerialProbeResult(port, self.config.baudrate, source="config")
+        else:
+            self.serial_port = self._auto_detect_port()
+        self.ser = self._open_serial(self.serial_port.port, self.serial_port.baudrate)
+
+        if self.serial_port.source == "cache" and not _await_valid_nmea(self.ser, 2 * SERIAL_PROBE_DWELL, needed=1):
+            logging.info("缓存的串口 %s @ %d 没有有效输出，重新探测", self.serial_port.port, self.serial_port.baudrate)
+            self.ser.close()
+            self.serial_port = self._auto_detect_port(use_cache=False)
+            self.ser = self._open_serial(self.serial_port.port, self.serial_port.baudrate)
+
+        logging.info("串口连接成功: %s @ %d", self.serial_port.port, self.serial_port.baudrate)
+
+    def _open_serial(self, port: str, baudrate: int) -> serial.Serial:
+        """以 8N1 打开串口，失败时给出占用或权限提示。"""
+
+        try:
+            ser = serial.Serial(
+                port=port,
+                baudrate=baudrate,
+                bytesize=serial.EIGHTBITS,
+                parity=serial.PARITY_NONE,
+                stopbits=serial.STOPBITS_ONE,
+                timeout=1,
+            )
+        except serial.SerialException as exc:  # noqa: BLE001
+            available = ", ".join(info.device for info in serial.tools.list_ports.comports()) or "无可用串口"
+            original = getattr(exc, "original_exception", None)
+            errno = getattr(exc, "errno", None)
+            detail = str(exc) or "未知错误"
+
+            if original:
+                errno = getattr(original, "errno", errno)
+                if not detail:
+                    detail = str(original)
+
+            busy_hint = ""
+            if (errno == 16) or ("Device or resource busy" in detail) or ("Errno 16" in detail):
+                busy_hint = "，设备被其他程序占用（例如 minicom），请关闭占用后重试"
+            elif (errno == 13) or ("Permission denied" in detail) or ("Errno 13" in detail):
+                busy_hint = "，权限不足，请确认当前用户对串口有访问权限"
+
+            raise RuntimeError(f"串口打开失败: {port}，错误: {detail}{busy_hint}（可用: {available}）") from exc
+
+        if not ser.is_open:
+            raise RuntimeError("无法打开串口")
+        return ser
+
+    def _initialize_mqtt(self):
+        """建立 MQTT 连接并由 paho 网络线程维护。"""
+
+        self._create_mqtt_client()
+        self.mqtt_client.connect(self.config.mqtt_host, self.config.mqtt_port, 60)
+        self.mqtt_client.loop_start()
+        logging.info("MQTT 连接中: %s:%s", self.config.mqtt_host, self.config.mqtt_port)
+
+    def _create_mqtt_client(self):
+        """创建 MQTT 客户端、打开断线发送队列并注册连接与控制消息回调。"""
+
+        self.mqtt_client = mqtt.Client()
+        # 发布窗口与断线重放各自限制了未确认的 QoS 1 消息数，paho 的上限取二者之和，不再额外排队
+        self.mqtt_client.max_inflight_messages_set(self.config.mqtt_max_inflight + SPOOL_DRAIN_WINDOW)
+
+        if self.config.mqtt_user and self.config.mqtt_pass:
+            self.mqtt_client.username_pw_set(self.config.mqtt_user, self.config.mqtt_pass)
+
+        if self.config.spool_dir and self.spool is None:
+            self.spool = OutboundSpool(self.config.spool_dir, self.config.spool_max_bytes)
+            self.spool_drainer = SpoolDrainer(self.spool, self._publish_spooled, self.config.spool_drain_rate)
+            self.spool_drainer.start()
+
+        def _on_connect(client, userdata, flags, rc):
+            """处理 MQTT 连接成功或失败的事件。"""
+
+            self._mqtt_connected = rc == 0
+            if rc == 0:
+                self.metrics.mqtt_connects.inc()
+                logging.info("MQTT 连接成功")
+                if self.config.mqtt_control_topic:
+                    client.subscribe(self.config.mqtt_control_topic)
+                    logging.info("已订阅控制主题: %s", self.config.mqtt_control_topic)
+                if self.spool_drainer:
+                    self.spool_drainer.resume()
+                self.publish_window.resume()
+                if self._status_pending:
+                    self.publish_status()
+            else:
+                logging.error("MQTT 连接失败，错误码: %s", rc)
+
+        def _on_disconnect(client, userdata, rc):
+            """处理 MQTT 断开事件并刷新连接状态。"""
+
+            self._mqtt_connected = False
+            self.metrics.mqtt_disconnects.inc()
+            if self.spool_drainer:
+                self.spool_drainer.pause()
+            self.publish_window.pause()
+            logging.info("MQTT 连接断开")
+
+        def _on_publish(client, userdata, mid):
+            """消息写入套接字（QoS 0）或收到 PUBACK（QoS 1）。"""
+
+            self.publish_window.acked(mid)
+
+        self.mqtt_client.on_connect = _on_connect
+        self.mqtt_client.on_disconnect = _on_disconnect
+        self.mqtt_client.on_publish = _on_publish
+        self.mqtt_client.on_message = self._on_control_message
+
+    def _auto_detect_port(self, use_cache: bool = True) -> SerialProbeResult:
+        """确定串口与波特率：未指定串口时先用缓存，否则并行探测所有串口；只缺波特率时只探测指定串口。"""
+
+        ports = serial.tools.list_ports.comports()
+        port = self.config.port
+        # 配置的波特率（非 0 时）最先尝试
+        baudrates = tuple(dict.fromkeys(filter(None, (self.config.baudrate, *self.config.probe_baudrates))))
+        if port:
+            candidates = [info for info in ports if info.device == port] or [ListPortInfo(port)]
+        else:
+            if use_cache:
+                cached = load_port_cache(self.config.port_cache, ports)
+                if cached:
+                    logging.info("使用上次探测到的串口: %s @ %d", cached.port, cached.baudrate)
+                    return cached
+            if not ports:
+                raise RuntimeError("未检测到可用串口，请检查连接")
+            candidates = ports
+
+        logging.info(
+            "正在探测 %s，波特率 %s", ", ".join(info.device for info in candidates), ",".join(map(str, baudrates))
+        )
+        result = probe_serial_ports(candidates, baudrates, self.config.probe_timeout)
+        if result is None:
+            raise RuntimeError(
+                f"未在 {', '.join(info.device for info in candidates)} 上检测到有效的 NMEA 输出"
+                f"（已尝试波特率 {','.join(map(str, baudrates))}）"
+            )
+        logging.info("探测到 GPS 串口: %s @ %d，耗时 %.0f ms", result.port, result.baudrate, result.elapsed_ms)
+        return result
+
+    def _remember_serial_port(self):
+        """自动选择的串口配置完成后，按最终波特率（可能已由接收机配置切换）写入缓存。"""
+
+        if not self.serial_port or self.config.port or not self.ser:
+            return
+        self.serial_port = replace(self.serial_port, baudrate=self.ser.baudrate)
+        save_port_cache(self.config.port_cache, self.serial_port)
+
+    # ---------------------- 核心功能 ------------------------
+    def start_streaming(self):
+        """开启串口读取并发送配置命令。"""
+
+        with self._streaming_lock:
+            if self.gps_streaming:
+                logging.info("GPS 采集已在运行")
+                return True
+
+            self._data_count = 0
+            try:
+                self._last_start_error = None
+                self._initialize_serial()
+                self.send_gps_commands()
+                self.gps_streaming = True
+                self._start_reader_thread()
+                self.publish_status()
+                logging.info("GPS 采集已启动")
+                return True
+            except Exception as exc:  # noqa: BLE001
+                logging.error("启动 GPS 采集失败: %s", exc)
+                self.gps_streaming = False
+                self._last_start_error = f"{exc.__class__.__name__}: {exc}" if str(exc) else exc.__class__.__name__
+                return False
+
+    def stop_streaming(self):
+        """停止串口读取并关闭串口。"""
+
+        with self._streaming_lock:
+            if not self.gps_streaming:
+                logging.info("GPS 采集已停止，无需重复停止")
+                return True
+
+            self.gps_streaming = False
+            self.serial_reconnect.cancel()
+            self._close_serial()
+            self._stop_reader_thread()
+            self.publish_status()
+            logging.info("GPS 采集已停止")
+            return True
+
+    def _serial_lost(self, ser: serial.Serial, exc: BaseException):
+        """读取出错（如 USB 拔出）：关闭串口并交给后台重连，采集状态保持运行；未启用重连时停止采集。"""
+
+        # 先不加锁检查：主动停止时 stop_streaming 持有锁并等待读取线程退出，此处不能再等锁
+        if not self.gps_streaming or self.ser is not ser:
+            return
+        with self._streaming_lock:
+            if not self.gps_streaming or self.ser is not ser:
+                return
+            logging.error("串口错误: %s", exc)
+            if not self.config.serial_reconnect:
+                self.stop_streaming()
+                return
+            self._close_serial()
+            self._stop_reader_thread()
+            self.serial_reconnect.begin(exc)
+        logging.info("串口已断开，等待设备重新出现后自动重连")
+        self.publish_status()
+
+    def _serial_present(self) -> bool:
+        """断开的设备是否重新出现：有 USB 序列号时按序列号查找（重插后路径可能变化），否则看路径是否存在。"""
+
+        serial_number = self.serial_port.serial_number if self.serial_port else None
+        if serial_number:
+            ports = serial.tools.list_ports.comports()
+            return any(getattr(info, "serial_number", None) == serial_number for info in ports)
+        port = self.config.port or (self.serial_port.port if self.serial_port else "")
+        return os.path.exists(port) if port else bool(serial.tools.list_ports.comports())
+
+    def _reopen_serial(self) -> bool:
+        """重连线程调用：重新打开串口、配置接收机并恢复读取；采集已被停止时直接结束重连。"""
+
+        with self._streaming_lock:
+            if not self.gps_streaming:
+                return True
+            try:
+                self._initialize_serial()
+                self.send_gps_commands()
+                self._start_reader_thread()
+            except Exception as exc:  # noqa: BLE001
+                logging.warning("串口重连失败: %s", exc)
+                self.serial_reconnect.last_error = str(exc)
+                self._close_serial()
+                return False
+        return True
+
+    def send_gps_commands(self):
+        """按配置方案配置 GPS 模块（等待应答，不再固定休眠）。"""
+
+        if self.ser:
+            self._configure_receiver(self.ser)
+
+    def _configure_receiver(self, ser: serial.Serial) -> Optional[Dict[str, Any]]:
+        """执行 ReceiverConfigurator 并保存报告；失败只记录日志，不影响采集启动。"""
+
+        try:
+            self.receiver_config = ReceiverConfigurator(ser, self.receiver_profile).apply()
+        except (serial.SerialException, OSError, TypeError, ValueError) as exc:
+            logging.error("配置接收机失败: %s", exc)
+            self.receiver_config = {"error": str(exc)}
+        self._remember_serial_port()
+        return self.receiver_config
+
+    def parse_nmea_sentence(self, sentence: str, device_id: str) -> Optional[Dict[str, Any]]:
+        """解析 NMEA 协议数据。"""
+
+        try:
+            sentence = sentence.strip()
+
+            if not sentence.startswith("$") or "*" not in sentence:
+                return None
+
+            data_body, checksum = sentence[1:].split("*")
+            parts = data_body.split(",")
+
+            nmea_type = parts[0]
+            message_id = nmea_type[-3:]
+
+            if message_id == "RMC":
+                return self.parse_rmc(parts, device_id)
+            if message_id == "GLL":
+                return self.parse_gll(parts, device_id)
+            if message_id == "GGA":
+                return self.parse_gga(parts, device_id)
+
+            if nmea_type not in {"TXT", "GNTXT"}:
+                logging.debug("忽略未处理的 NMEA 类型: %s", nmea_type)
+            return None
+
+        except Exception as exc:  # noqa: BLE001
+            logging.error("NMEA 解析错误: %s", exc)
+            return None
+
+    def parse_rmc(self, parts: list[str], device_id: str) -> Optional[Dict[str, Any]]:
+        """解析 RMC 语句，提取定位、速度与日期时间等信息。"""
+
+        if len(parts) < 12:
+            return None
+
+        try:
+            status = parts[2]
+            if status != "A":
+                return None
+
+            utc_time = parts[1]
+            time_str = f"{utc_time[:2]}:{utc_time[2:4]}:{utc_time[4:6]}" if utc_time and len(utc_time) >= 6 else None
+
+            utc_date = parts[9]
+            date_str = f"20{utc_date[4:6]}-{utc_date[2:4]}-{utc_date[0:2]}" if utc_date and len(utc_date) == 6 else None
+
+            latitude = self.dm_to_decimal(parts[3], parts[4]) if parts[3] else None
+            longitude = self.dm_to_decimal(parts[5], parts[6], is_longitude=True) if parts[5] else None
+
+            speed_knots = float(parts[7]) if parts[7] else 0.0
+            course = float(parts[8]) if parts[8] else 0.0
+            speed_ms = speed_knots * 0.51444
+
+            return {
+                "message_type": "RMC",
+                "device_id": device_id,
+                "timestamp": datetime.now().isoformat(),
+                "utc_time": time_str,
+                "utc_date": date_str,
+                "latitude": latitude,
+                "longitude": longitude,
+                "speed_knots": speed_knots,
+                "speed_ms": speed_ms,
+                "course": course,
+                "status": status,
+                "mode": parts[12] if len(parts) > 12 else None,
+            }
+
+        except (ValueError, IndexError) as exc:
+            logging.error("RMC 解析错误: %s", exc)
+            return None
+
+    def parse_gll(self, parts: list[str], device_id: str) -> Optional[Dict[str, Any]]:
+        """解析 GLL 语句，提取经纬度与时间，过滤无效状态。"""
+
+        if len(parts) < 7:
+            return None
+
+        try:
+            if parts[6] not in {"A", "D"}:
+                return None
+
+            latitude = self.dm_to_decimal(parts[1], parts[2]) if parts[1] else None
+            longitude = self.dm_to_decimal(parts[3], parts[4], is_longitude=True) if parts[3] else None
+            utc_time = parts[5]
+            time_str = f"{utc_time[:2]}:{utc_time[2:4]}:{utc_time[4:6]}" if utc_time and len(utc_time) >= 6 else None
+
+            return {
+                "message_type": "GLL",
+                "device_id": device_id,
+                "timestamp": datetime.now().isoformat(),
+                "utc_time": time_str,
+                "latitude": latitude,
+                "longitude": longitude,
+                "status": parts[6],
+            }
+
+        except (ValueError, IndexError) as exc:
+            logging.error("GLL 解析错误: %s", exc)
+            return None
+
+    def parse_gga(self, parts: list[str], device_id: str) -> Optional[Dict[str, Any]]:
+        """解析 GGA 语句，返回卫星数量、精度与高度等信息。"""
 
         if len(parts) < 15:
             return None
@@ -510,7 +6674,7 @@ class GPSPublisher:
             return 0.0
 
     def append_history_file(self, payload: Dict[str, Any]):
-        """将解析后的坐标写入历史文件，便于轨迹回放。"""
+        """将解析后的坐标交给后台写入线程追加到历史文件，便于轨迹回放。"""
 
         if not self.history_file:
             return
@@ -552,11 +6716,15 @@ class GPSPublisher:
                 ),
                 "speed": speed_value,
                 "deviceId": payload.get("device_id") or payload.get("deviceId"),
-                "raw": payload,
             }
 
-            with self.history_file.open("a", encoding="utf-8") as file:
-                file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            raw_mode = self.config.history_raw_mode
+            if raw_mode == "full":
+                record["raw"] = payload
+            elif raw_mode == "slim":
+                record["raw"] = {key: value for key, value in payload.items() if key not in HISTORY_SLIM_DROP_KEYS}
+
+            self.history_writer.submit(record)
         except Exception as exc:  # noqa: BLE001
             logging.error("写入历史轨迹文件失败: %s", exc)
 
@@ -568,43 +6736,235 @@ class GPSPublisher:
 
         try:
             try:
-                beijing_time = datetime.utcnow() + timedelta(hours=8)
+                if self._replay_clock is not None:
+                    # 回放时使用定位的记录时间
+                    moment = history_timestamp_to_epoch(gps_data.get("timestamp")) or self._replay_clock
+                    beijing_time = datetime.utcfromtimestamp(moment) + timedelta(hours=8)
+                else:
+                    beijing_time = datetime.utcnow() + timedelta(hours=8)
                 gps_data["time"] = beijing_time.strftime("%Y/%m/%d %H:%M:%S")
             except Exception:  # noqa: BLE001
                 gps_data["time"] = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
 
             gps_data["source"] = "UM220-III"
 
+            if self.publish_batcher:
+                batch = self.publish_batcher.add(gps_data)
+                if batch:
+                    self._publish_batch(batch, topic)
+                return
+
             payload = json.dumps(gps_data, ensure_ascii=False)
-            result = self.mqtt_client.publish(topic, payload)
-
-            if result.rc == mqtt.MQTT_ERR_SUCCESS:
-                logging.info(
-                    "发布 %s 数据: 纬度=%s, 经度=%s",
-                    gps_data.get("message_type"),
-                    gps_data.get("latitude"),
-                    gps_data.get("longitude"),
-                )
-                self.append_history_file(gps_data)
+            if self._spool_if_offline(topic, payload, [gps_data]):
+                return
+            logging.info(
+                "发布 %s 数据: 纬度=%s, 经度=%s",
+                gps_data.get("message_type"),
+                gps_data.get("latitude"),
+                gps_data.get("longitude"),
+            )
+            self._submit_fixes(topic, payload, [gps_data])
+
+        except Exception as exc:  # noqa: BLE001
+            logging.error("发布 GPS 数据异常: %s", exc)
+
+    def _publish_batch(self, fixes: list[Dict[str, Any]], topic: str):
+        """按配置的编码把一批定位合并为一条消息发布，成功后逐条记录历史。"""
+
+        if not self.mqtt_client or not fixes:
+            return
+
+        try:
+            if self.config.payload_encoding == "compact":
+                payload: bytes | str = encode_compact_batch(fixes, self.config.device_id)
             else:
-                logging.error("发布数据失败: %s", result.rc)
+                payload = json.dumps(
+                    {
+                        "message_type": "BATCH",
+                        "device_id": self.config.device_id,
+                        "count": len(fixes),
+                        "fixes": fixes,
+                    },
+                    ensure_ascii=False,
+                    separators=(",", ":"),
+                )
+            if self._spool_if_offline(topic, payload, fixes):
+                return
+            logging.info("发布批量数据: %d 条，%d 字节", len(fixes), len(payload))
+            self._submit_fixes(topic, payload, fixes)
 
         except Exception as exc:  # noqa: BLE001
             logging.error("发布 GPS 数据异常: %s", exc)
 
+    def _spool_if_offline(self, topic: str, payload: bytes | str, fixes: list[Dict[str, Any]]) -> bool:
+        """MQTT 未连接时直接写入发送队列（QoS 0 消息在断线期间交给 paho 会被静默丢弃）。"""
+
+        if self.spool is None or self._mqtt_connected:
+            return False
+        return self._spool_payload(topic, payload, fixes)
+
+    def _spool_payload(
+        self, topic: str, payload: bytes | str, fixes: list[Dict[str, Any]], record_history: bool = True
+    ) -> bool:
+        """把未能发出的消息写入发送队列（落盘后由重放线程以 QoS 1 保证送达），并记录历史。"""
+
+        if self.spool is None:
+            return False
+        try:
+            self.spool.append(topic, payload)
+        except OSError as exc:
+            logging.error("写入发送队列失败: %s", exc)
+            return False
+        if fixes:
+            logging.info("MQTT 不可用，%d 条定位已写入发送队列", len(fixes))
+        if record_history:
+            for fix in fixes:
+                self.append_history_file(fix)
+        return True
+
+    def _submit_fixes(self, topic: str, payload: bytes | str, fixes: list[Dict[str, Any]]):
+        """把定位消息交给发布窗口；未启用确认后记录时立即写入历史。"""
+
+        if not self.config.history_after_ack:
+            for fix in fixes:
+                self.append_history_file(fix)
+        self.publish_window.submit(OutgoingMessage(topic, payload, self.config.mqtt_qos, fixes, time.perf_counter()))
+
+    def _send_window_message(self, message: OutgoingMessage) -> Optional[int]:
+        """发布窗口的发送函数：返回 mid，失败返回 None。"""
+
+        result = self._mqtt_publish(message.topic, message.payload, message.qos)
+        # 断线瞬间 QoS 1 消息仍会留在 paho 队列中，重连后发出并确认
+        if result.rc == mqtt.MQTT_ERR_SUCCESS or (message.qos and result.rc == mqtt.MQTT_ERR_NO_CONN):
+            return result.mid
+        logging.error("发布数据失败: %s", result.rc)
+        return None
+
+    def _on_message_acked(self, message: OutgoingMessage):
+        """服务器确认（QoS 0 为写入套接字）：统计入队→确认延迟，并按需记录历史。"""
+
+        self.metrics.publish_ack.observe(time.perf_counter() - message.enqueued)
+        if self.config.history_after_ack:
+            for fix in message.fixes:
+                self.append_history_file(fix)
+
+    def _on_message_overflow(self, message: OutgoingMessage):
+        """被挤出发布队列或随断线丢失的消息：写入断线发送队列，未启用时丢弃。"""
+
+        if not self._spool_payload(message.topic, message.payload, message.fixes, self.config.history_after_ack):
+            self._discarded_messages += 1
+            if self._discarded_messages % 100 == 1:  # 长时间断线时每 100 条提示一次
+                logging.warning("发布队列已满或连接中断，已丢弃 %d 条消息", self._discarded_messages)
+
+    def _on_message_failed(self, message: OutgoingMessage):
+        """paho 拒绝的消息（如断线瞬间的 QoS 0）写入断线发送队列。"""
+
+        self._spool_payload(message.topic, message.payload, message.fixes, self.config.history_after_ack)
+
+    def _publish_spooled(self, topic: str, payload: bytes):
+        """以 QoS 1 重放发送队列中的一条消息。"""
+
+        return self._mqtt_publish(topic, payload, qos=1)
+
+    def _mqtt_publish(self, topic: str, payload: bytes | str, qos: int = 0) -> mqtt.MQTTMessageInfo:
+        """发布一条消息（定位经发布窗口调用，状态、命令回执、围栏与行程事件及断线重放直接调用）。"""
+
+        return self.mqtt_client.publish(topic, payload, qos=qos)
+
+    def publish_fence_event(self, event: Dict[str, Any]):
+        """以 QoS 1 向围栏事件主题发布一条进出事件，MQTT 未连接时写入断线发送队列。"""
+
+        logging.info(
+            "围栏事件: %s %s %s（%s）",
+            event["device_id"],
+            "进入" if event["event"] == "enter" else "离开",
+            event["fence_name"],
+            event["fence_id"],
+        )
+        if not self.mqtt_client or not self.config.mqtt_fence_topic:
+            return
+
+        topic = self.config.mqtt_fence_topic
+        payload = json.dumps({**event, "timestamp": datetime.utcnow().isoformat()}, ensure_ascii=False)
+        try:
+            if not self._spool_if_offline(topic, payload, []):
+                self._mqtt_publish(topic, payload, qos=1)
+        except Exception as exc:  # noqa: BLE001
+            logging.error("发布围栏事件失败: %s", exc)
+
+    def publish_trip_summary(self, trip: Dict[str, Any]):
+        """以 QoS 1 向行程主题发布一条行程摘要，MQTT 未连接时写入断线发送队列。"""
+
+        logging.info(
+            "行程结束: %s %.2f km，%.0f 分钟，平均 %.1f km/h，最高 %.1f km/h（%s）",
+            trip["device_id"],
+            trip["distance_m"] / 1000,
+            trip["duration_s"] / 60,
+            trip["avg_speed_ms"] * 3.6,
+            trip["max_speed_ms"] * 3.6,
+            trip["end_reason"],
+        )
+        if not self.mqtt_client or not self.config.mqtt_trip_topic:
+            return
+
+        topic = self.config.mqtt_trip_topic
+        payload = json.dumps({**trip, "timestamp": datetime.utcnow().isoformat()}, ensure_ascii=False)
+        try:
+            if not self._spool_if_offline(topic, payload, []):
+                self._mqtt_publish(topic, payload, qos=1)
+        except Exception as exc:  # noqa: BLE001
+            logging.error("发布行程摘要失败: %s", exc)
+
     def publish_status(self):
         """将设备状态发布到状态主题。"""
 
         if not self.mqtt_client or not self.config.mqtt_status_topic:
             return
 
-        status_payload = self._build_status_payload()
+        with self._status_lock:
+            status_payload = self._build_status_payload()
 
-        try:
-            self.mqtt_client.publish(self.config.mqtt_status_topic, json.dumps(status_payload, ensure_ascii=False))
-            logging.info("已发布状态: %s", status_payload)
-        except Exception as exc:  # noqa: BLE001
-            logging.error("发布状态失败: %s", exc)
+            try:
+                result = self._mqtt_publish(
+                    self.config.mqtt_status_topic, json.dumps(status_payload, ensure_ascii=False)
+                )
+                self._status_pending = result.rc != mqtt.MQTT_ERR_SUCCESS
+                if self._status_pending:
+                    logging.warning("MQTT 未连接，状态将在连接成功后发布")
+                    return
+                self._last_status = status_payload
+                logging.info("已发布状态: %s", status_payload)
+            except Exception as exc:  # noqa: BLE001
+                logging.error("发布状态失败: %s", exc)
+
+    def publish_heartbeat(self):
+        """向状态主题发布心跳：只包含与上一条状态（或心跳）相比变化的字段，尚无基准时发布完整状态。"""
+
+        if not self.mqtt_client or not self.config.mqtt_status_topic or not self._mqtt_connected:
+            return
+
+        with self._status_lock:
+            status = self._build_status_payload()
+            if self._last_status is None:
+                payload = status
+            else:
+                changes = status_changes(
+                    {key: value for key, value in self._last_status.items() if key not in STATUS_IDENTITY_KEYS},
+                    {key: value for key, value in status.items() if key not in STATUS_IDENTITY_KEYS},
+                )
+                payload = {
+                    "message_type": "HEARTBEAT",
+                    "device_id": self.config.device_id,
+                    **changes,
+                    "timestamp": status["timestamp"],
+                }
+
+            try:
+                self._mqtt_publish(self.config.mqtt_status_topic, json.dumps(payload, ensure_ascii=False))
+                self._last_status = status
+                logging.debug("已发布心跳: %s", payload)
+            except Exception as exc:  # noqa: BLE001
+                logging.error("发布心跳失败: %s", exc)
 
     def publish_command_result(self, command: str, success: bool, message: str, data: Optional[Dict[str, Any]] = None):
         """向命令结果主题发送执行结果，无论成功或失败。"""
@@ -625,7 +6985,7 @@ class GPSPublisher:
             payload.update(data)
 
         try:
-            self.mqtt_client.publish(
+            self._mqtt_publish(
                 self.config.mqtt_command_result_topic,
                 json.dumps(payload, ensure_ascii=False),
             )
@@ -639,94 +6999,113 @@ class GPSPublisher:
         return {
             "message_type": "STATUS",
             "device_id": self.config.device_id,
-            "running": self.gps_streaming,
-            "serial_open": bool(self.ser and self.ser.is_open),
+            **self._receiver_stats(),
             "mqtt_connected": self._mqtt_connected,
-            "sent_count": self._data_count,
+            "history": self.history_writer.stats(),
+            "spool": self.spool.stats() if self.spool else None,
+            "track_lod": self.track_pyramid.stats() if self.track_pyramid else None,
+            "publish_window": {"qos": self.config.mqtt_qos, **self.publish_window.stats()},
+            "commands": self.command_executor.stats(),
+            "metrics": METRICS.summary(),
             "timestamp": datetime.utcnow().isoformat(),
             "system_info": self._collect_system_info(),
         }
 
-    def _collect_system_info(self) -> Dict[str, Any]:
-        """收集设备基础信息（CPU、内存、IP 地址等）。"""
+    def _receiver_stats(self) -> Dict[str, Any]:
+        """单个接收机的运行状态与处理计数。"""
 
-        info: Dict[str, Any] = {
-            "cpu_cores": os.cpu_count(),
+        return {
+            "running": self.gps_streaming,
+            "serial_open": bool(self.ser and self.ser.is_open),
+            "serial_port": self.serial_port.to_dict() if self.serial_port else None,
+            "serial_reconnect": self.serial_reconnect.stats(),
+            "receiver_config": self.receiver_config,
+            "sent_count": self._data_count,
+            "line_queue": self._line_buffer.stats(),
+            "nmea": self.nmea_parser.stats(),
+            "epoch_fusion": self.epoch_assembler.stats() if self.epoch_assembler else None,
+            "publish_batch": self.publish_batcher.stats() if self.publish_batcher else None,
+            "publish_filter": self.fix_filters.stats(),
+            "geofence": self.geofence.stats(),
+            "trips": self.trip_analyzer.stats(),
         }
 
-        try:
-            load1, load5, load15 = os.getloadavg()
-            info["cpu_load"] = {"1m": round(load1, 2), "5m": round(load5, 2), "15m": round(load15, 2)}
-        except OSError:
-            pass
-
-        memory_info = self._read_meminfo()
-        if memory_info:
-            info["memory"] = memory_info
-
-        ip_address = self._get_local_ip()
-        if ip_address:
-            info["ip_address"] = ip_address
-
-        return info
-
-    def _read_meminfo(self) -> Dict[str, Any]:
-        """从 /proc/meminfo 读取内存数据并转换为 MB。"""
-
-        meminfo_path = Path("/proc/meminfo")
-        if not meminfo_path.exists():
-            return {}
-
-        data: Dict[str, int] = {}
-        try:
-            for line in meminfo_path.read_text().splitlines():
-                if ":" not in line:
-                    continue
-                key, value = line.split(":", 1)
-                parts = value.strip().split()
-                if not parts:
-                    continue
-                # 数值单位以 kB 为主，这里转为 MB
-                try:
-                    kb_value = int(parts[0])
-                    data[key] = kb_value
-                except ValueError:
-                    continue
-
-            if not data:
-                return {}
-
-            total_kb = data.get("MemTotal", 0)
-            available_kb = data.get("MemAvailable", 0)
-            return {
-                "total_mb": round(total_kb / 1024, 2),
-                "available_mb": round(available_kb / 1024, 2),
-            }
-        except Exception:  # noqa: BLE001
-            return {}
+    def _collect_metrics(self) -> Iterator[MetricSample]:
+        """Prometheus 收集函数：导出时读取现有计数与各队列深度，不在热路径上重复计数。"""
+
+        yield from self._receiver_metric_samples()
+        yield from self._link_metric_samples()
+
+    def _receiver_metric_samples(self) -> Iterator[MetricSample]:
+        """单个接收机的解析结果、行缓冲区与发布计数。"""
+
+        labels = {"device": self.config.device_id}
+        nmea = self.nmea_parser.stats()
+        line_queue = self._line_buffer.stats()
+        for result in ("parsed", "checksum_errors", "malformed", "unhandled"):
+            yield "gps_nmea_sentences_total", "counter", "NMEA 行处理结果计数", {**labels, "result": result}, nmea[result]
+        yield "gps_line_queue_depth", "gauge", "串口行缓冲区当前行数", labels, line_queue["depth"]
+        yield "gps_line_queue_dropped_total", "counter", "串口行缓冲区溢出丢弃的行数", labels, line_queue["dropped"]
+        yield "gps_serial_open", "gauge", "串口是否已打开", labels, int(bool(self.ser and self.ser.is_open))
+        reconnect = self.serial_reconnect.stats()
+        yield "gps_serial_reconnects_total", "counter", "串口断开后自动恢复的次数", labels, reconnect["reconnects"]
+        yield "gps_serial_outage_seconds_total", "counter", "串口断线累计时长（秒）", labels, reconnect["total_outage_s"]
+        yield "gps_published_fixes_total", "counter", "已发布的定位条数", labels, self._data_count
+        yield (
+            "gps_filter_suppressed_total",
+            "counter",
+            "被发布前过滤链丢弃的定位条数",
+            labels,
+            self.fix_filters.stats()["suppressed"],
+        )
+        fences = self.geofence.stats()
+        yield "gps_fences_loaded", "gauge", "已加载的围栏数", labels, fences["fences"]
+        yield "gps_fence_inside", "gauge", "设备当前所在的围栏数", labels, len(fences["inside"])
+        for event in ("enter", "exit"):
+            yield (
+                "gps_fence_events_total",
+                "counter",
+                "围栏进出事件数",
+                {**labels, "event": event},
+                fences[f"{event}_events"],
+            )
+        trips = self.trip_analyzer.stats()
+        yield "gps_trips_total", "counter", "已结束并发布的行程数", labels, trips["trips"]
+        yield "gps_trip_distance_meters_total", "counter", "已结束行程的累计距离（米）", labels, trips["distance_m"]
+        yield "gps_trip_active", "gauge", "设备当前是否在行程中", labels, int(trips["current"] is not None)
+        if self.epoch_assembler:
+            yield "gps_epoch_pending", "gauge", "历元融合中等待的语句数", labels, self.epoch_assembler.stats()["pending"]
+
+    def _link_metric_samples(self) -> Iterator[MetricSample]:
+        """MQTT 连接、发送队列与历史写入器（多接收机时共用，只由监督者导出）。"""
+
+        labels = {"device": self.config.device_id}
+        history = self.history_writer.stats()
+        yield "gps_mqtt_connected", "gauge", "MQTT 是否已连接", labels, int(self._mqtt_connected)
+        window = self.publish_window.stats()
+        yield "gps_publish_inflight", "gauge", "发布窗口中已发布但尚未确认的定位消息数", labels, window["inflight"]
+        yield "gps_publish_queue_depth", "gauge", "发布窗口队列中等待发送的消息数", labels, window["queued"]
+        yield "gps_publish_dropped_total", "counter", "发布队列溢出或随断线丢失的消息数", labels, window["dropped"] + window["lost"]
+        yield "gps_history_pending", "gauge", "等待写入历史文件的记录数", labels, history["pending"]
+        yield "gps_history_written_total", "counter", "已写入历史文件的记录数", labels, history["written"]
+        yield "gps_history_dropped_total", "counter", "历史写入积压溢出丢弃的记录数", labels, history["dropped"]
+        if self.spool:
+            yield "gps_spool_pending_bytes", "gauge", "发送队列中待重放的字节数", labels, self.spool.stats()["pending_bytes"]
 
-    def _get_local_ip(self) -> str:
-        """尝试获取本地 IPv4 地址。"""
+    def _collect_system_info(self) -> Dict[str, Any]:
+        """设备基础信息（CPU、内存、IP 地址等），取自后台采样的缓存。"""
 
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-                sock.connect(("8.8.8.8", 80))
-                return sock.getsockname()[0]
-        except Exception:  # noqa: BLE001
-            return ""
+        return self.system_info.snapshot()
 
     def _on_control_message(self, client: mqtt.Client, userdata: Any, msg: mqtt.MQTTMessage):
-        """处理控制主题的指令消息并返回执行结果。"""
+        """paho 回调：解析控制命令并交给执行器排队，立即回复 accepted，不在网络线程中执行命令。"""
 
-        payload = msg.payload.decode("utf-8", errors="ignore").strip()
-        command = payload.lower()
+        self.command_executor.submit(parse_control_command(msg.payload))
 
-        try:
-            data = json.loads(payload)
-            command = str(data.get("command", command)).lower()
-        except json.JSONDecodeError:
-            pass
+    def _execute_command(self, control: ControlCommand) -> tuple[bool, str, Optional[Dict[str, Any]]]:
+        """在命令执行线程中执行一条控制命令，返回 (成功, 说明, 附加字段)。"""
 
+        command = control.command
         success = False
         message = "未知的命令"
         extra_data: Dict[str, Any] | None = None
@@ -753,15 +7132,32 @@ class GPSPublisher:
             extra_data = {"status": self._build_status_payload()}
             self.publish_status()
             message = "已返回设备状态"
+        elif command in {"reload_fences", "fences"}:
+            logging.info("收到 MQTT 控制命令: reload_fences")
+            try:
+                index = self.reload_geofences(control.data.get("geojson"))
+            except ValueError as exc:
+                message = f"围栏加载失败: {exc}"
+            else:
+                success = True
+                extra_data = {"geofence": self.geofence.stats()}
+                message = f"已加载 {len(index.fences) if index else 0} 个围栏"
         elif command == "help":
             logging.info("收到 MQTT 控制命令: help")
             success = True
             extra_data = {"commands": self.command_help}
             message = "命令列表已返回"
         else:
-            logging.warning("未知的控制命令: %s", payload)
+            logging.warning("未知的控制命令: %s", command)
+
+        return success, message, extra_data
 
-        self.publish_command_result(command, success, message, extra_data)
+    def _publish_command_outcome(
+        self, control: ControlCommand, success: bool, message: str, extra: Dict[str, Any]
+    ):
+        """发布命令的受理回执或最终结果（都带 command_id 与 phase）。"""
+
+        self.publish_command_result(control.command, success, message, {"command_id": control.command_id, **extra})
 
     def _close_serial(self):
         """安全关闭串口连接。"""
@@ -776,9 +7172,15 @@ class GPSPublisher:
     def cleanup_resources(self):
         """退出时释放串口和 MQTT 资源。"""
 
-        self.gps_streaming = False
-        self._close_serial()
+        # 先关闭发布窗口，发出暂存定位时不会因 block 策略队列已满而卡住
+        self.publish_window.close()
+        self.command_executor.stop()
+        self._shutdown_pipeline()
+        self._stop_monitoring()
+        if self.spool_drainer:
+            self.spool_drainer.stop()
 
+        self._flush_publish_window()
         try:
             if self.mqtt_client:
                 self.mqtt_client.loop_stop()
@@ -787,13 +7189,589 @@ class GPSPublisher:
         except Exception:  # noqa: BLE001
             pass
 
+        if self.spool:
+            self.spool.close()
+        self.history_writer.close()
 
-def build_config_from_args() -> tuple[PublisherConfig, Optional[tuple[float, float, float]]]:
-    """解析命令行参数并返回配置与可选的手动发布参数。"""
+        for server in (self._history_http, self._metrics_http):
+            if server:
+                server.shutdown()
+                server.server_close()
+        self._history_http = None
+        self._metrics_http = None
+        if self.track_pyramid:
+            self.track_pyramid.stop()
+
+    def _flush_publish_window(self, timeout: float = 5.0):
+        """退出前等待发布窗口中的消息确认，仍未确认的写入断线发送队列（未启用时丢弃）。"""
+
+        self.publish_window.wait_drained(timeout)
+        self._spool_pending_window()
+
+    def _spool_pending_window(self):
+        """把发布窗口中剩余的消息交给断线发送队列。"""
+
+        pending = self.publish_window.take_pending()
+        for message in pending:
+            self._on_message_overflow(message)
+        if pending:
+            logging.info("退出时仍有 %d 条消息未确认", len(pending))
+
+    def _shutdown_pipeline(self):
+        """关闭串口并发出历元融合、过滤器与批处理中暂存的定位，以及进行中行程的摘要。"""
+
+        self.gps_streaming = False
+        self.serial_reconnect.cancel()
+        self._close_serial()
+        self._stop_reader_thread()
+
+        if self.epoch_assembler:
+            with contextlib.suppress(Exception):
+                for fix in self.epoch_assembler.flush():
+                    self._publish_fix(fix)
+        with contextlib.suppress(Exception):
+            for fix in self.fix_filters.flush():
+                self._publish_filtered(fix)
+        if self.publish_batcher:
+            with contextlib.suppress(Exception):
+                batch = self.publish_batcher.flush()
+                if batch:
+                    self._publish_batch(batch, self.config.mqtt_topic)
+        with contextlib.suppress(Exception):
+            for trip in self.trip_analyzer.flush():
+                self.publish_trip_summary(trip)
+
+
+def discover_receivers(base_device_id: str) -> list[tuple[str, str]]:
+    """枚举可用串口作为接收机，设备 ID 取 <基础ID>-<USB 序列号或串口名>，保证重插后不变。"""
+
+    receivers = []
+    for port in sorted(serial.tools.list_ports.comports(), key=lambda item: item.device):
+        suffix = getattr(port, "serial_number", None) or os.path.basename(port.device)
+        receivers.append((port.device, f"{base_device_id}-{suffix}"))
+    return receivers
+
+
+def parse_receivers(spec: str, base_device_id: str) -> list[tuple[str, str]]:
+    """解析 "串口=设备ID,..." 形式的接收机列表；"auto" 表示自动发现，省略设备 ID 时按串口名生成。"""
+
+    if spec.strip().lower() == "auto":
+        return discover_receivers(base_device_id)
+
+    receivers = []
+    for item in (part.strip() for part in spec.split(",")):
+        if not item:
+            continue
+        port, _, device_id = item.partition("=")
+        port = port.strip()
+        device_id = device_id.strip() or f"{base_device_id}-{os.path.basename(port)}"
+        receivers.append((port, device_id))
+
+    device_ids = [device_id for _, device_id in receivers]
+    if len(set(device_ids)) != len(device_ids):
+        raise ValueError(f"接收机设备 ID 重复: {', '.join(device_ids)}")
+    return receivers
+
+
+class ReceiverSupervisor(GPSPublisher):
+    """多接收机模式：每个串口一个 GPSPublisher（各自的读取线程与处理线程），
+    共用一个 MQTT 连接、一个历史写入器和断线发送队列；控制命令按 device_id 分发。
+    """
+
+    def __init__(self, config: PublisherConfig, receivers: list[tuple[str, str]]):
+        """receivers 为 (串口, 设备 ID) 列表。"""
+
+        super().__init__(config)
+        # 围栏文件只由监督者加载，各接收机共用同一个围栏集合
+        self.receivers: Dict[str, GPSPublisher] = {
+            device_id: GPSPublisher(
+                replace(config, port=port, device_id=device_id, fence_file=None),
+                self.history_writer,
+            )
+            for port, device_id in receivers
+        }
+        self._set_geofence_index(self.geofence.index)
+        # 各接收机的指标由监督者统一导出，共用的连接与历史写入器只导出一份
+        for receiver in self.receivers.values():
+            METRICS.unregister_collector(receiver._collect_metrics)
+        self._workers: list[threading.Thread] = []
+        self.command_help = {
+            **self.command_help,
+            "start/stop + device_id": "只启动或停止指定设备，省略 device_id 时作用于全部设备",
+        }
+
+    def run(self):
+        """连接 MQTT 后为每个接收机启动处理线程，阻塞直到中断。"""
+
+        if self.service_active:
+            logging.warning("GPS 服务已在运行中")
+            return
+
+        self.service_active = True
+        try:
+            self._initialize_mqtt()
+            self._start_history_http()
+            self._start_metrics_http()
+            self._start_monitoring()
+            for device_id, receiver in self.receivers.items():
+                worker = threading.Thread(
+                    target=self._receiver_main,
+                    args=(receiver,),
+                    name=f"receiver-{device_id}",
+                    daemon=True,
+                )
+                worker.start()
+                self._workers.append(worker)
+            logging.info("多接收机模式已启动: %s", ", ".join(f"{r.config.port}={d}" for d, r in self.receivers.items()))
+
+            while self.service_active:
+                time.sleep(1.0)
+
+        except KeyboardInterrupt:
+            logging.info("收到中断信号，准备退出...")
+        except Exception as exc:  # noqa: BLE001
+            logging.error("GPS 发布器错误: %s", exc)
+        finally:
+            self.service_active = False
+            self.cleanup_resources()
+
+    def _receiver_main(self, receiver: GPSPublisher):
+        """接收机处理线程：打开串口（各接收机并行发送配置命令）后进入处理循环。"""
+
+        receiver.service_active = True
+        receiver.start_streaming()
+        receiver._process_loop()
+
+    def _create_mqtt_client(self):
+        """创建共用的 MQTT 客户端，并把连接状态、发送队列同步给各接收机。"""
+
+        super()._create_mqtt_client()
+        client = self.mqtt_client
+        on_connect, on_disconnect = client.on_connect, client.on_disconnect
+
+        def _on_connect(client, userdata, flags, rc):
+            """连接结果同步给各接收机，并补发各接收机连接前未能发布的状态。"""
+
+            on_connect(client, userdata, flags, rc)
+            self._sync_receivers()
+            if rc == 0:
+                for receiver in self.receivers.values():
+                    if receiver._status_pending:
+                        receiver.publish_status()
+
+        def _on_disconnect(client, userdata, rc):
+            """断开状态同步给各接收机，使其改写发送队列。"""
+
+            on_disconnect(client, userdata, rc)
+            self._sync_receivers()
+
+        client.on_connect = _on_connect
+        client.on_disconnect = _on_disconnect
+        client.on_message = self._dispatch_control_message
+        self._sync_receivers()
+
+    def _sync_receivers(self):
+        """各接收机共用本对象的 MQTT 客户端、连接状态与发送队列。"""
+
+        for receiver in self.receivers.values():
+            receiver.mqtt_client = self.mqtt_client
+            receiver.spool = self.spool
+            receiver._mqtt_connected = self._mqtt_connected
+            receiver.publish_window = self.publish_window
+
+    def _set_geofence_index(self, index: Optional[GeofenceIndex]):
+        """围栏集合由监督者加载，同时替换各接收机的围栏（限定设备的围栏由各接收机自行筛选）。"""
+
+        super()._set_geofence_index(index)
+        for receiver in self.receivers.values():
+            receiver.geofence.set_index(index)
+
+    def _dispatch_control_message(self, client: mqtt.Client, userdata: Any, msg: mqtt.MQTTMessage):
+        """按 device_id 分发控制命令：指定设备时交给该接收机，start/stop 省略时分发给全部接收机，其余命令（含围栏重载）由监督者汇总回复。"""
+
+        control = parse_control_command(msg.payload)
+        device_id = control.data.get("device_id")
+
+        if control.command in {"reload_fences", "fences"}:
+            # 围栏集合为各接收机共用，限定设备写在 GeoJSON 的 properties.devices 中
+            self.command_executor.submit(control)
+            return
+
+        if device_id and device_id != self.config.device_id:
+            receiver = self.receivers.get(device_id)
+            if receiver is None:
+                logging.warning("控制命令指定了未知设备: %s", device_id)
+                self._publish_command_outcome(control, False, f"未知的设备: {device_id}", {"phase": "rejected"})
+                return
+            receiver.command_executor.submit(control)
+            return
+
+        if control.command in {"start", "resume", "stop", "pause"}:
+            # 各接收机的执行线程并行打开串口，同一条命令使用相同的 command_id
+            for receiver in self.receivers.values():
+                receiver.command_executor.submit(control)
+            return
+
+        self.command_executor.submit(control)
+
+    def _collect_metrics(self) -> Iterator[MetricSample]:
+        """导出每台接收机的计数与一份共用连接、历史写入器的指标。"""
+
+        for receiver in self.receivers.values():
+            yield from receiver._receiver_metric_samples()
+        yield from self._link_metric_samples()
+
+    def _receiver_stats(self) -> Dict[str, Any]:
+        """汇总各接收机的状态，并在 devices 中给出每台设备的计数。"""
+
+        devices = {
+            device_id: {"port": receiver.config.port, **receiver._receiver_stats()}
+            for device_id, receiver in self.receivers.items()
+        }
+        return {
+            "running": any(device["running"] for device in devices.values()),
+            "serial_open": any(device["serial_open"] for device in devices.values()),
+            "sent_count": sum(device["sent_count"] for device in devices.values()),
+            "devices": devices,
+        }
+
+    def cleanup_resources(self):
+        """停止各接收机并发出暂存定位后，再关闭共用的 MQTT 连接与历史写入器。"""
+
+        # 处理线程可能正阻塞在已满的发布队列上，先关闭共用的发布窗口再等待线程退出
+        self.publish_window.close()
+        for receiver in self.receivers.values():
+            receiver.service_active = False
+            receiver.command_executor.stop()
+        for worker in self._workers:
+            worker.join(timeout=2)
+        self._workers = []
+        for receiver in self.receivers.values():
+            receiver._shutdown_pipeline()
+        super().cleanup_resources()
+
+
+class AsyncGPSPublisher(GPSPublisher):
+    """asyncio 运行模式：串口与 MQTT 套接字都注册到同一个事件循环，控制命令在事件循环中排队执行。
+
+    串口与采集状态只在事件循环线程中修改，不再需要串口读取线程和 paho 网络线程；
+    历史写入仍由 HistoryWriter 的后台线程完成，事件循环中只做入队。
+    """
+
+    def __init__(self, config: PublisherConfig):
+        """初始化事件循环相关状态，事件循环在 run() 中创建。"""
+
+        super().__init__(config)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[threading.Thread] = None
+        self._stop_event: Optional[asyncio.Event] = None
+        self._timer_wakeup: Optional[asyncio.Event] = None
+        self._serial_fd: Optional[int] = None
+        self._serial_partial = bytearray()
+        self._configuring: Optional[asyncio.Task] = None
+        self._tasks: set[asyncio.Task] = set()
+        # 命令在事件循环中执行（start 发送配置命令用 call_later，不阻塞），不需要执行线程
+        self.command_executor.threaded = False
+        self.command_executor.on_submit = self._schedule_control_commands
+        if self.publish_window.policy == "block":
+            logging.warning("asyncio 模式下发布队列不能阻塞（确认也在事件循环中处理），改用 drop-oldest")
+            self.publish_window.policy = "drop-oldest"
+        # 重连线程只负责等待设备与打开串口，配置接收机、注册读取和发布状态都回到事件循环
+        self.serial_reconnect.on_recovered = lambda: self._call_in_loop(self.publish_status)
+
+    def run(self):
+        """在新的事件循环中运行服务，直到收到 SIGINT/SIGTERM。"""
+
+        if self.service_active:
+            logging.warning("GPS 服务已在运行中")
+            return
+
+        try:
+            asyncio.run(self.run_async())
+        except KeyboardInterrupt:
+            logging.info("收到中断信号，准备退出...")
+
+    async def run_async(self):
+        """服务主协程：连接 MQTT、启动采集并等待停止信号。"""
+
+        self.service_active = True
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.current_thread()
+        self._stop_event = asyncio.Event()
+        self._timer_wakeup = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            with contextlib.suppress(NotImplementedError, RuntimeError):
+                self._loop.add_signal_handler(sig, self._stop_event.set)
+
+        try:
+            self._create_mqtt_client()
+            self._attach_mqtt_to_loop()
+            self._start_history_http()
+            self._start_metrics_http()
+            self._start_monitoring()
+            self._spawn(self._mqtt_supervisor())
+            self._spawn(self._timer_loop())
+            self.start_streaming()
+            await self._stop_event.wait()
+            logging.info("收到中断信号，准备退出...")
+        except Exception as exc:  # noqa: BLE001
+            logging.error("GPS 发布器错误: %s", exc)
+        finally:
+            self.service_active = False
+            for task in list(self._tasks):
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            # 确认也在事件循环中处理，不能在 cleanup_resources 中阻塞等待
+            deadline = self._loop.time() + 5.0
+            while self._mqtt_connected and self.publish_window.pending() and self._loop.time() < deadline:
+                await asyncio.sleep(0.05)
+            self.cleanup_resources()
+
+    def stop(self):
+        """请求退出事件循环（可在其他线程调用）。"""
+
+        if self._loop and self._stop_event:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+
+    def _spawn(self, coro) -> asyncio.Task:
+        """创建后台任务并保留引用，退出时统一取消。"""
+
+        task = self._loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _call_in_loop(self, func: Callable[..., Any], *args: Any):
+        """在事件循环线程中执行：已在循环线程则直接调用，否则线程安全地排入循环。"""
+
+        if threading.current_thread() is self._loop_thread:
+            func(*args)
+        else:
+            self._loop.call_soon_threadsafe(func, *args)
+
+    def _start_monitoring(self):
+        """设备信息仍由后台线程采样，心跳改为事件循环中的任务（所有发布都在循环线程中进行）。"""
+
+        self.system_info.start()
+        if self.config.heartbeat_interval > 0:
+            self._spawn(self._heartbeat_task())
+
+    async def _heartbeat_task(self):
+        """每 heartbeat_interval 秒发布一次心跳。"""
+
+        while True:
+            await asyncio.sleep(self.config.heartbeat_interval)
+            self.publish_heartbeat()
+
+    # ---------------------- MQTT ---------------------------
+    def _attach_mqtt_to_loop(self):
+        """用 paho 的套接字回调把 MQTT 读写交给事件循环。"""
+
+        client = self.mqtt_client
+        client.on_socket_open = lambda _client, _userdata, sock: self._call_in_loop(self._on_mqtt_socket_open, sock)
+        client.on_socket_close = lambda _client, _userdata, sock: self._call_in_loop(self._on_mqtt_socket_close, sock)
+        client.on_socket_register_write = lambda _client, _userdata, sock: self._call_in_loop(
+            self._loop.add_writer, sock, client.loop_write
+        )
+        client.on_socket_unregister_write = lambda _client, _userdata, sock: self._call_in_loop(
+            self._remove_writer, sock
+        )
+
+    def _on_mqtt_socket_open(self, sock):
+        """MQTT 套接字建立后开始监听可读事件。"""
+
+        self._loop.add_reader(sock, self.mqtt_client.loop_read)
+
+    def _on_mqtt_socket_close(self, sock):
+        """MQTT 套接字关闭时取消监听。"""
+
+        with contextlib.suppress(ValueError, OSError):
+            self._loop.remove_reader(sock)
+        self._remove_writer(sock)
+
+    def _remove_writer(self, sock):
+        """取消监听可写事件（套接字可能已关闭）。"""
+
+        with contextlib.suppress(ValueError, OSError):
+            self._loop.remove_writer(sock)
+
+    async def _mqtt_supervisor(self):
+        """维持 MQTT 连接：断开后按指数退避重连，连接期间每秒执行 loop_misc（心跳与超时检查）。"""
+
+        delay = 1.0
+        first = True
+        while True:
+            if self.mqtt_client.socket() is None:
+                if first:
+                    logging.info("MQTT 连接中: %s:%s", self.config.mqtt_host, self.config.mqtt_port)
+                try:
+                    # 连接（含 DNS 解析）可能阻塞数秒，放到线程池中执行；套接字回调会转回事件循环
+                    await self._loop.run_in_executor(None, self._mqtt_connect, first)
+                    first = False
+                    delay = 1.0
+                except (OSError, ValueError) as exc:
+                    logging.error("MQTT 连接失败: %s，%.0f 秒后重试", exc, delay)
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 60.0)
+                    continue
+            self.mqtt_client.loop_misc()
+            await asyncio.sleep(1.0)
+
+    def _mqtt_connect(self, first: bool):
+        """首次连接或重连。"""
+
+        if first:
+            self.mqtt_client.connect(self.config.mqtt_host, self.config.mqtt_port, 60)
+        else:
+            self.mqtt_client.reconnect()
+
+    def _schedule_control_commands(self):
+        """有新命令入队：在事件循环的下一轮执行（先让 accepted 回执发出）。"""
+
+        self._call_in_loop(self._loop.call_soon, self.command_executor.run_pending)
+
+    # ---------------------- 串口 ---------------------------
+    def send_gps_commands(self):
+        """配置需要阻塞读取应答，放到线程池中执行，完成后再把串口注册到事件循环。"""
+
+        if self.ser:
+            self._configuring = self._spawn(self._configure_receiver_async(self.ser))
+
+    def _flush_publish_window(self, timeout: float = 5.0):
+        """run_async 已在事件循环中等待过确认，这里只转存剩余消息。"""
+
+        self._spool_pending_window()
+
+    def _reopen_serial(self) -> bool:
+        """重连线程调用：在事件循环中完成重新打开（打开串口本身放到线程池），等待结果。"""
+
+        future = None
+        try:
+            future = asyncio.run_coroutine_threadsafe(self._reopen_serial_async(), self._loop)
+            return future.result(timeout=max(60.0, self.config.probe_timeout * 2))
+        except (concurrent.futures.TimeoutError, RuntimeError) as exc:
+            # 超时或事件循环已关闭（正在退出）
+            logging.warning("串口重连未完成: %s", exc)
+            if future:
+                future.cancel()
+            return False
+
+    async def _reopen_serial_async(self) -> bool:
+        """打开串口（可能需要探测，放到线程池）后按启动流程配置接收机并注册读取。"""
+
+        if not self.gps_streaming:
+            return True
+        try:
+            await self._loop.run_in_executor(None, self._initialize_serial)
+        except Exception as exc:  # noqa: BLE001
+            logging.warning("串口重连失败: %s", exc)
+            self.serial_reconnect.last_error = str(exc)
+            return False
+        if not self.gps_streaming:
+            # 打开期间收到 stop 命令
+            self._close_serial()
+            return True
+        self.send_gps_commands()
+        return True
+
+    async def _configure_receiver_async(self, ser: serial.Serial):
+        """等待线程池中的配置完成；串口仍在使用时开始监听读取。"""
+
+        try:
+            await self._loop.run_in_executor(None, self._configure_receiver, ser)
+        finally:
+            self._configuring = None
+        if ser is self.ser and self.gps_streaming:
+            self._start_reader_thread()
+        if self._status_pending:
+            self.publish_status()
+
+    def publish_status(self):
+        """接收机配置期间推迟发布状态：与线程模式一致，采集状态在配置完成、串口开始读取后发布。"""
+
+        if self._configuring is not None:
+            self._status_pending = True
+            return
+        super().publish_status()
+
+    def _start_reader_thread(self):
+        """把串口文件描述符注册到事件循环，代替读取线程（需要 POSIX 串口）。"""
+
+        if not self.ser or self._configuring:
+            # 配置期间串口由配置线程独占，完成后由 _configure_receiver_async 注册
+            return
+
+        self._serial_partial.clear()
+        self.ser.timeout = 0
+        self._serial_fd = self.ser.fileno()
+        self._loop.add_reader(self._serial_fd, self._on_serial_readable, self.ser)
+
+    def _stop_reader_thread(self):
+        """从事件循环注销串口。"""
+
+        if self._serial_fd is not None and self._loop:
+            with contextlib.suppress(ValueError, OSError):
+                self._loop.remove_reader(self._serial_fd)
+        self._serial_fd = None
+
+    def _close_serial(self):
+        """先注销文件描述符再关闭串口，避免事件循环监听已关闭的描述符。"""
+
+        self._stop_reader_thread()
+        super()._close_serial()
+
+    def _on_serial_readable(self, ser: serial.Serial):
+        """串口可读：读出已到达的字节，按行处理，残余半行留到下次。"""
+
+        try:
+            chunk = ser.read(ser.in_waiting or 1)
+        except (serial.SerialException, OSError, TypeError) as exc:
+            self._serial_lost(ser, exc)
+            return
+
+        self.metrics.serial_bytes.inc(len(chunk))
+        buffer = self._serial_partial
+        buffer += chunk
+        start = 0
+        while (end := buffer.find(b"\n", start)) >= 0:
+            line_bytes = bytes(buffer[start : end + 1])
+            start = end + 1
+            self.metrics.serial_lines.inc()
+            try:
+                self._process_line(line_bytes)
+            except Exception as exc:  # noqa: BLE001
+                logging.error("处理数据时出错: %s", exc)
+        del buffer[:start]
+        if len(buffer) > 4096:
+            # 长时间没有换行说明波特率不匹配或收到噪声，丢弃以免无限增长
+            buffer.clear()
+        self._timer_wakeup.set()
+
+    async def _timer_loop(self):
+        """定时任务：在历元融合与批量发布的截止时刻执行 _poll_timers，新数据到达时重新计算等待时间。"""
+
+        while True:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._timer_wakeup.wait(), self._next_timer_timeout())
+            self._timer_wakeup.clear()
+            try:
+                self._poll_timers()
+            except Exception as exc:  # noqa: BLE001
+                logging.error("处理数据时出错: %s", exc)
+
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    """构造命令行参数解析器。"""
 
     parser = argparse.ArgumentParser(description="GPS 串口到 MQTT 发布器（命令行版）")
-    parser.add_argument("--port", help="串口名称，例如 /dev/ttyAMA0")
-    parser.add_argument("--baud", type=int, help="串口波特率")
+    parser.add_argument("--port", help="串口名称，例如 /dev/ttyAMA0；auto 表示自动探测输出 NMEA 的串口")
+    parser.add_argument("--baud", type=int, help="串口波特率（0 表示自动探测）")
+    parser.add_argument("--probe-bauds", help="自动探测时依次尝试的波特率，逗号分隔")
+    parser.add_argument("--probe-timeout", type=float, help="自动探测的最长时间（秒）")
+    parser.add_argument("--port-cache", type=Path, help="保存探测结果的文件，下次启动直接使用")
+    parser.add_argument("--no-port-cache", action="store_true", help="不读写探测结果缓存")
+    parser.add_argument("--no-serial-reconnect", action="store_true", help="串口断开后停止采集，不自动重连")
+    parser.add_argument("--reconnect-max-delay", type=float, help="串口重连的最大退避时间（秒）")
     parser.add_argument("--mqtt-host", help="MQTT 服务器地址")
     parser.add_argument("--mqtt-port", type=int, help="MQTT 端口")
     parser.add_argument("--mqtt-user", help="MQTT 用户名")
@@ -803,15 +7781,153 @@ def build_config_from_args() -> tuple[PublisherConfig, Optional[tuple[float, flo
     parser.add_argument("--mqtt-control-topic", help="MQTT 控制主题，用于 start/stop/status")
     parser.add_argument("--mqtt-status-topic", help="MQTT 状态主题，用于发布设备状态")
     parser.add_argument("--mqtt-command-result-topic", help="MQTT 命令结果主题，用于接收命令执行反馈")
+    parser.add_argument("--mqtt-fence-topic", help="MQTT 围栏事件主题，用于发布进入/离开事件")
+    parser.add_argument("--fences", type=Path, help="围栏文件（GeoJSON 多边形或带 radius_m 的圆）")
+    parser.add_argument("--no-fences", action="store_true", help="不加载围栏，不判定 isInsideFence")
+    parser.add_argument("--fence-hysteresis", type=float, help="围栏进出判定的滞回距离（米）")
+    parser.add_argument("--mqtt-trip-topic", help="MQTT 行程主题，用于发布行程摘要")
+    parser.add_argument("--trip-speed", type=float, help="视为移动的最低速度（m/s）")
+    parser.add_argument("--trip-dwell", type=float, help="最后一次移动后停留多久结束行程（秒）")
+    parser.add_argument("--trip-min-distance", type=float, help="短于该距离（米）的行程视为漂移，不发布")
+    parser.add_argument("--sentences", help="接收机启用的语句，逗号分隔，例如 RMC,GGA")
+    parser.add_argument("--rate-hz", type=float, help="接收机输出频率：1、2、5 或 10 Hz（0 表示保持接收机设置）")
+    parser.add_argument("--receiver-baud", type=int, help="启动时把接收机切换到的波特率（0 表示不切换）")
+    parser.add_argument("--queue-size", type=int, help="串口行缓冲区容量（行数）")
+    parser.add_argument("--queue-policy", choices=QUEUE_POLICIES, help="串口行缓冲区溢出策略")
+    parser.add_argument("--mqtt-qos", type=int, choices=(0, 1), help="定位消息的 MQTT QoS")
+    parser.add_argument("--max-inflight", type=int, help="最多已发出尚未确认的定位消息数")
+    parser.add_argument("--publish-queue-size", type=int, help="发布队列容量（消息条数）")
+    parser.add_argument("--publish-queue-policy", choices=QUEUE_POLICIES, help="发布队列满时的策略")
+    parser.add_argument(
+        "--history-after-ack",
+        action="store_true",
+        default=None,
+        help="服务器确认后才写入历史（QoS 0 为写入套接字后）",
+    )
+    parser.add_argument("--history-file", type=Path, help="历史文件路径（JSON Lines）")
+    parser.add_argument("--history-batch-size", type=int, help="历史记录批量写入条数")
+    parser.add_argument("--history-batch-interval", type=float, help="历史记录批量写入时间窗口（秒）")
+    parser.add_argument("--history-fsync", choices=FSYNC_POLICIES, help="历史文件落盘策略")
+    parser.add_argument("--history-fsync-interval", type=float, help="按间隔落盘时的间隔（秒）")
+    parser.add_argument("--history-rotate-bytes", type=int, help="历史文件滚动大小（字节，0 表示不限）")
+    parser.add_argument(
+        "--history-rotate-daily",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help="历史文件是否按天滚动",
+    )
+    parser.add_argument("--history-compression", choices=HISTORY_COMPRESSIONS, help="历史分段压缩方式")
+    parser.add_argument("--history-retention-bytes", type=int, help="历史文件总大小上限（字节，0 表示不限）")
+    parser.add_argument("--history-raw", choices=HISTORY_RAW_MODES, help="历史记录中原始负载的保存方式")
+    parser.add_argument("--history-backend", choices=HISTORY_BACKENDS, help="历史存储后端")
+    parser.add_argument("--history-binary-dir", type=Path, help="二进制历史存储目录")
+    parser.add_argument(
+        "--convert-history",
+        action="store_true",
+        help="将现有 history.jsonl（含分段）转换为二进制历史存储后退出",
+    )
+    parser.add_argument("--history-http-host", help="历史查询 HTTP 服务监听地址")
+    parser.add_argument("--history-http-port", type=int, help="历史查询 HTTP 服务端口（常规运行时 0 表示不启动）")
+    parser.add_argument("--serve-history", action="store_true", help="仅启动历史查询 HTTP 服务")
+    parser.add_argument("--track-lod-dir", type=Path, help="地图轨迹金字塔缓存目录")
+    parser.add_argument("--no-track-lod", action="store_true", help="不提供 GET /track 简化轨迹")
+    parser.add_argument("--track-lod-tolerance", type=float, help="轨迹金字塔各级别的简化误差（屏幕像素）")
+    parser.add_argument(
+        "--build-track-lod",
+        action="store_true",
+        help="从历史重建轨迹金字塔缓存后退出（可用 --query-device/--query-start/--query-end 限定范围）",
+    )
+    parser.add_argument("--metrics-host", help="运行指标（Prometheus）HTTP 服务监听地址")
+    parser.add_argument("--metrics-port", type=int, help="运行指标 HTTP 服务端口（0 表示不启动）")
+    parser.add_argument("--sysinfo-interval", type=float, help="设备信息后台采样周期（秒）")
+    parser.add_argument("--heartbeat-interval", type=float, help="心跳发布周期（秒，0 表示不发送）")
+    parser.add_argument("--query", action="store_true", help="查询历史轨迹并输出到标准输出后退出")
+    parser.add_argument("--query-device", help="查询的设备 ID（缺省为全部设备）")
+    parser.add_argument("--query-start", help="查询起始时间（Unix 时间戳、YYYY/MM/DD HH:MM:SS 或 ISO 8601）")
+    parser.add_argument("--query-end", help="查询结束时间")
+    parser.add_argument("--query-bbox", help="查询范围：最小经度,最小纬度,最大经度,最大纬度")
+    parser.add_argument("--query-format", choices=("ndjson", "json"), default="ndjson", help="查询输出格式")
+    parser.add_argument("--query-limit", type=int, help="最多输出条数")
+    parser.add_argument(
+        "--trips",
+        action="store_true",
+        help="统计历史中的行程并输出摘要后退出（可用 --query-device/--query-start/--query-end 限定范围）",
+    )
+    parser.add_argument(
+        "--epoch-fusion",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help="是否将同一 UTC 时刻的 RMC/GLL/GGA 合并为一条消息",
+    )
+    parser.add_argument("--epoch-sentences", help="一个历元应包含的语句，逗号分隔，例如 RMC,GLL,GGA")
+    parser.add_argument("--epoch-timeout", type=float, help="历元收集超时（秒）")
+    parser.add_argument("--payload-encoding", choices=PAYLOAD_ENCODINGS, help="定位消息编码：json 或 compact")
+    parser.add_argument("--batch-size", type=int, help="每条 MQTT 消息合并的定位条数（1 表示不合并）")
+    parser.add_argument("--batch-interval-ms", type=int, help="批量发布的最长等待时间（毫秒）")
+    parser.add_argument("--filters", help="发布前过滤链，逗号分隔，例如 deadband,simplify")
+    parser.add_argument("--deadband-m", type=float, help="死区距离（米）")
+    parser.add_argument("--deadband-heading", type=float, help="死区航向变化阈值（度）")
+    parser.add_argument("--simplify-tolerance", type=float, help="轨迹简化容差（米）")
+    parser.add_argument("--max-silence", type=float, help="过滤时最长不发布的时间（秒）")
+    parser.add_argument("--replay", type=Path, help="回放记录的 NMEA 文件（可为 .gz/.zst）后退出")
+    parser.add_argument("--speed", default="1x", help="回放速度：倍速（如 10x）或 max（尽快）")
+    parser.add_argument(
+        "--receivers",
+        help='多接收机模式："/dev/ttyUSB0=gps-01,/dev/ttyUSB1=gps-02" 或 "auto"（共用一个 MQTT 连接）',
+    )
+    parser.add_argument(
+        "--async",
+        dest="async_mode",
+        action="store_true",
+        help="以 asyncio 事件循环运行（串口与 MQTT 共用一个线程，需要 POSIX 串口；不能与多接收机模式同时使用）",
+    )
+    parser.add_argument("--spool-dir", type=Path, help="MQTT 断线发送队列目录")
+    parser.add_argument("--no-spool", action="store_true", help="断线时不缓存未发出的消息")
+    parser.add_argument("--spool-max-bytes", type=int, help="发送队列容量上限（字节，0 表示不限）")
+    parser.add_argument("--spool-rate", type=float, help="重连后每秒重放的消息数（0 表示不限速）")
     parser.add_argument("--manual-lng", type=float, help="手动发布经度")
     parser.add_argument("--manual-lat", type=float, help="手动发布纬度")
     parser.add_argument("--manual-speed", type=float, help="手动发布速度 (m/s)")
     parser.add_argument("--manual", action="store_true", help="仅发布一次手动数据后退出")
+    parser.add_argument(
+        "--manual-file",
+        type=Path,
+        help="从 CSV/JSONL 文件（可为 .gz，- 表示标准输入）批量手动发布后退出",
+    )
+    parser.add_argument("--manual-rate", type=float, help="批量手动发布每秒条数（0 表示不限速）")
+    parser.add_argument("--manual-window", type=int, help="批量手动发布时最多未确认的消息数")
+    return parser
+
+
+def build_config_from_args(
+    args: Optional[argparse.Namespace] = None,
+) -> tuple[PublisherConfig, Optional[tuple[float, float, float]]]:
+    """解析命令行参数并返回配置与可选的手动发布参数。"""
 
-    args = parser.parse_args()
+    if args is None:
+        args = build_arg_parser().parse_args()
 
     port = args.port if args.port is not None else SERIAL_PORT
+    if port and port.lower() == "auto":
+        port = ""
+    probe_baudrates = (
+        tuple(int(part) for part in args.probe_bauds.split(",") if part.strip())
+        if args.probe_bauds
+        else SERIAL_PROBE_BAUDRATES
+    )
     baud = args.baud if args.baud is not None else SERIAL_BAUDRATE
+    sentences = (
+        tuple(part.strip().upper() for part in args.sentences.split(",") if part.strip())
+        if args.sentences
+        else RECEIVER_SENTENCES
+    )
+    if args.epoch_sentences:
+        epoch_sentences = tuple(part.strip().upper() for part in args.epoch_sentences.split(",") if part.strip())
+    elif args.sentences:
+        # 只等待接收机实际输出、且能提供定位的语句，避免每个历元都等到超时
+        epoch_sentences = tuple(name for name in sentences if name in EpochAssembler.POSITION_SOURCES)
+    else:
+        epoch_sentences = EPOCH_FUSION_SENTENCES
 
     config = PublisherConfig(
         port=port or "",  # 空字符串将在运行时自动检测
@@ -825,7 +7941,70 @@ def build_config_from_args() -> tuple[PublisherConfig, Optional[tuple[float, flo
         mqtt_status_topic=args.mqtt_status_topic or MQTT_STATUS_TOPIC,
         mqtt_command_result_topic=args.mqtt_command_result_topic or MQTT_COMMAND_RESULT_TOPIC,
         device_id=args.device_id or DEVICE_ID,
-        history_file=HISTORY_FILE,
+        history_file=args.history_file or HISTORY_FILE,
+        receiver_sentences=sentences,
+        receiver_rate_hz=args.rate_hz if args.rate_hz is not None else RECEIVER_RATE_HZ,
+        receiver_baudrate=args.receiver_baud if args.receiver_baud is not None else RECEIVER_BAUDRATE,
+        probe_baudrates=probe_baudrates,
+        probe_timeout=args.probe_timeout or SERIAL_PROBE_TIMEOUT,
+        port_cache=None if args.no_port_cache else (args.port_cache or SERIAL_PORT_CACHE),
+        serial_reconnect=SERIAL_RECONNECT and not args.no_serial_reconnect,
+        serial_reconnect_max_delay=args.reconnect_max_delay or SERIAL_RECONNECT_MAX_DELAY,
+        queue_size=args.queue_size or SERIAL_QUEUE_SIZE,
+        queue_policy=args.queue_policy or SERIAL_QUEUE_POLICY,
+        mqtt_qos=args.mqtt_qos if args.mqtt_qos is not None else MQTT_QOS,
+        mqtt_max_inflight=args.max_inflight or MQTT_MAX_INFLIGHT,
+        mqtt_queue_size=args.publish_queue_size or MQTT_QUEUE_SIZE,
+        mqtt_queue_policy=args.publish_queue_policy or MQTT_QUEUE_POLICY,
+        history_after_ack=args.history_after_ack if args.history_after_ack is not None else HISTORY_AFTER_ACK,
+        mqtt_fence_topic=args.mqtt_fence_topic or MQTT_FENCE_TOPIC,
+        fence_file=None if args.no_fences else (args.fences or FENCE_FILE),
+        fence_hysteresis_m=args.fence_hysteresis if args.fence_hysteresis is not None else FENCE_HYSTERESIS_M,
+        mqtt_trip_topic=args.mqtt_trip_topic or MQTT_TRIP_TOPIC,
+        trip_moving_speed_ms=args.trip_speed if args.trip_speed is not None else TRIP_MOVING_SPEED_MS,
+        trip_stop_dwell_s=args.trip_dwell if args.trip_dwell is not None else TRIP_STOP_DWELL_S,
+        trip_min_distance_m=args.trip_min_distance if args.trip_min_distance is not None else TRIP_MIN_DISTANCE_M,
+        history_batch_size=args.history_batch_size or HISTORY_BATCH_SIZE,
+        history_batch_interval=(
+            args.history_batch_interval if args.history_batch_interval is not None else HISTORY_BATCH_INTERVAL
+        ),
+        history_fsync_policy=args.history_fsync or HISTORY_FSYNC_POLICY,
+        history_fsync_interval=args.history_fsync_interval or HISTORY_FSYNC_INTERVAL,
+        history_rotate_bytes=(
+            args.history_rotate_bytes if args.history_rotate_bytes is not None else HISTORY_ROTATE_BYTES
+        ),
+        history_rotate_daily=(
+            args.history_rotate_daily if args.history_rotate_daily is not None else HISTORY_ROTATE_DAILY
+        ),
+        history_compression=args.history_compression or HISTORY_COMPRESSION,
+        history_retention_bytes=(
+            args.history_retention_bytes if args.history_retention_bytes is not None else HISTORY_RETENTION_BYTES
+        ),
+        history_raw_mode=args.history_raw or HISTORY_RAW_MODE,
+        history_backend=args.history_backend or HISTORY_BACKEND,
+        history_binary_dir=args.history_binary_dir or HISTORY_BINARY_DIR,
+        history_http_host=args.history_http_host or HISTORY_HTTP_HOST,
+        history_http_port=args.history_http_port if args.history_http_port is not None else HISTORY_HTTP_PORT,
+        track_lod_dir=None if args.no_track_lod else (args.track_lod_dir or TRACK_LOD_DIR),
+        track_lod_pixel_tolerance=args.track_lod_tolerance or TRACK_LOD_PIXEL_TOLERANCE,
+        metrics_http_host=args.metrics_host or METRICS_HTTP_HOST,
+        metrics_http_port=args.metrics_port if args.metrics_port is not None else METRICS_HTTP_PORT,
+        system_info_interval=args.sysinfo_interval or SYSTEM_INFO_INTERVAL,
+        heartbeat_interval=args.heartbeat_interval if args.heartbeat_interval is not None else HEARTBEAT_INTERVAL,
+        epoch_fusion=args.epoch_fusion if args.epoch_fusion is not None else EPOCH_FUSION_ENABLED,
+        epoch_sentences=epoch_sentences or EPOCH_FUSION_SENTENCES,
+        epoch_timeout=args.epoch_timeout if args.epoch_timeout is not None else EPOCH_FUSION_TIMEOUT,
+        payload_encoding=args.payload_encoding or MQTT_PAYLOAD_ENCODING,
+        batch_size=args.batch_size or MQTT_BATCH_SIZE,
+        batch_interval_ms=args.batch_interval_ms if args.batch_interval_ms is not None else MQTT_BATCH_INTERVAL_MS,
+        publish_filters=args.filters if args.filters is not None else PUBLISH_FILTERS,
+        deadband_distance_m=args.deadband_m if args.deadband_m is not None else DEADBAND_DISTANCE_M,
+        deadband_heading_deg=args.deadband_heading if args.deadband_heading is not None else DEADBAND_HEADING_DEG,
+        simplify_tolerance_m=args.simplify_tolerance if args.simplify_tolerance is not None else SIMPLIFY_TOLERANCE_M,
+        filter_max_silence_s=args.max_silence if args.max_silence is not None else FILTER_MAX_SILENCE_S,
+        spool_dir=None if args.no_spool else (args.spool_dir or SPOOL_DIR),
+        spool_max_bytes=args.spool_max_bytes if args.spool_max_bytes is not None else SPOOL_MAX_BYTES,
+        spool_drain_rate=args.spool_rate if args.spool_rate is not None else SPOOL_DRAIN_RATE,
     )
 
     manual_args = None
@@ -840,14 +8019,159 @@ def build_config_from_args() -> tuple[PublisherConfig, Optional[tuple[float, flo
 
 
 def main():
-    """脚本入口，支持手动发布一次或启动常规服务。"""
+    """脚本入口，支持手动发布一次、转换、查询或统计历史，或启动常规服务。"""
+
+    args = build_arg_parser().parse_args()
+    config, manual_args = build_config_from_args(args)
+
+    if args.convert_history:
+        store = BinaryHistoryStore(config.history_binary_dir)
+        count = convert_history_to_binary(config.history_file, store)
+        logging.info("已转换 %d 条历史记录到 %s（跳过 %d 条）", count, config.history_binary_dir, store.skipped)
+        return
+
+    if args.query or args.serve_history or args.build_track_lod or args.trips:
+        binary_store = BinaryHistoryStore(config.history_binary_dir) if config.history_backend != "jsonl" else None
+        query = HistoryQuery(config.history_file, binary_store)
+        pyramid = build_track_pyramid(config, query)
+
+        if args.build_track_lod:
+            if pyramid is None:
+                logging.error("未配置轨迹金字塔缓存目录")
+                return
+            try:
+                report = pyramid.build(
+                    args.query_device,
+                    parse_query_time(args.query_start) if args.query_start else None,
+                    parse_query_time(args.query_end) if args.query_end else None,
+                )
+            except ValueError as exc:
+                logging.error("历史查询参数错误: %s", exc)
+                return
+            logging.info(
+                "轨迹金字塔已重建: %d 台设备，%d 个小时块，%d 个定位，用时 %.1f 秒",
+                report["devices"],
+                report["chunks"],
+                report["points"],
+                report["elapsed_s"],
+            )
+            return
+
+        if args.trips:
+            count = 0
+            started = time.perf_counter()
+
+            def counted(trips: Iterator[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+                nonlocal count
+                for trip in trips:
+                    count += 1
+                    yield trip
+
+            try:
+                trips = summarize_trips(
+                    query,
+                    args.query_device,
+                    parse_query_time(args.query_start) if args.query_start else None,
+                    parse_query_time(args.query_end) if args.query_end else None,
+                    **trip_options(config),
+                )
+                write_query_results(counted(trips), args.query_format, sys.stdout.write)
+            except ValueError as exc:
+                logging.error("历史查询参数错误: %s", exc)
+                return
+            except BrokenPipeError:
+                return
+            logging.info("行程统计完成: %d 个行程，用时 %.1f 秒", count, time.perf_counter() - started)
+            return
+
+        if args.serve_history:
+            server = start_history_http_server(
+                query, config.history_http_host, config.history_http_port or 8765, pyramid, trip_options(config)
+            )
+            if pyramid:
+                pyramid.start()
+            try:
+                while True:
+                    time.sleep(3600)
+            except KeyboardInterrupt:
+                logging.info("收到中断信号，准备退出...")
+            finally:
+                server.shutdown()
+                server.server_close()
+                if pyramid:
+                    pyramid.stop()
+            return
+
+        try:
+            fixes = query.iter_fixes(
+                device_id=args.query_device,
+                start=parse_query_time(args.query_start) if args.query_start else None,
+                end=parse_query_time(args.query_end) if args.query_end else None,
+                bbox=parse_query_bbox(args.query_bbox) if args.query_bbox else None,
+                limit=args.query_limit,
+            )
+            write_query_results(fixes, args.query_format, sys.stdout.write)
+        except ValueError as exc:
+            logging.error("历史查询参数错误: %s", exc)
+        except BrokenPipeError:
+            pass
+        return
+
+    if args.replay:
+        try:
+            speed = parse_replay_speed(args.speed)
+        except ValueError as exc:
+            logging.error("回放速度无效: %s", exc)
+            return
+        publisher = GPSPublisher(config)
+        try:
+            publisher.replay(args.replay, speed)
+        except KeyboardInterrupt:
+            logging.info("收到中断信号，准备退出...")
+        finally:
+            publisher.cleanup_resources()
+        return
+
+    if args.manual_file:
+        publisher = GPSPublisher(config)
+        try:
+            stream = sys.stdin if str(args.manual_file) == "-" else open_history_text(args.manual_file)
+            with stream:
+                publisher.publish_manual_points(
+                    iter_manual_points(stream),
+                    rate=args.manual_rate if args.manual_rate is not None else MANUAL_PUBLISH_RATE,
+                    window=args.manual_window or MANUAL_INFLIGHT_WINDOW,
+                )
+        except (OSError, RuntimeError) as exc:
+            logging.error("读取手动发布文件失败: %s", exc)
+        finally:
+            publisher.cleanup_resources()
+        return
+
+    receivers_spec = args.receivers if args.receivers is not None else RECEIVERS
+    if receivers_spec and not manual_args:
+        if args.async_mode:
+            logging.error("多接收机模式不支持 --async，请去掉其中一个参数")
+            return
+        try:
+            receivers = parse_receivers(receivers_spec, config.device_id)
+        except ValueError as exc:
+            logging.error("%s", exc)
+            return
+        if not receivers:
+            logging.error("未发现可用串口，无法启动多接收机模式")
+            return
+        ReceiverSupervisor(config, receivers).run()
+        return
 
-    config, manual_args = build_config_from_args()
-    publisher = GPSPublisher(config)
+    publisher = AsyncGPSPublisher(config) if args.async_mode and not manual_args else GPSPublisher(config)
 
     if manual_args:
         lng, lat, speed = manual_args
-        publisher.publish_manual_location(lng, lat, speed)
+        try:
+            publisher.publish_manual_location(lng, lat, speed)
+        finally:
+            publisher.cleanup_resources()
         return
 
     publisher.run()
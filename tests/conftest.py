@@ -0,0 +1,6 @@
+"""测试公共设置：让测试直接导入仓库根目录的 main.py。"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,72 @@
+"""BinaryHistoryStore 的写入、重新打开与时间范围查询。"""
+
+from datetime import datetime
+
+import main
+
+BASE = 1_790_000_000 - 1_790_000_000 % 86400 + 3600  # 某个 UTC 日的 01:00，测试记录不跨日
+
+
+def record(ts: float, device: str = "dev1", speed: float = 1.5) -> dict:
+    """构造 append_history_file 格式的历史记录。"""
+
+    return {
+        "timestamp": datetime.fromtimestamp(ts, main.BEIJING_TZ).strftime("%Y/%m/%d %H:%M:%S"),
+        "lng": 121.0 + (ts - BASE) * 1e-5,
+        "lat": 40.0,
+        "speed": speed,
+        "isInsideFence": False,
+        "deviceId": device,
+    }
+
+
+def timestamps(rows) -> list[float]:
+    """query() 返回 NumPy 结构化数组或元组列表，统一取出时间戳。"""
+
+    return [float(row[0]) for row in rows]
+
+
+def test_round_trip_after_reopen(tmp_path):
+    store = main.BinaryHistoryStore(tmp_path)
+    store.append_records([record(BASE + i) for i in range(1000)])
+    store.append_records([record(BASE + i, device="dev2") for i in range(10)])
+    store.close()
+
+    reopened = main.BinaryHistoryStore(tmp_path)
+    rows = reopened.query("dev1")
+    assert timestamps(rows) == [BASE + i for i in range(1000)]
+    first = main.binary_fix_to_dict(tuple(rows[0]), "dev1")
+    assert first["timestamp"] == record(BASE)["timestamp"]
+    assert abs(first["lng"] - 121.0) < 1e-6 and abs(first["lat"] - 40.0) < 1e-6
+    assert len(reopened.query("dev2")) == 10
+
+    assert timestamps(reopened.query("dev1", BASE + 300, BASE + 599)) == [BASE + i for i in range(300, 600)]
+    reopened.close()
+
+
+def test_out_of_order_appends_stay_reachable(tmp_path):
+    """晚写入的旧记录（回填、重放）在带结束时间的查询中仍能查到。"""
+
+    store = main.BinaryHistoryStore(tmp_path)
+    store.append_records([record(BASE + 1000 + i) for i in range(600)])
+    store.append_records([record(BASE + i) for i in range(300)])
+    store.close()
+
+    store = main.BinaryHistoryStore(tmp_path)
+    assert len(store.query("dev1", BASE, BASE + 500)) == 300
+    assert len(store.query("dev1", BASE, BASE + 1100)) == 401
+    assert len(store.query("dev1", BASE + 1500, None)) == 100
+    assert len(store.query("dev1", None, BASE + 99)) == 100
+    store.close()
+
+
+def test_append_after_reopen_continues_index(tmp_path):
+    store = main.BinaryHistoryStore(tmp_path)
+    store.append_records([record(BASE + i) for i in range(300)])
+    store.close()
+
+    store = main.BinaryHistoryStore(tmp_path)
+    store.append_records([record(BASE + 300 + i) for i in range(300)])
+    assert len(store.query("dev1", BASE + 250, BASE + 349)) == 100
+    assert len(store.query("dev1")) == 600
+    store.close()
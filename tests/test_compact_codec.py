@@ -0,0 +1,71 @@
+"""encode_compact_batch / decode_compact_batch 的往返一致性。"""
+
+from datetime import datetime
+
+import pytest
+
+import main
+
+BASE = 1_790_000_000
+
+
+def fix(offset: float, **extra) -> dict:
+    ts = BASE + offset
+    data = {
+        "timestamp": datetime.fromtimestamp(ts, main.BEIJING_TZ).strftime("%Y/%m/%d %H:%M:%S"),
+        "latitude": 40.0 + offset * 1.3e-5,
+        "longitude": 121.0 - offset * 2.1e-5,
+        "speed_ms": 3.27,
+        "course": 359.99,
+    }
+    data.update(extra)
+    return data
+
+
+def test_round_trip_preserves_fields():
+    fixes = [
+        fix(0, num_satellites=9, hdop=0.87, altitude=-12.3, quality=1, isInsideFence=True, message_type="FIX"),
+        fix(1, isInsideFence=False, message_type="RMC"),
+        fix(2),
+    ]
+    decoded = main.decode_compact_batch(main.encode_compact_batch(fixes, "tracker_01"))
+
+    assert decoded["version"] == main.COMPACT_VERSION
+    assert decoded["device_id"] == "tracker_01"
+    assert len(decoded["fixes"]) == 3
+    for source, out in zip(fixes, decoded["fixes"]):
+        assert out["time"] == main._fix_epoch_ms(source)
+        assert out["latitude"] == pytest.approx(source["latitude"], abs=1e-7)
+        assert out["longitude"] == pytest.approx(source["longitude"], abs=1e-7)
+        assert out["speed_ms"] == pytest.approx(3.27)
+        assert out["course"] == pytest.approx(359.99)
+
+    first, second, third = decoded["fixes"]
+    assert (first["num_satellites"], first["hdop"], first["altitude"], first["quality"]) == (9, 0.87, -12.3, 1)
+    assert first["isInsideFence"] is True and first["message_type"] == "FIX"
+    assert second["isInsideFence"] is False and second["message_type"] == "RMC"
+    assert not {"num_satellites", "hdop", "altitude", "quality", "isInsideFence", "message_type"} & third.keys()
+
+
+def test_negative_deltas_and_time_going_backwards():
+    fixes = [fix(10), fix(0), fix(-3600, latitude=-33.8688, longitude=-151.2093)]
+    decoded = main.decode_compact_batch(main.encode_compact_batch(fixes, "d"))
+
+    assert [f["time"] for f in decoded["fixes"]] == [main._fix_epoch_ms(f) for f in fixes]
+    assert decoded["fixes"][2]["latitude"] == pytest.approx(-33.8688, abs=1e-7)
+    assert decoded["fixes"][2]["longitude"] == pytest.approx(-151.2093, abs=1e-7)
+
+
+def test_fixes_without_coordinates_are_skipped():
+    fixes = [fix(0), {"timestamp": fix(1)["timestamp"], "latitude": None, "longitude": 121.0}, fix(2)]
+    decoded = main.decode_compact_batch(main.encode_compact_batch(fixes, "d"))
+
+    assert len(decoded["fixes"]) == 2
+
+
+def test_empty_batch_and_bad_magic():
+    decoded = main.decode_compact_batch(main.encode_compact_batch([], "设备"))
+    assert decoded == {"version": main.COMPACT_VERSION, "device_id": "设备", "fixes": []}
+
+    with pytest.raises(ValueError):
+        main.decode_compact_batch(b'{"message_type": "BATCH"}')
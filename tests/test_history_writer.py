@@ -0,0 +1,42 @@
+"""HistoryWriter 关闭时对积压记录的处理。"""
+
+import json
+import threading
+
+import main
+
+
+def test_close_writes_backlog(tmp_path):
+    writer = main.HistoryWriter(tmp_path / "history.jsonl", batch_size=100, batch_interval=60.0)
+    for i in range(5):
+        writer.submit({"seq": i})
+    writer.close()
+
+    lines = (tmp_path / "history.jsonl").read_text(encoding="utf-8").splitlines()
+    assert [json.loads(line)["seq"] for line in lines] == [0, 1, 2, 3, 4]
+    assert writer.stats()["dropped"] == 0
+
+
+def test_close_does_not_race_a_stuck_writer(tmp_path, monkeypatch):
+    writer = main.HistoryWriter(tmp_path / "history.jsonl", batch_size=1, batch_interval=0.0)
+    entered = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_write(batch):
+        calls.append((threading.current_thread().name, len(batch)))
+        entered.set()
+        release.wait(5)
+
+    monkeypatch.setattr(writer, "_write_batch", slow_write)
+    monkeypatch.setattr(writer, "_close_file", lambda: calls.append(("close", 0)))
+    writer.submit({"seq": 0})
+    assert entered.wait(5)
+    writer.submit({"seq": 1})
+    writer.submit({"seq": 2})
+
+    writer.close(timeout=0.1)
+    release.set()
+
+    assert calls == [("history-writer", 1)]
+    assert writer.stats()["dropped"] == 2
@@ -0,0 +1,12 @@
+"""MetricsRegistry 的 Prometheus 文本输出。"""
+
+import main
+
+
+def test_label_values_are_escaped():
+    registry = main.MetricsRegistry()
+    registry.counter("gps_test_total", "测试计数", {"device": 'a\\b"c\nd'}).inc(3)
+
+    lines = registry.render().splitlines()
+
+    assert 'gps_test_total{device="a\\\\b\\"c\\nd"} 3' in lines
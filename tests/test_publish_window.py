@@ -0,0 +1,126 @@
+"""PublishWindow 的在途窗口与队列满时的各策略。"""
+
+import itertools
+import threading
+import time
+
+import pytest
+
+import main
+
+
+def message(name: str, qos: int = 1) -> main.OutgoingMessage:
+    return main.OutgoingMessage(topic="gps/data", payload=name, qos=qos, fixes=[], enqueued=time.perf_counter())
+
+
+class Harness:
+    """记录 send / on_overflow / on_acked 的调用，mid 从 1 递增。"""
+
+    def __init__(self, policy: str, max_inflight: int = 1, queue_size: int = 2):
+        self.sent: list[str] = []
+        self.overflow: list[str] = []
+        self.acked: list[str] = []
+        self._mids = itertools.count(1)
+        self.window = main.PublishWindow(
+            self.send,
+            max_inflight=max_inflight,
+            queue_size=queue_size,
+            policy=policy,
+            on_acked=lambda m: self.acked.append(m.payload),
+            on_overflow=lambda m: self.overflow.append(m.payload),
+        )
+
+    def send(self, outgoing: main.OutgoingMessage) -> int:
+        self.sent.append(outgoing.payload)
+        return next(self._mids)
+
+
+def test_window_limits_inflight_and_sends_on_ack():
+    h = Harness("drop-newest", max_inflight=2, queue_size=10)
+    h.window.resume()
+    for name in "abcd":
+        h.window.submit(message(name))
+
+    assert h.sent == ["a", "b"]
+    assert h.window.acked(1)
+    assert h.sent == ["a", "b", "c"]
+    assert h.acked == ["a"]
+    assert not h.window.acked(99)
+
+
+def test_drop_oldest_evicts_head_of_queue():
+    h = Harness("drop-oldest")  # 未连接：全部入队
+    for name in "abcd":
+        h.window.submit(message(name))
+
+    assert h.overflow == ["a", "b"]
+    h.window.resume()
+    assert h.sent == ["c"]
+    assert h.window.stats()["dropped"] == 2
+
+
+def test_drop_newest_rejects_incoming():
+    h = Harness("drop-newest")
+    for name in "abcd":
+        h.window.submit(message(name))
+
+    assert h.overflow == ["c", "d"]
+    h.window.resume()
+    assert h.sent == ["a"]
+
+
+def test_block_does_not_wait_while_disconnected():
+    h = Harness("block")
+    for name in "abc":
+        h.window.submit(message(name))
+
+    assert h.overflow == ["c"]
+
+
+def test_block_waits_for_room_then_enqueues():
+    h = Harness("block", max_inflight=1, queue_size=1)
+    h.window.resume()
+    h.window.submit(message("a"))  # 在途
+    h.window.submit(message("b"))  # 队列已满
+
+    worker = threading.Thread(target=h.window.submit, args=(message("c"),))
+    worker.start()
+    worker.join(0.2)
+    assert worker.is_alive()
+
+    h.window.acked(1)  # b 进入窗口，队列腾出空位
+    worker.join(2)
+    assert not worker.is_alive()
+    assert h.overflow == []
+    assert h.sent == ["a", "b"]
+    assert h.window.stats()["queued"] == 1
+
+
+@pytest.mark.parametrize("release", ["close", "pause"])
+def test_block_stops_waiting_on_close_or_disconnect(release):
+    h = Harness("block", max_inflight=1, queue_size=1)
+    h.window.resume()
+    h.window.submit(message("a"))
+    h.window.submit(message("b"))
+
+    worker = threading.Thread(target=h.window.submit, args=(message("c"),))
+    worker.start()
+    worker.join(0.2)
+    assert worker.is_alive()
+
+    getattr(h.window, release)()
+    worker.join(2)
+    assert not worker.is_alive()
+    assert h.overflow == ["c"]
+
+
+def test_pause_hands_lost_qos0_messages_to_overflow():
+    h = Harness("drop-newest", max_inflight=2, queue_size=10)
+    h.window.resume()
+    h.window.submit(message("q0", qos=0))
+    h.window.submit(message("q1", qos=1))
+
+    h.window.pause()
+    assert h.overflow == ["q0"]
+    assert h.window.stats()["lost"] == 1
+    assert h.window.pending() == 1